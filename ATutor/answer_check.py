@@ -0,0 +1,304 @@
+# ATutor/answer_check.py
+# Local fast-path verdicts for /analyse-work, checked before any LLM call.
+#
+# Many submissions end with a final answer that is plainly right (or, for multiple choice,
+# plainly wrong). We compare the last line of the transcription with the stored answer:
+#   • MCQ   — the student wrote just a choice label: match it against `correct_choice`.
+#   • Value — parse both answers with SymPy and test equivalence (numeric probes), with a time
+#             limit. Answers are parsed unevaluated first and anything with large literals or
+#             exponents is left to the model: a power tower like 9^9^7 would otherwise hold the GIL
+#             (and the event loop) for seconds, and a timed-out thread cannot be stopped.
+#             When both answers are labelled (`x = 2`, `y = 2`) the labels must match; lines with
+#             more than one "=" (several assignments, chains) are left to the model.
+# Only *confident* verdicts are returned; anything unparseable, unsimplified or non-equivalent
+# returns None and the request goes to the model as usual (a wrong final answer deserves a real hint).
+# Normalisation rules follow A_Level/pipeline_scripts/cas_validator.py.
+#
+# Env:
+#   ANSWER_FASTPATH           "on" (default) or "off"
+#   ANSWER_CHECK_TIMEOUT_MS   budget for one SymPy comparison (default 250)
+
+import asyncio
+import logging
+import os
+import random
+import re
+from typing import List, Optional, Tuple
+
+try:
+    import sympy as sp
+    from sympy.parsing.sympy_parser import (
+        convert_xor,
+        implicit_multiplication_application,
+        parse_expr,
+        standard_transformations,
+    )
+except ImportError:  # SymPy is optional; without it only MCQ labels are checked locally
+    sp = None  # type: ignore[assignment]
+
+FASTPATH_MODE = os.getenv("ANSWER_FASTPATH", "on").strip().lower()
+CHECK_TIMEOUT_SECONDS = int(os.getenv("ANSWER_CHECK_TIMEOUT_MS", "250")) / 1000.0
+
+# Anything longer is not a "final answer" and is left to the model
+_MAX_ANSWER_CHARS = 120
+_NUMERIC_PROBES = 5
+_NUMERIC_TOL = 1e-9
+# Size limits checked on the unevaluated parse tree before SymPy evaluates anything
+_MAX_LITERAL_DIGITS = 30
+_MAX_EXPONENT = 100  # product of numeric exponents along any chain of nested powers
+_MAX_NODES = 200
+
+_CHOICE_RE = re.compile(r"^\(?\s*([A-Ea-e])\s*\)?\s*[.:]?$")
+_CHOICE_PREFIX_RE = re.compile(r"^(?:answer|ans|option|choice)\s*(?:is|[:=])?\s*", re.IGNORECASE)
+
+# LaTeX that only affects layout (whole command names only: \leftarrow stays)
+_LATEX_LAYOUT = re.compile(
+    r"\\(?:(?:left|right|displaystyle|textstyle|quad|qquad)(?![A-Za-z])|,|;|:|!)"
+    r"|\\\(|\\\)|\\\[|\\\]|\$|&"
+)
+_LATEX_SIMPLE = {
+    r"\cdot": "*",
+    r"\times": "*",
+    r"\div": "/",
+    r"\pi": "pi",
+    r"\infty": "oo",
+    r"\ln": "log",
+    r"\log": "log",
+    r"\sin": "sin",
+    r"\cos": "cos",
+    r"\tan": "tan",
+    r"\sec": "sec",
+    r"\csc": "csc",
+    r"\cot": "cot",
+    r"\exp": "exp",
+}
+_UNICODE_OPS = {
+    "−": "-",
+    "–": "-",
+    "—": "-",
+    "×": "*",
+    "·": "*",
+    "÷": "/",
+    "π": "pi",
+    "∞": "oo",
+}
+_FRAC_RE = re.compile(r"\\[dt]?frac\s*\{([^{}]*)\}\s*\{([^{}]*)\}")
+_SQRT_N_RE = re.compile(r"\\sqrt\s*\[([^\]]*)\]\s*\{([^{}]*)\}")
+_SQRT_RE = re.compile(r"\\sqrt\s*\{([^{}]*)\}")
+_TEXT_RE = re.compile(r"\\(?:text|mathrm|operatorname)\s*\{[^{}]*\}")
+# `x`, `y`, `f(x)` — what may precede "=" on an answer line
+_LABEL_RE = re.compile(r"[A-Za-z](?:\s*\(\s*[A-Za-z]\s*\))?")
+# parse_expr evaluates its input, so only plain arithmetic on known names is ever passed to it
+_SAFE_CHARS_RE = re.compile(r"^[A-Za-z0-9 .+\-*/()=,<>!]*$")
+_IDENTIFIER_RE = re.compile(r"[A-Za-z]+")
+_KNOWN_NAMES = {"sin", "cos", "tan", "sec", "csc", "cot", "log", "exp", "sqrt", "pi", "oo"}
+
+if sp is not None:
+    _TRANSFORMS = standard_transformations + (implicit_multiplication_application, convert_xor)
+    # Parse e as Euler's number and keep I/E/S/N/O/Q from shadowing single-letter unknowns
+    _LOCALS = {name: sp.Symbol(name) for name in "abcdfghijklmnopqrstuvwxyzABCDFGHIJKLMNOPQRSTUVWXYZ"}
+    _LOCALS["e"] = sp.E
+
+
+def _last_line(text: str) -> str:
+    lines = [ln.strip() for ln in re.split(r"\n|\\\\", text or "") if ln.strip()]
+    return lines[-1] if lines else ""
+
+
+def _strip_latex(s: str) -> str:
+    s = _LATEX_LAYOUT.sub(" ", s)
+    for k, v in _UNICODE_OPS.items():
+        s = s.replace(k, v)
+    return s.strip()
+
+
+def extract_choice(transcription: str) -> Optional[str]:
+    """The choice label (A–E) if the student's final line is just a label, else None."""
+    line = _CHOICE_PREFIX_RE.sub("", _strip_latex(_last_line(transcription)))
+    line = _TEXT_RE.sub(lambda m: m.group(0)[m.group(0).index("{") + 1:-1], line).strip()
+    m = _CHOICE_RE.match(line)
+    return m.group(1).upper() if m else None
+
+
+def latex_to_sympy_str(s: str) -> Optional[str]:
+    """
+    Convert simple LaTeX (fractions, roots, powers, common functions) to SymPy syntax.
+    Returns None when LaTeX we don't understand remains.
+    """
+    s = _strip_latex(s)
+    s = _TEXT_RE.sub(" ", s)
+    # Innermost-first so nested \frac{\frac{..}{..}}{..} unwinds
+    prev = None
+    while prev != s:
+        prev = s
+        s = _FRAC_RE.sub(r"((\1)/(\2))", s)
+        s = _SQRT_N_RE.sub(r"((\2)**(1/(\1)))", s)
+        s = _SQRT_RE.sub(r"sqrt(\1)", s)
+    for k in sorted(_LATEX_SIMPLE, key=len, reverse=True):
+        s = s.replace(k, _LATEX_SIMPLE[k])
+    if "\\" in s:
+        return None
+    s = s.replace("{", "(").replace("}", ")").replace("^", "**")
+    if not _SAFE_CHARS_RE.match(s):
+        return None
+    if any(len(w) > 1 and w not in _KNOWN_NAMES for w in _IDENTIFIER_RE.findall(s)):
+        return None
+    return re.sub(r"\s+", " ", s).strip()
+
+
+def _final_value(text: str) -> Optional[Tuple[Optional[str], str]]:
+    """
+    (label, right-hand side) of the final line: `y = 3x + 1` -> ("y", "3x + 1"), `2` -> (None, "2").
+    """
+    line = _last_line(text)
+    if not line or len(line) > _MAX_ANSWER_CHARS:
+        return None
+    converted = latex_to_sympy_str(line)
+    if not converted:
+        return None
+    label = None
+    if "=" in converted:
+        # "x = 5, x = 2", "x = 3, y = 2" and chains like "x = 9 = 2" hold several claims;
+        # comparing only the last one would pass wrong work, so the model judges those
+        if converted.count("=") > 1:
+            return None
+        label, converted = converted.split("=")
+        # A final line like "2x + 1 = 7" is an equation, not an answer
+        if not _LABEL_RE.fullmatch(label.strip()):
+            return None
+        label = re.sub(r"\s+", "", label)
+    if any(op in converted for op in ("<", ">", "!", ",", ";")) and not _is_tuple(converted):
+        return None
+    converted = converted.strip()
+    return (label, converted) if converted else None
+
+
+def _is_tuple(s: str) -> bool:
+    s = s.strip()
+    return s.startswith("(") and s.endswith(")") and "," in s
+
+
+def _split_tuple(s: str) -> List[str]:
+    return [part.strip() for part in s.strip()[1:-1].split(",")]
+
+
+def _within_limits(tree) -> bool:
+    """
+    True if evaluating the unevaluated tree is cheap: small integer literals, few nodes, and
+    numeric exponents whose product along nested powers stays under _MAX_EXPONENT.
+    """
+    stack = [(tree, 1.0)]
+    nodes = 0
+    while stack:
+        node, scale = stack.pop()
+        nodes += 1
+        if nodes > _MAX_NODES:
+            return False
+        if node.is_Integer:
+            if len(str(abs(int(node)))) > _MAX_LITERAL_DIGITS:
+                return False
+        elif node.is_Pow:
+            base, exponent = node.args
+            if not _within_limits(exponent):
+                return False
+            if exponent.free_symbols:
+                stack.append((base, scale))
+            else:
+                # Safe to evaluate now: the exponent's own subtree passed the same checks
+                scale *= max(1.0, abs(complex(exponent.evalf())))
+                if scale > _MAX_EXPONENT:
+                    return False
+                stack.append((base, scale))
+        else:
+            stack.extend((arg, scale) for arg in node.args)
+    return True
+
+
+def _parse(s: str):
+    """(unevaluated tree, evaluated expression); ValueError when the answer is too big to evaluate here."""
+    tree = parse_expr(s, local_dict=_LOCALS, transformations=_TRANSFORMS, evaluate=False)
+    if not _within_limits(tree):
+        raise ValueError("answer too large to compare locally")
+    return tree, parse_expr(s, local_dict=_LOCALS, transformations=_TRANSFORMS, evaluate=True)
+
+
+def _equivalent(a, b) -> bool:
+    # No expand(): (a + b + ... )^n blows up; numeric probes decide instead
+    diff = a - b
+    if diff == 0:
+        return True
+    free = sorted(diff.free_symbols, key=str)
+    rng = random.Random(0)
+    for _ in range(_NUMERIC_PROBES):
+        point = {sym: sp.Float(rng.uniform(0.3, 2.7)) for sym in free}
+        value = complex(diff.evalf(subs=point))
+        if abs(value) > _NUMERIC_TOL * max(1.0, abs(complex(a.evalf(subs=point)))):
+            return False
+    return True
+
+
+def _same_value(student: str, reference: str) -> bool:
+    """True only if the student's answer equals the reference and is no less simplified."""
+    if _is_tuple(student) or _is_tuple(reference):
+        if not (_is_tuple(student) and _is_tuple(reference)):
+            return False
+        s_parts, r_parts = _split_tuple(student), _split_tuple(reference)
+        return len(s_parts) == len(r_parts) and all(_same_value(s, r) for s, r in zip(s_parts, r_parts))
+    (a_tree, a), (b_tree, b) = _parse(student), _parse(reference)
+    # "8/4" is equivalent to "2" but counts as unfinished; leave such cases to the model
+    return _equivalent(a, b) and sp.count_ops(a_tree) <= sp.count_ops(b_tree)
+
+
+def _correct(reason: str) -> dict:
+    return {"analysis": "CORRECT", "reason": reason}
+
+
+async def quick_verdict(
+    transcription: str,
+    solution_text: str,
+    final_answer: Optional[str] = None,
+    correct_choice: Optional[str] = None,
+) -> Optional[dict]:
+    """
+    A confident {"analysis", "reason"} verdict for the student's final answer, or None
+    when the model should decide.
+    """
+    if FASTPATH_MODE == "off" or not transcription.strip():
+        return None
+
+    choice = extract_choice(transcription)
+    if correct_choice and choice:
+        if choice == correct_choice.strip().upper()[:1]:
+            return _correct(f"Correct — option {choice} is the right answer. Well done!")
+        return {
+            "analysis": "INCORRECT",
+            "reason": (
+                f"Option {choice} isn't the right answer. Re-check each option against the question "
+                "and try again."
+            ),
+        }
+    if choice or sp is None:
+        return None
+
+    student = _final_value(transcription)
+    reference = _final_value(final_answer or solution_text)
+    if not student or not reference:
+        return None
+    (student_label, student_value), (reference_label, reference_value) = student, reference
+    if student_label and reference_label and student_label != reference_label:
+        return None  # `x = 2` against `y = 2`: right number, wrong unknown
+
+    try:
+        same = await asyncio.wait_for(
+            asyncio.to_thread(_same_value, student_value, reference_value), CHECK_TIMEOUT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        logging.info("Answer fast-path: SymPy comparison timed out; deferring to the model")
+        return None
+    except Exception as e:  # SympifyError, TypeError, ... — not a confident verdict either way
+        logging.debug(f"Answer fast-path: could not compare answers: {e}")
+        return None
+
+    if same:
+        return _correct("Correct — your final answer matches. Well done!")
+    return None
@@ -1,8 +1,22 @@
 # ATutor/auth_utils.py
 # Minimal helper for verifying Firebase ID tokens from HTTP requests.
-
-from typing import Optional
+#
+# Decoded tokens are kept in a small in-process LRU (keyed by a hash of the token) until just
+# before they expire, so a client reusing one ID token for an hour pays for signature
+# verification once, not on every request. Shared by the tutor, leaderboard and profile routes.
+#
+# Env:
+#   AUTH_TOKEN_CACHE_SIZE              max cached tokens (default 10000; 0 disables the cache)
+#   AUTH_CHECK_REVOKED                 "true" to also check revocation (extra Admin API call per miss)
+#   AUTH_REVOCATION_RECHECK_SECONDS    with revocation checks on, re-verify cached tokens this often (default 300)
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import hashlib
 import logging
+import os
+import threading
+import time
 
 import firebase_admin
 from firebase_admin import auth
@@ -11,6 +25,7 @@ from fastapi import Header, HTTPException, status
 # We rely on your existing FirebaseManager to initialize the Admin SDK once.
 # (utils.FirebaseManager sets up firebase_admin.initialize_app with env creds.)
 from utils import FirebaseManager
+from observability import stage
 
 
 def _ensure_firebase_initialized() -> None:
@@ -38,6 +53,91 @@ def _extract_bearer_token(authorization_header: Optional[str]) -> Optional[str]:
     return None
 
 
+# ======= Decoded token cache =======
+
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+CHECK_REVOKED = os.getenv("AUTH_CHECK_REVOKED", "false").strip().lower() in ("1", "true", "yes")
+REVOCATION_RECHECK_SECONDS = int(os.getenv("AUTH_REVOCATION_RECHECK_SECONDS", "300"))
+# Stop serving a cached token this long before its `exp`, so we never accept an expired one
+_EXPIRY_SKEW_SECONDS = 60
+
+
+class _DecodedTokenCache:
+    """Thread-safe LRU of sha256(token) -> (valid_until_epoch, decoded_claims)."""
+
+    def __init__(self, max_size: int) -> None:
+        self._max = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        if self._max <= 0:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token: str, decoded: Dict[str, Any]) -> None:
+        if self._max <= 0:
+            return
+        try:
+            valid_until = float(decoded.get("exp", 0)) - _EXPIRY_SKEW_SECONDS
+        except (TypeError, ValueError):
+            return
+        if CHECK_REVOKED:
+            valid_until = min(valid_until, time.time() + REVOCATION_RECHECK_SECONDS)
+        if valid_until <= time.time():
+            return
+        with self._lock:
+            self._entries[self._key(token)] = (valid_until, decoded)
+            self._entries.move_to_end(self._key(token))
+            while len(self._entries) > self._max:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "check_revoked": CHECK_REVOKED,
+            }
+
+
+_token_cache = _DecodedTokenCache(TOKEN_CACHE_SIZE)
+
+
+def token_cache_stats() -> Dict[str, Any]:
+    return _token_cache.stats()
+
+
+def _verify_id_token_cached(token: str) -> Dict[str, Any]:
+    """verify_id_token with the decoded-claims cache in front. Raises on invalid tokens (never cached)."""
+    with stage("auth"):
+        decoded = _token_cache.get(token)
+        if decoded is not None:
+            return decoded
+        decoded = auth.verify_id_token(token, check_revoked=CHECK_REVOKED)
+        _token_cache.put(token, decoded)
+        return decoded
+
+
 def verify_request_and_get_uid(authorization_header: Optional[str]) -> str:
     """
     Verify the Firebase ID token from the Authorization header and return the caller's uid.
@@ -53,7 +153,7 @@ def verify_request_and_get_uid(authorization_header: Optional[str]) -> str:
         )
 
     try:
-        decoded = auth.verify_id_token(token)
+        decoded = _verify_id_token_cached(token)
         uid = decoded.get("uid")
         if not uid:
             raise ValueError("Token decoded but missing 'uid'")
@@ -85,7 +185,7 @@ def verify_request_and_get_user(authorization_header: Optional[str]) -> dict:
         )
 
     try:
-        decoded = auth.verify_id_token(token)
+        decoded = _verify_id_token_cached(token)
         uid = decoded.get("uid")
         if not uid:
             raise ValueError("Token decoded but missing 'uid'")
@@ -0,0 +1,158 @@
+# ATutor/chat_sessions.py
+# Server-side chat session state for the tutor chat.
+#
+# A session holds the fixed question context (built once and reused as a cached prompt prefix),
+# a running summary of older turns, and the most recent turns verbatim. Clients only send the
+# new student message; once the verbatim history passes a token budget, the oldest turns are
+# folded into the summary so per-turn prompt size stays flat over long tutoring sessions.
+#
+# Notes:
+# • State is in-process. Run with sticky routing (or a single worker) when scaling out;
+#   an unknown/expired session id should make the client start a new session.
+# • This module contains NO FastAPI routing and no model calls — the summariser is passed in.
+
+import asyncio
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from prompts import get_chat_context_prompt, get_chat_turn_prompt
+
+# Tunables (env overrides)
+SESSION_TTL_SECONDS = int(os.getenv("CHAT_SESSION_TTL_SECONDS", "3600"))
+MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "5000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500"))
+KEEP_RECENT_TURNS = int(os.getenv("CHAT_KEEP_RECENT_TURNS", "6"))
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token); good enough for budgeting."""
+    return (len(text) + 3) // 4
+
+
+def format_turns(turns: List[Tuple[bool, str]]) -> str:
+    """Format (is_user, text) turns exactly like the /chat endpoint formats conversation_history."""
+    return "\n".join(f"{'Student' if is_user else 'Tutor'}: {text}" for is_user, text in turns)
+
+
+@dataclass
+class ChatSession:
+    session_id: str
+    question_part: str
+    student_work: str
+    solution_text: str
+    context_prompt: str  # fixed prefix (rules + question context), identical on every turn
+    summary: str = ""
+    turns: List[Tuple[bool, str]] = field(default_factory=list)  # (is_user, text), oldest first
+    last_used: float = field(default_factory=time.monotonic)
+    model: Any = None  # per-session model bound to context_prompt (set by the caller)
+    compacting: bool = False
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def turn_prompt(self, pending_student_message: Optional[str] = None) -> str:
+        """Per-turn prompt: running summary + verbatim recent turns (+ the new message)."""
+        turns = list(self.turns)
+        if pending_student_message is not None:
+            turns.append((True, pending_student_message))
+        return get_chat_turn_prompt(format_turns(turns), self.summary)
+
+    def history_tokens(self) -> int:
+        return estimate_tokens(format_turns(self.turns))
+
+
+class ChatSessionStore:
+    """Bounded, TTL-expiring, in-memory map of session_id -> ChatSession (LRU eviction)."""
+
+    def __init__(self, ttl_seconds: int = SESSION_TTL_SECONDS, max_sessions: int = MAX_SESSIONS) -> None:
+        self._ttl = ttl_seconds
+        self._max = max_sessions
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+    def create(
+        self,
+        question_part: str,
+        student_work: str,
+        solution_text: str,
+        history: Optional[List[Tuple[bool, str]]] = None,
+    ) -> ChatSession:
+        self._evict_expired()
+        session = ChatSession(
+            session_id=secrets.token_urlsafe(16),
+            question_part=question_part,
+            student_work=student_work,
+            solution_text=solution_text,
+            context_prompt=get_chat_context_prompt(question_part, student_work, solution_text),
+            turns=list(history or []),
+        )
+        self._sessions[session.session_id] = session
+        while len(self._sessions) > self._max:
+            self._sessions.popitem(last=False)
+        return session
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if time.monotonic() - session.last_used > self._ttl:
+            self._sessions.pop(session_id, None)
+            return None
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        # OrderedDict is in LRU order, so expired sessions are at the front
+        while self._sessions:
+            sid, oldest = next(iter(self._sessions.items()))
+            if now - oldest.last_used <= self._ttl:
+                break
+            self._sessions.pop(sid, None)
+
+
+async def compact_session(
+    session: ChatSession,
+    summarize: Callable[[str, str], Awaitable[str]],
+    token_budget: int = HISTORY_TOKEN_BUDGET,
+    keep_recent: int = KEEP_RECENT_TURNS,
+) -> bool:
+    """
+    Fold the oldest turns into the running summary once the verbatim history exceeds `token_budget`.
+    The newest `keep_recent` turns are always kept verbatim. `summarize(previous_summary, formatted_turns)`
+    returns the new summary text. Returns True if the session was compacted.
+    """
+    async with session.lock:
+        if session.compacting:
+            return False
+        if session.history_tokens() <= token_budget or len(session.turns) <= keep_recent:
+            return False
+        cut = len(session.turns) - keep_recent
+        old_turns = session.turns[:cut]
+        previous_summary = session.summary
+        session.compacting = True
+
+    # Summarise WITHOUT holding the lock so the next student message is not delayed
+    try:
+        new_summary = (await summarize(previous_summary, format_turns(old_turns))).strip()
+    except Exception as e:
+        logging.warning(f"Chat session {session.session_id}: compaction failed, keeping full history: {e}")
+        new_summary = ""
+
+    async with session.lock:
+        session.compacting = False
+        if not new_summary:
+            return False
+        session.summary = new_summary
+        # Turns are only ever appended, so the summarised ones are still at the front
+        session.turns = session.turns[cut:]
+        return True
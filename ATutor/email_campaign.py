@@ -0,0 +1,466 @@
+# ATutor/email_campaign.py
+# Bulk email campaigns (new-term announcements, streak reminders, ...) to the user base.
+#
+#   python email_campaign.py --campaign term-2025-autumn --template new_term
+#   python email_campaign.py --campaign streaks-2025-10-20 --template streak_reminder --audience streak
+#   python email_campaign.py --campaign test --template new_term --dry-run --limit 1000
+#
+# • Users are streamed page by page (ordered by document id) with a field mask — only the
+#   fields a template can use, never friends arrays etc.
+# • Templates are compiled once; each recipient only gets a $placeholder substitution
+#   (values HTML-escaped). Users without an email or with emailOptOut are skipped.
+# • Each page is sent through a bounded thread pool behind a shared rate limit (the provider's
+#   requests/second); 429/5xx responses are retried with backoff.
+# • Every recipient gets one EmailSends/{campaign}_{uid} entry (written through a BulkWriter).
+#   Progress (cursor = last fully processed user id, counters) lives in EmailCampaigns/{campaign};
+#   re-running the same campaign id resumes after the cursor, and recipients already logged as
+#   accepted are never sent to twice. The log id is also the provider idempotency key.
+# • The cursor moves past failed recipients too, so every re-run (also of a completed campaign)
+#   first retries the recipients logged as "failed" by earlier runs.
+# • --transport local uses the in-process stand-in transport (EMAIL_LOCAL_LATENCY_MS simulates
+#   provider latency); --dry-run additionally writes nothing to Firestore. Both are meant for
+#   rehearsals and throughput benchmarks.
+#
+# Env:
+#   CAMPAIGN_FROM_EMAIL          sender (default: WELCOME_FROM_EMAIL)
+#   CAMPAIGN_RATE_PER_SEC        provider send rate (default 2, Resend's default API limit; 0 = unlimited)
+#   CAMPAIGN_CONCURRENCY         sends in flight (default 8)
+#   CAMPAIGN_MAX_ATTEMPTS        attempts per recipient for retryable failures (default 3)
+
+import argparse
+import html
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
+from typing import Any, Dict, Iterator, List, Optional
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from email_service import (
+    EMAIL_LOG_COLLECTION,
+    WELCOME_FROM,
+    EmailSendError,
+    LocalTransport,
+    ResendTransport,
+    get_transport,
+    send_message,
+)
+from upstream_limits import TokenBucket
+from utils import FirebaseManager
+
+CAMPAIGN_COLLECTION = "EmailCampaigns"
+CAMPAIGN_FROM = os.getenv("CAMPAIGN_FROM_EMAIL", WELCOME_FROM)
+RATE_PER_SEC = float(os.getenv("CAMPAIGN_RATE_PER_SEC", "2"))
+CONCURRENCY = int(os.getenv("CAMPAIGN_CONCURRENCY", "8"))
+MAX_ATTEMPTS = int(os.getenv("CAMPAIGN_MAX_ATTEMPTS", "3"))
+
+# The only user fields a campaign reads
+RECIPIENT_FIELDS = ["email", "username", "displayName", "currentStreak", "totalXP", "emailOptOut"]
+
+DOC_ID = FieldPath.document_id()
+
+_SIGNATURE = """
+      <p style="margin-top:20px;">
+        Ben J
+        <br/>
+        <span style="color:#666;">Founder, Alma Math</span>
+      </p>
+"""
+
+# Built-in templates; placeholders: $name, $streak, $total_xp
+TEMPLATES: Dict[str, Dict[str, str]] = {
+    "new_term": {
+        "subject": "A new term with Alma 📚",
+        "html": """
+    <div style="font-family:-apple-system,BlinkMacSystemFont,Segoe UI,Roboto,Arial,sans-serif;
+                line-height:1.5; color:#111;">
+      <p><b>Hi $name,</b></p>
+      <p>
+        A new term is starting, and Alma has new weeks of questions ready for you.
+        You've earned $total_xp XP so far — let's build on it.
+      </p>
+      <p>As always, just reply if anything feels wrong or missing. I read every message myself.</p>
+""" + _SIGNATURE + """
+    </div>
+    """,
+    },
+    "streak_reminder": {
+        "subject": "Keep your $streak-day streak going 🔥",
+        "html": """
+    <div style="font-family:-apple-system,BlinkMacSystemFont,Segoe UI,Roboto,Arial,sans-serif;
+                line-height:1.5; color:#111;">
+      <p><b>Hi $name,</b></p>
+      <p>
+        You're on a $streak-day streak. One question today keeps it alive.
+      </p>
+""" + _SIGNATURE + """
+    </div>
+    """,
+    },
+}
+
+AUDIENCES = ("all", "streak")
+
+
+class RateLimiter:
+    """Thread-safe blocking wrapper around TokenBucket."""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self._bucket = TokenBucket(rate, burst)
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                wait = self._bucket.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class CampaignTemplate:
+    """Subject + HTML compiled once; render() only substitutes per-recipient values."""
+
+    def __init__(self, subject: str, body_html: str) -> None:
+        self._subject = Template(subject)
+        self._html = Template(body_html)
+
+    @classmethod
+    def load(cls, name: Optional[str] = None, path: Optional[str] = None) -> "CampaignTemplate":
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                spec = json.load(f)
+        elif name in TEMPLATES:
+            spec = TEMPLATES[name]
+        else:
+            raise ValueError(f"Unknown template {name!r}; choose one of {sorted(TEMPLATES)} or pass --template-file")
+        return cls(spec["subject"], spec["html"])
+
+    def render(self, values: Dict[str, Any]) -> Dict[str, str]:
+        return {
+            "subject": self._subject.safe_substitute(values),
+            "html": self._html.safe_substitute({k: html.escape(str(v)) for k, v in values.items()}),
+        }
+
+
+def _safe_int(v: Any, default: int = 0) -> int:
+    try:
+        return int(v)
+    except Exception:
+        return default
+
+
+def recipient_values(data: Dict[str, Any]) -> Dict[str, Any]:
+    name = str(data.get("displayName") or data.get("username") or "").strip() or "there"
+    return {
+        "name": name,
+        "streak": _safe_int(data.get("currentStreak"), 0),
+        "total_xp": _safe_int(data.get("totalXP"), 0),
+    }
+
+
+def wants_email(data: Dict[str, Any], audience: str) -> bool:
+    if not data.get("email") or data.get("emailOptOut"):
+        return False
+    if audience == "streak":
+        return _safe_int(data.get("currentStreak"), 0) > 0
+    return True
+
+
+def stream_user_pages(db, page_size: int, after: Optional[str] = None) -> Iterator[List[Any]]:
+    """Field-masked pages of user documents ordered by id, starting after `after`."""
+    users = db.collection("users")
+    query = users.select(RECIPIENT_FIELDS).order_by(DOC_ID).limit(page_size)
+    cursor = after
+    while True:
+        page = query.start_after({DOC_ID: users.document(cursor)}) if cursor else query
+        docs = list(page.stream())
+        if docs:
+            yield docs
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1].id
+
+
+def log_id(campaign_id: str, uid: str) -> str:
+    return f"{campaign_id}_{uid}"
+
+
+# ======= Sending =======
+
+class CampaignSender:
+    def __init__(
+        self,
+        db,
+        campaign_id: str,
+        template: CampaignTemplate,
+        transport,
+        rate_per_sec: float = RATE_PER_SEC,
+        concurrency: int = CONCURRENCY,
+        dry_run: bool = False,
+    ) -> None:
+        self.db = db
+        self.campaign_id = campaign_id
+        self.template = template
+        self.transport = transport
+        self.dry_run = dry_run
+        self._limiter = RateLimiter(rate_per_sec, burst=max(1, int(rate_per_sec) or 1))
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="campaign-send")
+
+    def _send_one(self, uid: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        message = self.template.render(recipient_values(data))
+        payload = {"from": CAMPAIGN_FROM, "to": [data["email"]], **message}
+        entry: Dict[str, Any] = {
+            "type": "campaign",
+            "campaignId": self.campaign_id,
+            "uid": uid,
+            "to": data["email"],
+            "from": CAMPAIGN_FROM,
+            "subject": message["subject"],
+            "provider": self.transport.name,
+        }
+        attempt = 0
+        while True:
+            attempt += 1
+            self._limiter.acquire()
+            try:
+                status_code, body = send_message(payload, idempotency_key=log_id(self.campaign_id, uid), transport=self.transport)
+            except EmailSendError as e:
+                if e.retryable and attempt < MAX_ATTEMPTS:
+                    time.sleep(min(30.0, 2.0 ** attempt))
+                    continue
+                return {**entry, "status": "failed", "httpStatus": e.status_code, "error": str(e)[:500], "attempts": attempt}
+            return {
+                **entry,
+                "status": "accepted",
+                "httpStatus": status_code,
+                "resendId": (body or {}).get("id"),
+                "attempts": attempt,
+            }
+
+    def _already_accepted(self, uids: List[str]) -> set:
+        if self.dry_run or not uids:
+            return set()
+        logs = self.db.collection(EMAIL_LOG_COLLECTION)
+        by_log_id = {log_id(self.campaign_id, uid): uid for uid in uids}
+        return {
+            by_log_id[snap.id]
+            for snap in self.db.get_all([logs.document(i) for i in by_log_id], field_paths=["status"])
+            if snap.exists and (snap.to_dict() or {}).get("status") == "accepted"
+        }
+
+    def failed_uids(self) -> List[str]:
+        """Recipients whose latest logged send for this campaign failed."""
+        if self.dry_run:
+            return []
+        query = (
+            self.db.collection(EMAIL_LOG_COLLECTION)
+            .where("campaignId", "==", self.campaign_id)
+            .where("status", "==", "failed")
+            .select(["uid"])
+        )
+        uids = {(snap.to_dict() or {}).get("uid") for snap in query.stream()}
+        return sorted(str(uid) for uid in uids if uid)
+
+    def retry_failed(self, audience: str, page_size: int) -> Dict[str, int]:
+        """Re-send to recipients logged as failed (re-reading their user documents)."""
+        totals = {"sent": 0, "failed": 0, "skipped": 0}
+        uids = self.failed_uids()
+        users = self.db.collection("users")
+        for i in range(0, len(uids), page_size):
+            refs = [users.document(uid) for uid in uids[i:i + page_size]]
+            docs = [snap for snap in self.db.get_all(refs, field_paths=RECIPIENT_FIELDS) if snap.exists]
+            counts = self.send_page(docs, audience)
+            for k in totals:
+                totals[k] += counts[k]
+        return totals
+
+    def send_page(self, docs: List[Any], audience: str) -> Dict[str, int]:
+        """Send to every eligible user of one page; returns {"sent", "failed", "skipped"}."""
+        targets = [(doc.id, doc.to_dict() or {}) for doc in docs]
+        eligible = [(uid, data) for uid, data in targets if wants_email(data, audience)]
+        done = self._already_accepted([uid for uid, _ in eligible])
+        todo = [(uid, data) for uid, data in eligible if uid not in done]
+
+        results = list(self._pool.map(lambda item: self._send_one(*item), todo))
+        counts = {
+            "sent": sum(1 for r in results if r["status"] == "accepted"),
+            "failed": sum(1 for r in results if r["status"] == "failed"),
+            "skipped": len(targets) - len(todo),
+        }
+        if not self.dry_run and results:
+            writer = self.db.bulk_writer()
+            logs = self.db.collection(EMAIL_LOG_COLLECTION)
+            for r in results:
+                writer.set(logs.document(log_id(self.campaign_id, r["uid"])), {**r, "createdAt": firestore.SERVER_TIMESTAMP})
+            writer.close()  # logs land before the page is checkpointed
+        return counts
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+
+def run_campaign(
+    db,
+    campaign_id: str,
+    template: CampaignTemplate,
+    template_name: str,
+    audience: str = "all",
+    transport=None,
+    page_size: int = 500,
+    limit: Optional[int] = None,
+    rate_per_sec: float = RATE_PER_SEC,
+    concurrency: int = CONCURRENCY,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    transport = transport or get_transport()
+    campaign_ref = db.collection(CAMPAIGN_COLLECTION).document(campaign_id)
+    state: Dict[str, Any] = {}
+    if not dry_run:
+        snap = campaign_ref.get()
+        state = (snap.to_dict() or {}) if snap.exists else {}
+        if state and (state.get("template") != template_name or state.get("audience") != audience):
+            raise SystemExit(
+                f"[campaign] {campaign_id} was started with template={state.get('template')} "
+                f"audience={state.get('audience')}; resume it with the same settings or use a new id"
+            )
+    completed = state.get("status") == "completed"
+    if state and not completed:
+        campaign_ref.set({"status": "running", "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    elif not state and not dry_run:
+        campaign_ref.set(
+            {
+                "template": template_name,
+                "audience": audience,
+                "status": "running",
+                "startedAt": firestore.SERVER_TIMESTAMP,
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+                "sent": 0,
+                "failed": 0,
+                "skipped": 0,
+            },
+            merge=True,
+        )
+
+    sender = CampaignSender(db, campaign_id, template, transport, rate_per_sec, concurrency, dry_run)
+    totals = {"sent": 0, "failed": 0, "skipped": 0}
+    processed = 0
+    started = time.monotonic()
+    finished = True
+    try:
+        if state:
+            # Earlier runs' failures sit before the cursor; give them another attempt first
+            retried = sender.retry_failed(audience, page_size)
+            if retried["sent"] or retried["failed"]:
+                print(
+                    f"[campaign] Retried earlier failures: {retried['sent']} sent, "
+                    f"{retried['failed']} still failing, {retried['skipped']} no longer eligible"
+                )
+                campaign_ref.set(
+                    {
+                        "sent": firestore.Increment(retried["sent"]),
+                        "failed": firestore.Increment(-retried["sent"]),
+                        "updatedAt": firestore.SERVER_TIMESTAMP,
+                    },
+                    merge=True,
+                )
+            totals["sent"] += retried["sent"]
+            totals["failed"] += retried["failed"]
+        if completed:
+            print(f"[campaign] {campaign_id} already completed ({state.get('sent', 0) + totals['sent']} sent).")
+            return totals
+
+        cursor = state.get("cursor")
+        if cursor:
+            print(f"[campaign] Resuming {campaign_id} after user {cursor} ({state.get('sent', 0)} sent so far)")
+        for docs in stream_user_pages(db, page_size, after=cursor):
+            if limit is not None and processed >= limit:
+                finished = False
+                break
+            if limit is not None:
+                docs = docs[:limit - processed]
+            counts = sender.send_page(docs, audience)
+            processed += len(docs)
+            for k in totals:
+                totals[k] += counts[k]
+            if not dry_run:
+                campaign_ref.set(
+                    {
+                        "cursor": docs[-1].id,
+                        "sent": firestore.Increment(counts["sent"]),
+                        "failed": firestore.Increment(counts["failed"]),
+                        "skipped": firestore.Increment(counts["skipped"]),
+                        "updatedAt": firestore.SERVER_TIMESTAMP,
+                    },
+                    merge=True,
+                )
+            elapsed = time.monotonic() - started
+            print(
+                f"[campaign] {processed} users scanned: {totals['sent']} sent, {totals['failed']} failed, "
+                f"{totals['skipped']} skipped ({totals['sent'] / max(elapsed, 1e-6):.1f} emails/s)"
+            )
+    finally:
+        sender.close()
+
+    if not dry_run:
+        campaign_ref.set(
+            {
+                "status": "completed" if finished else "paused",
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+                **({"completedAt": firestore.SERVER_TIMESTAMP} if finished else {}),
+            },
+            merge=True,
+        )
+    elapsed = time.monotonic() - started
+    print(
+        f"[campaign] {campaign_id} {'complete' if finished else 'paused'}: {totals['sent']} sent, "
+        f"{totals['failed']} failed, {totals['skipped']} skipped in {elapsed:.1f}s"
+        + (" (dry run)" if dry_run else "")
+    )
+    return totals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Send a bulk email campaign to users")
+    parser.add_argument("--campaign", required=True, help="Campaign id (re-use it to resume)")
+    template = parser.add_mutually_exclusive_group(required=True)
+    template.add_argument("--template", choices=sorted(TEMPLATES), help="Built-in template")
+    template.add_argument("--template-file", help='JSON file: {"subject": "...", "html": "..."} with $name/$streak/$total_xp')
+    parser.add_argument("--audience", choices=AUDIENCES, default="all", help="all, or only users with an active streak")
+    parser.add_argument("--transport", choices=["resend", "local"], help="Override EMAIL_TRANSPORT")
+    parser.add_argument("--rate", type=float, default=RATE_PER_SEC, help="Provider sends per second (0 = unlimited)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Sends in flight")
+    parser.add_argument("--page-size", type=int, default=500, help="Users read per page")
+    parser.add_argument("--limit", type=int, help="Stop (paused) after scanning this many users")
+    parser.add_argument("--dry-run", action="store_true", help="Local transport and no Firestore writes")
+    args = parser.parse_args()
+
+    if args.dry_run or args.transport == "local":
+        transport = LocalTransport()
+    elif args.transport == "resend":
+        transport = ResendTransport()
+    else:
+        transport = get_transport()
+
+    db = FirebaseManager().get_db_client()
+    run_campaign(
+        db,
+        args.campaign,
+        CampaignTemplate.load(args.template, args.template_file),
+        args.template or os.path.basename(args.template_file),
+        audience=args.audience,
+        transport=transport,
+        page_size=args.page_size,
+        limit=args.limit,
+        rate_per_sec=args.rate,
+        concurrency=args.concurrency,
+        dry_run=args.dry_run,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+# ATutor/email_queue.py
+# Persistent background queue for outbound email (welcome email).
+#
+# /welcome-email used to call the provider inline, so signup waited on Resend plus the
+# EmailSends log writes. Now the endpoint only records a job and returns:
+#
+#   EmailJobs/welcome_{uid} = {
+#       "type": "welcome", "uid": "...", "to": "...", "firstName": "...",
+#       "status": "queued" | "sent" | "failed",
+#       "attempts": 2, "nextAttemptAt": <epoch seconds>, "lastError": "...", "logId": "...",
+#   }
+#
+# • The job id is deterministic and created in a transaction that also checks
+#   users/{uid}.welcomeEmailSentAt, so repeated calls never queue a second welcome email.
+# • A job is persisted before the request is acknowledged; workers in this process pick it up
+#   at once, and a periodic poll recovers jobs left behind by a restart or another instance.
+# • Claiming a job pushes nextAttemptAt forward by a lease, so two workers never send it at the
+#   same time and a crash mid-send is retried once the lease runs out. The job id doubles as the
+#   provider idempotency key, which keeps such a retry from sending twice.
+# • Failures back off exponentially (with jitter); permanent provider rejections and jobs out of
+#   attempts are marked "failed". On success the job and users/{uid}.welcomeEmailSentAt are
+#   written together.
+#
+# Env:
+#   EMAIL_JOB_COLLECTION          default "EmailJobs"
+#   EMAIL_QUEUE_WORKERS           concurrent sends per process (default 4)
+#   EMAIL_QUEUE_POLL_SECONDS      how often due jobs are looked up in Firestore (default 30)
+#   EMAIL_MAX_ATTEMPTS            attempts before a job is marked failed (default 6)
+#   EMAIL_RETRY_BASE_SECONDS      first retry delay, doubled per attempt (default 30; capped at 1 hour)
+#   EMAIL_SEND_LEASE_SECONDS      how long a claimed job is reserved for one send (default 120)
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from firebase_admin import firestore
+
+from email_service import EmailSendError, send_welcome_email
+
+JOB_COLLECTION = os.getenv("EMAIL_JOB_COLLECTION", "EmailJobs")
+WORKERS = int(os.getenv("EMAIL_QUEUE_WORKERS", "4"))
+POLL_SECONDS = float(os.getenv("EMAIL_QUEUE_POLL_SECONDS", "30"))
+MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "6"))
+RETRY_BASE_SECONDS = float(os.getenv("EMAIL_RETRY_BASE_SECONDS", "30"))
+RETRY_MAX_SECONDS = 3600.0
+SEND_LEASE_SECONDS = float(os.getenv("EMAIL_SEND_LEASE_SECONDS", "120"))
+
+# Due jobs fetched per poll
+_POLL_LIMIT = 50
+
+
+def welcome_job_id(uid: str) -> str:
+    return f"welcome_{uid}"
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with full jitter on the upper half: base * 2^(n-1), capped."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# ======= Firestore job records (blocking; run in a worker thread) =======
+
+def enqueue_welcome(db, uid: str, email: str, first_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Persist a welcome-email job unless the email was already sent or is already queued.
+    Returns {"queued": bool, "reason": "queued" | "already_sent" | "already_queued", "jobId": ...}.
+    """
+    user_ref = db.collection("users").document(uid)
+    job_id = welcome_job_id(uid)
+    job_ref = db.collection(JOB_COLLECTION).document(job_id)
+
+    @firestore.transactional
+    def run(txn) -> Dict[str, Any]:
+        user = user_ref.get(field_paths=["welcomeEmailSentAt"], transaction=txn)
+        if user.exists and (user.to_dict() or {}).get("welcomeEmailSentAt"):
+            return {"queued": False, "reason": "already_sent", "jobId": job_id}
+        job = job_ref.get(transaction=txn)
+        if job.exists and (job.to_dict() or {}).get("status") in ("queued", "sent"):
+            return {"queued": False, "reason": "already_queued", "jobId": job_id}
+        # New job, or a failed one the user asked for again: start over
+        txn.set(
+            job_ref,
+            {
+                "type": "welcome",
+                "uid": uid,
+                "to": email,
+                "firstName": first_name,
+                "status": "queued",
+                "attempts": 0,
+                "nextAttemptAt": time.time(),
+                "lastError": None,
+                "createdAt": firestore.SERVER_TIMESTAMP,
+            },
+        )
+        return {"queued": True, "reason": "queued", "jobId": job_id}
+
+    return run(db.transaction())
+
+
+def claim_job(db, job_id: str, owner: str) -> Optional[Dict[str, Any]]:
+    """Reserve a due job for one send attempt; None if it is not due or not queued."""
+    job_ref = db.collection(JOB_COLLECTION).document(job_id)
+
+    @firestore.transactional
+    def run(txn) -> Optional[Dict[str, Any]]:
+        snap = job_ref.get(transaction=txn)
+        if not snap.exists:
+            return None
+        job = snap.to_dict() or {}
+        if job.get("status") != "queued" or float(job.get("nextAttemptAt") or 0) > time.time():
+            return None
+        job["attempts"] = int(job.get("attempts") or 0) + 1
+        txn.update(
+            job_ref,
+            {"attempts": job["attempts"], "nextAttemptAt": time.time() + SEND_LEASE_SECONDS, "claimedBy": owner},
+        )
+        return job
+
+    return run(db.transaction())
+
+
+def due_job_ids(db, limit: int = _POLL_LIMIT) -> List[str]:
+    docs = (
+        db.collection(JOB_COLLECTION)
+        .where("status", "==", "queued")
+        .where("nextAttemptAt", "<=", time.time())
+        .order_by("nextAttemptAt")
+        .limit(limit)
+        .select([])
+        .stream()
+    )
+    return [doc.id for doc in docs]
+
+
+def deliver(db, job_id: str, job: Dict[str, Any]) -> Dict[str, Any]:
+    """Send one claimed job and record the outcome. Returns the job's new status fields."""
+    job_ref = db.collection(JOB_COLLECTION).document(job_id)
+    try:
+        log_id = send_welcome_email(
+            to_email=job["to"],
+            first_name=job.get("firstName"),
+            uid=job.get("uid"),
+            idempotency_key=job_id,
+        )
+    except Exception as e:
+        retryable = not isinstance(e, EmailSendError) or e.retryable
+        attempts = int(job.get("attempts") or 1)
+        if retryable and attempts < MAX_ATTEMPTS:
+            update = {"status": "queued", "nextAttemptAt": time.time() + retry_delay(attempts), "lastError": str(e)[:500]}
+        else:
+            update = {"status": "failed", "failedAt": firestore.SERVER_TIMESTAMP, "lastError": str(e)[:500]}
+        job_ref.update(update)
+        return update
+
+    # Mark as sent (idempotency) together with the job
+    batch = db.batch()
+    batch.update(job_ref, {"status": "sent", "sentAt": firestore.SERVER_TIMESTAMP, "logId": log_id, "lastError": None})
+    if job.get("uid"):
+        batch.set(
+            db.collection("users").document(job["uid"]),
+            {"email": job["to"], "welcomeEmailSentAt": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+    batch.commit()
+    return {"status": "sent", "logId": log_id}
+
+
+# ======= In-process workers =======
+
+class EmailQueue:
+    def __init__(self, get_db: Callable[[], Any], workers: int = WORKERS, poll_seconds: float = POLL_SECONDS) -> None:
+        self._get_db = get_db
+        self._workers = max(1, workers)
+        self._poll_seconds = poll_seconds
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._queued: Set[str] = set()
+        self._tasks: List["asyncio.Task[None]"] = []
+        self._owner = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+        self._tasks.append(asyncio.create_task(self._poller()))
+
+    async def stop(self) -> None:
+        # Jobs are persisted; anything in flight is picked up again after its lease expires
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job_id: str) -> None:
+        """Hand a persisted job to the local workers (no-op if it is already waiting)."""
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    async def enqueue_welcome(self, uid: str, email: str, first_name: Optional[str] = None) -> Dict[str, Any]:
+        result = await asyncio.to_thread(enqueue_welcome, self._get_db(), uid, email, first_name)
+        if result["queued"]:
+            self.submit(result["jobId"])
+        return result
+
+    async def _poller(self) -> None:
+        while True:
+            try:
+                for job_id in await asyncio.to_thread(due_job_ids, self._get_db()):
+                    self.submit(job_id)
+            except Exception as e:
+                logging.warning(f"Email queue poll failed: {e}")
+            await asyncio.sleep(self._poll_seconds)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self._process(job_id)
+            except Exception as e:
+                logging.warning(f"Email job {job_id} could not be processed: {e}")
+
+    async def _process(self, job_id: str) -> None:
+        db = self._get_db()
+        job = await asyncio.to_thread(claim_job, db, job_id, self._owner)
+        if job is None:
+            return
+        outcome = await asyncio.to_thread(deliver, db, job_id, job)
+        if outcome["status"] == "sent":
+            self.sent += 1
+            return
+        if outcome["status"] == "failed":
+            self.failed += 1
+            logging.error(f"Email job {job_id} failed permanently: {outcome.get('lastError')}")
+            return
+        self.retried += 1
+        delay = max(0.0, outcome["nextAttemptAt"] - time.time())
+        logging.warning(f"Email job {job_id} failed ({outcome.get('lastError')}); retrying in {delay:.0f}s")
+        # Retry from this process when due; the poller covers it if we restart in between
+        asyncio.get_running_loop().call_later(delay, self.submit, job_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "waiting": self._queue.qsize(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
@@ -1,7 +1,18 @@
 # ATutor/email_service.py
+# Outbound email (welcome email) with an audit log in Firestore.
+#
+# Sends go through a transport:
+#   EMAIL_TRANSPORT=resend (default)  → Resend HTTP API over a pooled requests.Session
+#   EMAIL_TRANSPORT=local             → nothing leaves the machine; messages are kept in memory
+#                                       (and written to EMAIL_LOCAL_OUTBOX_DIR as JSON if set);
+#                                       EMAIL_LOCAL_LATENCY_MS simulates provider latency for benchmarks
+import json
 import os
+import threading
+import time
 import requests
-from typing import Optional, Dict, Any
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, Any, List, Tuple
 
 import firebase_admin
 from firebase_admin import firestore
@@ -11,6 +22,11 @@ from utils import FirebaseManager  # your existing initializer
 RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 RESEND_SEND_URL = "https://api.resend.com/emails"
 
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT", "resend").strip().lower()
+EMAIL_LOCAL_OUTBOX_DIR = os.getenv("EMAIL_LOCAL_OUTBOX_DIR")
+EMAIL_HTTP_POOL_SIZE = int(os.getenv("EMAIL_HTTP_POOL_SIZE", "10"))
+EMAIL_LOCAL_LATENCY_MS = int(os.getenv("EMAIL_LOCAL_LATENCY_MS", "0"))
+
 # Default sender. You chose benj@almamath.com
 WELCOME_FROM = os.getenv("WELCOME_FROM_EMAIL", "Ben @ Alma <benj@almamath.com>")
 
@@ -30,19 +46,127 @@ def _db():
     return firestore.client()
 
 
+class EmailSendError(RuntimeError):
+    """A send that failed; `retryable` is False when resending the same message cannot help."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retryable: bool = True) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+
+
+# ======= Transports =======
+
+class ResendTransport:
+    name = "resend"
+
+    def __init__(self, api_key: Optional[str] = RESEND_API_KEY, url: str = RESEND_SEND_URL) -> None:
+        self._api_key = api_key
+        self._url = url
+        # One keep-alive pool for every send instead of a new TLS connection per email
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=EMAIL_HTTP_POOL_SIZE))
+
+    def send(self, payload: Dict[str, Any], idempotency_key: Optional[str] = None) -> Tuple[int, Any]:
+        if not self._api_key:
+            raise RuntimeError("RESEND_API_KEY is not set in environment variables.")
+        headers = {
+            "Authorization": f"Bearer {self._api_key}",
+            "Content-Type": "application/json",
+        }
+        if idempotency_key:
+            # Resend drops a repeat of the same key, so a retried job cannot send twice
+            headers["Idempotency-Key"] = idempotency_key
+        r = self._session.post(self._url, headers=headers, json=payload, timeout=20)
+        try:
+            return r.status_code, r.json()
+        except Exception:
+            return r.status_code, r.text
+
+
+class LocalTransport:
+    """Stand-in for tests and local runs: records messages instead of sending them."""
+
+    name = "local"
+
+    def __init__(
+        self,
+        outbox_dir: Optional[str] = EMAIL_LOCAL_OUTBOX_DIR,
+        latency_seconds: float = EMAIL_LOCAL_LATENCY_MS / 1000.0,
+    ) -> None:
+        self._outbox_dir = outbox_dir
+        self._latency = latency_seconds
+        self._lock = threading.Lock()
+        self._keys: Dict[str, str] = {}
+        self.sent: List[Dict[str, Any]] = []
+
+    def send(self, payload: Dict[str, Any], idempotency_key: Optional[str] = None) -> Tuple[int, Any]:
+        if self._latency > 0:
+            time.sleep(self._latency)
+        with self._lock:
+            if idempotency_key and idempotency_key in self._keys:
+                return 200, {"id": self._keys[idempotency_key]}
+            message_id = f"local-{len(self.sent) + 1}"
+            self.sent.append({"id": message_id, "idempotencyKey": idempotency_key, **payload})
+            if idempotency_key:
+                self._keys[idempotency_key] = message_id
+        if self._outbox_dir:
+            os.makedirs(self._outbox_dir, exist_ok=True)
+            with open(os.path.join(self._outbox_dir, f"{message_id}.json"), "w", encoding="utf-8") as f:
+                json.dump(self.sent[-1], f, ensure_ascii=False, indent=2)
+        return 200, {"id": message_id}
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """The process-wide transport selected by EMAIL_TRANSPORT."""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = LocalTransport() if EMAIL_TRANSPORT == "local" else ResendTransport()
+        return _transport
+
+
+def send_message(
+    payload: Dict[str, Any],
+    idempotency_key: Optional[str] = None,
+    transport=None,
+) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """
+    Send one prepared message (from/to/subject/html) without writing a log entry — callers that
+    send in bulk log the outcome themselves. Returns (http_status, provider_json); raises EmailSendError.
+    """
+    transport = transport or get_transport()
+    try:
+        status_code, body = transport.send(payload, idempotency_key=idempotency_key)
+    except Exception as e:
+        raise EmailSendError(f"{transport.name} request failed: {e!r}") from e
+    if status_code >= 300:
+        raise EmailSendError(
+            f"{transport.name} send failed ({status_code}): {body}",
+            status_code=status_code,
+            retryable=status_code == 429 or status_code >= 500,
+        )
+    return status_code, body if isinstance(body, dict) else None
+
+
 def send_welcome_email(
     to_email: str,
     first_name: Optional[str] = None,
     uid: Optional[str] = None,
+    idempotency_key: Optional[str] = None,
 ) -> str:
     """
-    Sends the welcome email via Resend and logs attempts/results to Firestore.
+    Sends the welcome email via the configured transport and logs attempts/results to Firestore.
+    Raises EmailSendError when the send fails.
 
     Returns:
         log_id (Firestore doc id) so callers can correlate with user events.
     """
-    if not RESEND_API_KEY:
-        raise RuntimeError("RESEND_API_KEY is not set in environment variables.")
+    transport = get_transport()
 
     html = """
     <div style="font-family:-apple-system,BlinkMacSystemFont,Segoe UI,Roboto,Arial,sans-serif;
@@ -100,17 +224,9 @@ def send_welcome_email(
         }
     )
 
-    # 2) Send via Resend
+    # 2) Send via the transport
     try:
-        r = requests.post(
-            RESEND_SEND_URL,
-            headers={
-                "Authorization": f"Bearer {RESEND_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=20,
-        )
+        status_code, body = transport.send(payload, idempotency_key=idempotency_key)
     except Exception as e:
         doc.update(
             {
@@ -119,35 +235,36 @@ def send_welcome_email(
                 "error": f"request_exception: {repr(e)}",
             }
         )
-        raise
+        raise EmailSendError(f"{transport.name} request failed: {e!r}") from e
 
     # 3) Update log with provider response
-    if r.status_code >= 300:
+    if status_code >= 300:
         doc.update(
             {
                 "status": "failed",
                 "failedAt": firestore.SERVER_TIMESTAMP,
-                "provider": "resend",
-                "httpStatus": r.status_code,
-                "providerBody": r.text,
+                "provider": transport.name,
+                "httpStatus": status_code,
+                "providerBody": body if isinstance(body, str) else json.dumps(body, default=str),
             }
         )
-        raise RuntimeError(f"Resend send failed ({r.status_code}): {r.text}")
+        # 4xx (bad address, rejected payload, ...) will fail the same way again; 429/5xx may not
+        raise EmailSendError(
+            f"{transport.name} send failed ({status_code}): {body}",
+            status_code=status_code,
+            retryable=status_code == 429 or status_code >= 500,
+        )
 
     # Resend typically returns JSON with an "id"
-    resend_id = None
-    try:
-        data = r.json()
-        resend_id = data.get("id")
-    except Exception:
-        data = None
+    data = body if isinstance(body, dict) else None
+    resend_id = data.get("id") if data else None
 
     doc.update(
         {
             "status": "accepted",
             "acceptedAt": firestore.SERVER_TIMESTAMP,
-            "provider": "resend",
-            "httpStatus": r.status_code,
+            "provider": transport.name,
+            "httpStatus": status_code,
             "resendId": resend_id,
             "providerJson": data,
         }
@@ -0,0 +1,122 @@
+# ATutor/image_preprocess.py
+# Normalise student photos before they are sent to OCR.
+#
+# Phone photos arrive as full-resolution base64 JPEGs (often several MB). Mathpix does not need
+# that much: we fix EXIF orientation, trim the blank paper margins, downsize to the resolution OCR
+# actually uses, and re-encode as a compact greyscale JPEG. The original is kept whenever the
+# processed version would not be smaller, or if anything goes wrong.
+#
+# Env:
+#   OCR_IMAGE_PREPROCESS   "on" (default) or "off" (pass-through, for A/B comparison)
+#   OCR_MAX_DIMENSION      longest edge in pixels after resizing (default 1600)
+#   OCR_JPEG_QUALITY       re-encode quality 1..95 (default 80)
+
+import base64
+import binascii
+import io
+import logging
+import os
+from typing import Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it we simply pass images through
+    Image = None  # type: ignore[assignment]
+    ImageOps = None  # type: ignore[assignment]
+
+PREPROCESS_MODE = os.getenv("OCR_IMAGE_PREPROCESS", "on").strip().lower()
+MAX_DIMENSION = int(os.getenv("OCR_MAX_DIMENSION", "1600"))
+JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", "80"))
+
+# A pixel counts as "ink" if it is this much darker than the estimated paper brightness
+_INK_CONTRAST = 60
+# Breathing room kept around the trimmed content (fraction of the shorter side)
+_TRIM_PADDING = 0.02
+
+
+def _strip_data_url(image_b64: str) -> str:
+    """Accept both raw base64 and 'data:image/...;base64,...' strings."""
+    if image_b64.startswith("data:") and "," in image_b64:
+        return image_b64.split(",", 1)[1]
+    return image_b64
+
+
+def _paper_brightness(gray) -> int:
+    """Estimate background brightness from the median of the border pixels."""
+    w, h = gray.size
+    border = []
+    for box in ((0, 0, w, 1), (0, h - 1, w, h), (0, 0, 1, h), (w - 1, 0, w, h)):
+        border.extend(gray.crop(box).getdata())
+    if not border:
+        return 255
+    border.sort()
+    return border[len(border) // 2]
+
+
+def _content_bbox(gray) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box of the written content (pixels clearly darker than the paper), padded."""
+    cutoff = _paper_brightness(gray) - _INK_CONTRAST
+    if cutoff <= 0:
+        return None  # dark/low-contrast photo; don't risk cropping away work
+    mask = gray.point(lambda p: 255 if p < cutoff else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return None
+    w, h = gray.size
+    pad = int(min(w, h) * _TRIM_PADDING)
+    left, top, right, bottom = bbox
+    return (max(0, left - pad), max(0, top - pad), min(w, right + pad), min(h, bottom + pad))
+
+
+def _normalize(raw: bytes) -> bytes:
+    img = Image.open(io.BytesIO(raw))
+    # For JPEGs, let the decoder downscale by powers of two while decoding (much faster than resizing later).
+    # Square target so the draft is big enough whichever way EXIF rotates the image.
+    img.draft("L", (MAX_DIMENSION, MAX_DIMENSION))
+    img = ImageOps.exif_transpose(img)
+    gray = img.convert("L")
+
+    bbox = _content_bbox(gray)
+    if bbox and bbox != (0, 0) + gray.size:
+        gray = gray.crop(bbox)
+
+    gray.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
+
+    out = io.BytesIO()
+    gray.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def prepare_image_for_ocr(image_b64: str, mode: Optional[str] = None) -> str:
+    """
+    Return base64 JPEG data (no data: prefix) ready for OCR.
+    Falls back to the original data when preprocessing is off, Pillow is missing,
+    the image cannot be decoded, or the result would not be smaller.
+    """
+    mode = (mode or PREPROCESS_MODE).lower()
+    data = _strip_data_url(image_b64)
+    if mode == "off" or Image is None:
+        return data
+
+    try:
+        raw = base64.b64decode(data, validate=False)
+    except (binascii.Error, ValueError) as e:
+        logging.warning(f"OCR preprocess: could not decode base64, passing through: {e}")
+        return data
+
+    try:
+        processed = _normalize(raw)
+    except Exception as e:
+        logging.warning(f"OCR preprocess: image normalisation failed, passing through: {e}")
+        return data
+
+    if len(processed) >= len(raw):
+        logging.info(f"OCR preprocess: kept original ({len(raw)} bytes; processed was {len(processed)} bytes)")
+        return data
+
+    saved = len(raw) - len(processed)
+    logging.info(
+        f"OCR preprocess: {len(raw)} -> {len(processed)} bytes "
+        f"(saved {saved} bytes, {100.0 * saved / max(1, len(raw)):.0f}%)"
+    )
+    return base64.b64encode(processed).decode("ascii")
@@ -3,10 +3,28 @@
 # This module intentionally contains NO FastAPI routing — routes live in leaderboard_routes.py.
 # It expects a FirebaseManager instance to be passed in, and a TIERS list/GROUP_SIZE from constants.
 
+import base64
+import json
 import logging
-from typing import Any, Dict, List
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from leaderboard_snapshots import get_group_snapshot
+from observability import stage
+
+DOC_ID = FieldPath.document_id()
+
+# Only the fields a leaderboard row needs are read from each user document
+LEADERBOARD_FIELDS = ["username", "totalXP", "tierID", "userID"]
+
+# Friend documents are fetched with multi-get (get_all) calls of this many refs, run concurrently
+FRIENDS_BATCH_SIZE = int(os.getenv("FRIENDS_BATCH_SIZE", "100"))
+_FRIENDS_MAX_PARALLEL = int(os.getenv("FRIENDS_MAX_PARALLEL_BATCHES", "8"))
+_friends_pool = ThreadPoolExecutor(max_workers=_FRIENDS_MAX_PARALLEL, thread_name_prefix="friends-get")
 
 
 def _safe_str(v: Any, default: str = "") -> str:
@@ -20,22 +38,148 @@ def _safe_int(v: Any, default: int = 0) -> int:
         return default
 
 
+# id(tiers) -> (tiers, {id: name}, min_id, max_id); built once per TIERS list
+_tier_lookups: Dict[int, Tuple[List[Dict[str, Any]], Dict[Any, Any], int, int]] = {}
+
+
+def _tier_lookup(tiers: List[Dict[str, Any]]) -> Tuple[Dict[Any, Any], int, int]:
+    entry = _tier_lookups.get(id(tiers))
+    if entry is None or entry[0] is not tiers:
+        id_to_name = {t.get("id"): t.get("name") for t in tiers}
+        ids = [k for k in id_to_name if isinstance(k, int)]
+        entry = (tiers, id_to_name, min(ids, default=0), max(ids, default=0))
+        _tier_lookups[id(tiers)] = entry
+    return entry[1], entry[2], entry[3]
+
+
 def _tier_name_for(tiers: List[Dict[str, Any]], raw_tier_id: Any) -> str:
     """Map a raw tierID to a safe tier name using the provided TIERS list."""
     tier_id = _safe_int(raw_tier_id, 0)
-    # Build lookup once (small list; cost negligible)
-    id_to_name = {t.get("id"): t.get("name") for t in tiers}
+    id_to_name, min_id, max_id = _tier_lookup(tiers)
     if tier_id in id_to_name:
         return id_to_name[tier_id]
     if not id_to_name:
         return "Broccoli"  # ultra-safe fallback
     # Clamp to nearest valid by id range
-    min_id = min(id_to_name.keys())
-    max_id = max(id_to_name.keys())
     clamped = min_id if tier_id < min_id else max_id
     return id_to_name.get(clamped, "Broccoli")
 
 
+def _chunks(items: List[str], size: int) -> Iterable[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def fetch_user_rows(db, user_ids: Iterable[str], field_paths: List[str] = LEADERBOARD_FIELDS) -> Dict[str, Dict[str, Any]]:
+    """
+    Read many user documents with batched multi-gets (field-masked), chunks in parallel.
+    Returns {uid: data} for documents that exist.
+    """
+    ids = sorted({uid for uid in user_ids if uid})
+    if not ids:
+        return {}
+    users = db.collection("users")
+
+    def fetch(chunk: List[str]) -> List[Any]:
+        return list(db.get_all([users.document(uid) for uid in chunk], field_paths=field_paths))
+
+    chunks = list(_chunks(ids, max(1, FRIENDS_BATCH_SIZE)))
+    if len(chunks) == 1:
+        snapshots = fetch(chunks[0])
+    else:
+        snapshots = [snap for batch in _friends_pool.map(fetch, chunks) for snap in batch]
+
+    return {snap.id: (snap.to_dict() or {}) for snap in snapshots if snap.exists}
+
+
+def read_user_placement(db, user_id: str) -> Optional[Dict[str, Any]]:
+    """The caller's tierID, groupID and friends list (one field-masked read), or None if no profile."""
+    with stage("leaderboard_self"):
+        doc = db.collection("users").document(user_id).get(field_paths=["tierID", "groupID", "friends"])
+    if not doc.exists:
+        return None
+    me = doc.to_dict() or {}
+    return {
+        "tierID": _safe_int(me.get("tierID"), 0),
+        "groupID": _safe_int(me.get("groupID"), 0),
+        "friends": sorted({_safe_str(fid) for fid in (me.get("friends") or []) if _safe_str(fid)}),
+    }
+
+
+def snapshot_has_member(snapshot: Dict[str, Any], user_id: str) -> bool:
+    return any(_safe_str(m.get("userID")) == user_id for m in snapshot.get("members") or [])
+
+
+def group_board_items(snapshot: Dict[str, Any], tier_name: str, user_id: str) -> List[Dict[str, Any]]:
+    """Ranked rows for a group snapshot, from the caller's point of view."""
+    leaderboard: List[Dict[str, Any]] = []
+    for i, row in enumerate(snapshot.get("members") or []):
+        leaderboard.append(
+            {
+                "rank": i + 1,
+                "username": _safe_str(row.get("username"), "Player"),
+                "totalXP": _safe_int(row.get("totalXP"), 0),
+                "tierName": tier_name,  # all in the same tier/group by construction
+                "isCurrentUser": _safe_str(row.get("userID")) == _safe_str(user_id),
+            }
+        )
+    return leaderboard
+
+
+def friend_board_items(rows: Dict[str, Dict[str, Any]], TIERS, user_id: str) -> List[Dict[str, Any]]:
+    """Ranked rows for the caller's friends (plus self), from fetch_user_rows output."""
+    leaderboard: List[Dict[str, Any]] = []
+    for fid, f in rows.items():
+        tier_name = _tier_name_for(TIERS, f.get("tierID"))
+        leaderboard.append(
+            {
+                "username": _safe_str(f.get("username"), "Player"),
+                "totalXP": _safe_int(f.get("totalXP"), 0),
+                "tierName": tier_name,
+                "isCurrentUser": _safe_str(fid) == _safe_str(user_id),
+            }
+        )
+
+    # Sort by XP desc
+    leaderboard.sort(key=lambda x: x["totalXP"], reverse=True)
+
+    # Assign ranks
+    for i, item in enumerate(leaderboard):
+        item["rank"] = i + 1
+
+    return leaderboard
+
+
+def tiered_leaderboard_snapshot(request, TIERS, GROUP_SIZE, firebase_manager, known_version=None):
+    """
+    Leaderboard for the caller's current tier and group, served from the group's
+    materialised snapshot document (see leaderboard_snapshots.py).
+
+    Returns {"items": [...], "version": int}, or {"unchanged": True, "version": int} when
+    `known_version` matches the stored snapshot. Item shape is as in tiered_leaderboard_desc.
+    On error, returns {"status": "error", "message": "..."}.
+    """
+    try:
+        db = firebase_manager.get_db_client()
+        me = read_user_placement(db, request.user_id)
+        if me is None:
+            return {"items": [], "version": 0}
+
+        tier_id = me["tierID"]
+        group_id = me["groupID"]
+        tier_name = _tier_name_for(TIERS, tier_id)
+
+        snapshot = get_group_snapshot(db, tier_id, group_id, user_id=_safe_str(request.user_id))
+        version = _safe_int(snapshot.get("version"), 0)
+        if known_version is not None and _safe_int(known_version, -1) == version:
+            return {"unchanged": True, "version": version}
+
+        return {"items": group_board_items(snapshot, tier_name, request.user_id), "version": version}
+    except Exception as e:
+        logging.error(f"Leaderboard (tiered) query failed: {e}")
+        return {"status": "error", "message": "Database operation failed"}
+
+
 def tiered_leaderboard_desc(request, TIERS, GROUP_SIZE, firebase_manager):
     """
     Get leaderboard for the caller's current tier and group.
@@ -50,43 +194,10 @@ def tiered_leaderboard_desc(request, TIERS, GROUP_SIZE, firebase_manager):
       }
     On error, returns {"status": "error", "message": "..."}.
     """
-    try:
-        db = firebase_manager.get_db_client()
-        user_doc = db.collection("users").document(request.user_id).get()
-        if not user_doc.exists:
-            return []
-
-        me = user_doc.to_dict() or {}
-        tier_id = _safe_int(me.get("tierID"), 0)
-        group_id = _safe_int(me.get("groupID"), 0)
-        tier_name = _tier_name_for(TIERS, tier_id)
-
-        # Fetch peers in same tier+group, sorted by XP desc
-        users = (
-            db.collection("users")
-            .where("tierID", "==", tier_id)
-            .where("groupID", "==", group_id)
-            .order_by("totalXP", direction=firestore.Query.DESCENDING)
-            .get()
-        )
-
-        leaderboard: List[Dict[str, Any]] = []
-        for i, doc in enumerate(users):
-            row = doc.to_dict() or {}
-            leaderboard.append(
-                {
-                    "rank": i + 1,
-                    "username": _safe_str(row.get("username"), "Player"),
-                    "totalXP": _safe_int(row.get("totalXP"), 0),
-                    "tierName": tier_name,  # all in the same tier/group by query
-                    "isCurrentUser": _safe_str(row.get("userID")) == _safe_str(request.user_id),
-                }
-            )
-
-        return leaderboard
-    except Exception as e:
-        logging.error(f"Leaderboard (tiered) query failed: {e}")
-        return {"status": "error", "message": "Database operation failed"}
+    result = tiered_leaderboard_snapshot(request, TIERS, GROUP_SIZE, firebase_manager)
+    if result.get("status") == "error":
+        return result
+    return result["items"]
 
 
 def get_friend_leaderboard_desc(request, TIERS, GROUP_SIZE, firebase_manager):
@@ -105,41 +216,176 @@ def get_friend_leaderboard_desc(request, TIERS, GROUP_SIZE, firebase_manager):
     """
     try:
         db = firebase_manager.get_db_client()
-        me_doc = db.collection("users").document(request.user_id).get()
-        if not me_doc.exists:
+        me = read_user_placement(db, request.user_id)
+        if me is None:
             return []
 
-        me = me_doc.to_dict() or {}
-        # Start with friends from the doc, then add self, and deduplicate
-        friend_ids = set((me.get("friends") or []))
+        # Friends from the doc plus self, deduplicated
+        friend_ids = set(me["friends"])
         friend_ids.add(_safe_str(request.user_id))
 
-        leaderboard: List[Dict[str, Any]] = []
-        for fid in friend_ids:
-            if not fid:
-                continue
-            fdoc = db.collection("users").document(fid).get()
-            if not fdoc.exists:
-                continue
-            f = fdoc.to_dict() or {}
-            tier_name = _tier_name_for(TIERS, f.get("tierID"))
-            leaderboard.append(
-                {
-                    "username": _safe_str(f.get("username"), "Player"),
-                    "totalXP": _safe_int(f.get("totalXP"), 0),
-                    "tierName": tier_name,
-                    "isCurrentUser": _safe_str(fid) == _safe_str(request.user_id),
-                }
-            )
-
-        # Sort by XP desc
-        leaderboard.sort(key=lambda x: x["totalXP"], reverse=True)
+        # One multi-get per FRIENDS_BATCH_SIZE friends instead of one round trip each
+        with stage("friends_fetch"):
+            rows = fetch_user_rows(db, friend_ids)
 
-        # Assign ranks
-        for i, item in enumerate(leaderboard):
-            item["rank"] = i + 1
-
-        return leaderboard
+        return friend_board_items(rows, TIERS, request.user_id)
     except Exception as e:
         logging.error(f"Leaderboard (friends) query failed: {e}")
         return {"status": "error", "message": "Database operation failed"}
+
+
+# ======= Windowed leaderboards (top-K pages + around-me) =======
+
+MAX_WINDOW_LIMIT = 100
+MAX_AROUND = 25
+
+
+def _encode_cursor(payload: Dict[str, Any]) -> str:
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _is_int(v: Any) -> bool:
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def decode_cursor(cursor: Optional[str], scope: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Opaque page cursor -> dict; raises ValueError on anything malformed, or (when `scope` is
+    given) on a cursor from another scope: tier cursors carry xp/id/rank, group and friends
+    cursors an offset.
+    """
+    if not cursor:
+        return {}
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(data, dict):
+        raise ValueError("Invalid cursor")
+    if scope == "tier":
+        doc_id = data.get("id")
+        if not (_is_int(data.get("xp")) and _is_int(data.get("rank")) and data["rank"] >= 0
+                and isinstance(doc_id, str) and doc_id and "/" not in doc_id):
+            raise ValueError("Invalid cursor for scope=tier")
+    elif scope is not None:
+        if not (_is_int(data.get("offset")) and data["offset"] >= 0):
+            raise ValueError(f"Invalid cursor for scope={scope}")
+    return data
+
+
+def window_items(
+    items: List[Dict[str, Any]],
+    limit: int,
+    cursor: Optional[str] = None,
+    around: int = 0,
+) -> Dict[str, Any]:
+    """
+    Window an already-ranked, in-memory board (group snapshot or friends):
+    one page of `limit` rows starting at the cursor, plus `around` rows either side of the caller.
+    """
+    offset = max(0, _safe_int(decode_cursor(cursor).get("offset"), 0))
+    page = items[offset:offset + limit]
+    next_offset = offset + len(page)
+
+    me = next((item for item in items if item.get("isCurrentUser")), None)
+    around_rows: List[Dict[str, Any]] = []
+    if me is not None and around > 0:
+        idx = me["rank"] - 1
+        around_rows = items[max(0, idx - around):idx + around + 1]
+
+    return {
+        "items": page,
+        "around": around_rows,
+        "me": {"rank": me["rank"], "totalXP": me["totalXP"]} if me else None,
+        "total": len(items),
+        "nextCursor": _encode_cursor({"offset": next_offset}) if next_offset < len(items) else None,
+    }
+
+
+def _tier_row(doc, rank: int, tier_name: str, user_id: str) -> Dict[str, Any]:
+    row = doc.to_dict() or {}
+    return {
+        "rank": rank,
+        "username": _safe_str(row.get("username"), "Player"),
+        "totalXP": _safe_int(row.get("totalXP"), 0),
+        "tierName": tier_name,
+        "isCurrentUser": doc.id == _safe_str(user_id),
+    }
+
+
+def _count(query) -> int:
+    result = query.count().get()
+    return _safe_int(result[0][0].value, 0)
+
+
+def tier_window(
+    db,
+    TIERS,
+    user_id: str,
+    tier_id: int,
+    limit: int,
+    cursor: Optional[str] = None,
+    around: int = 0,
+) -> Dict[str, Any]:
+    """
+    Windowed leaderboard over a whole tier, straight from Firestore:
+      • page:      order_by(totalXP desc, doc id).start_after(cursor).limit(limit), field-masked
+      • me.rank:   count(totalXP > mine) + count(totalXP == mine, doc id < mine) + 1
+      • total:     count(tierID == tier)
+      • around-me: `around` rows either side of the caller, via two limited queries
+    Read cost is bounded by limit + 2*around (+ aggregation units), independent of tier size.
+    Needs the composite index users(tierID ASC, totalXP DESC) from firestore.indexes.json.
+    """
+    users = db.collection("users")
+    tier_name = _tier_name_for(TIERS, tier_id)
+    base = users.where("tierID", "==", int(tier_id))
+    ranked = base.order_by("totalXP", direction=firestore.Query.DESCENDING).order_by(DOC_ID)
+
+    with stage("leaderboard_count"):
+        total = _count(base)
+
+    state = decode_cursor(cursor, "tier")
+    page_query = ranked.select(LEADERBOARD_FIELDS).limit(limit)
+    start_rank = state.get("rank", 0)
+    if state:
+        page_query = page_query.start_after({"totalXP": state["xp"], DOC_ID: users.document(state["id"])})
+
+    with stage("leaderboard_page"):
+        page_docs = list(page_query.stream())
+    page = [_tier_row(doc, start_rank + i + 1, tier_name, user_id) for i, doc in enumerate(page_docs)]
+    next_cursor = None
+    if page_docs and start_rank + len(page_docs) < total:
+        last = page_docs[-1]
+        next_cursor = _encode_cursor(
+            {"xp": _safe_int((last.to_dict() or {}).get("totalXP"), 0), "id": last.id, "rank": start_rank + len(page_docs)}
+        )
+
+    me_doc = users.document(user_id).get(field_paths=LEADERBOARD_FIELDS)
+    me: Optional[Dict[str, Any]] = None
+    around_rows: List[Dict[str, Any]] = []
+    if me_doc.exists and _safe_int((me_doc.to_dict() or {}).get("tierID"), 0) == int(tier_id):
+        my_xp = _safe_int((me_doc.to_dict() or {}).get("totalXP"), 0)
+        me_ref = users.document(user_id)
+        with stage("leaderboard_count"):
+            ahead = _count(base.where("totalXP", ">", my_xp)) + _count(
+                base.where("totalXP", "==", my_xp).where(DOC_ID, "<", me_ref)
+            )
+        my_rank = ahead + 1
+        me = {"rank": my_rank, "totalXP": my_xp}
+
+        if around > 0:
+            position = {"totalXP": my_xp, DOC_ID: me_ref}
+            with stage("leaderboard_around"):
+                above = list(
+                    base.order_by("totalXP").order_by(DOC_ID, direction=firestore.Query.DESCENDING)
+                    .select(LEADERBOARD_FIELDS).start_after(position).limit(around).stream()
+                )
+                below = list(ranked.select(LEADERBOARD_FIELDS).start_after(position).limit(around).stream())
+            above.reverse()
+            around_rows = [_tier_row(doc, my_rank - len(above) + i, tier_name, user_id) for i, doc in enumerate(above)]
+            around_rows.append(_tier_row(me_doc, my_rank, tier_name, user_id))
+            around_rows += [_tier_row(doc, my_rank + 1 + i, tier_name, user_id) for i, doc in enumerate(below)]
+
+    return {"items": page, "around": around_rows, "me": me, "total": total, "nextCursor": next_cursor}
@@ -0,0 +1,460 @@
+# ATutor/leaderboard_live.py
+# Realtime leaderboard push (behind the /leaderboard/live WebSocket in leaderboard_routes.py).
+#
+# Instead of polling POST /leaderboard/tiered and /friends, the app keeps one socket open and
+# receives rank changes as they happen. The hub keeps one channel per live board:
+#
+#   ("group", tierID, groupID)      → the group's snapshot rows, shared by every member watching it
+#   ("friends", friend-set hash)    → the rows of one set of friends (caller included)
+#
+# Channels are fed by an in-process change stream — XP flushes (xp_awards) and username changes
+# (PATCH /users/me) call member_changed() — and, for changes made by other instances, by a
+# periodic resync: ONE batched read per interval for all live group snapshots plus one batched
+# multi-get for all live friend sets, however many clients are connected. The resync also
+# re-reads the watchers' friend lists (one field-masked multi-get), so a friend added or removed
+# after connecting moves the watcher to the board of the new friend set.
+#
+# Messages (JSON), per scope:
+#   {"type": "snapshot", "scope": "group", "seq": 4, "version": 17, "items": [
+#       {"id": "3f9c0a1b2c4d", "rank": 1, "username": "...", "totalXP": 1234, "tierName": "Banana", "isCurrentUser": false}, ...]}
+#   {"type": "delta", "scope": "group", "seq": 5, "changes": [
+#       {"id": "3f9c0a1b2c4d", "rank": 2, "previousRank": 1, "username": "...", "totalXP": 1300, "tierName": "Banana"}, ...]}
+#   {"type": "ping"}
+# A snapshot is sent on connect, on {"type": "resync"} from the client, when a board's
+# membership changes, and when a client fell too far behind. `id` is an opaque per-process member
+# key (user ids are not exposed, as in the POST endpoints). `seq` rises by one per change of a
+# channel; a client that sees a gap should send {"type": "resync"}.
+#
+# Env:
+#   LEADERBOARD_LIVE_RESYNC_SECONDS     how often live boards are re-read from Firestore (default 15)
+#   LEADERBOARD_LIVE_QUEUE_SIZE         messages buffered per connection before it is resynced (default 64)
+#   LEADERBOARD_LIVE_MAX_CONNECTIONS    sockets per process (default 5000)
+#   LEADERBOARD_LIVE_PING_SECONDS       keep-alive ping interval (default 25)
+
+import asyncio
+import hashlib
+import logging
+import os
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from constants import tier_name_for
+from leaderboard import fetch_user_rows, read_user_placement
+from leaderboard_snapshots import get_group_snapshot, rank_members, snapshot_ref
+
+RESYNC_SECONDS = float(os.getenv("LEADERBOARD_LIVE_RESYNC_SECONDS", "15"))
+QUEUE_SIZE = int(os.getenv("LEADERBOARD_LIVE_QUEUE_SIZE", "64"))
+MAX_CONNECTIONS = int(os.getenv("LEADERBOARD_LIVE_MAX_CONNECTIONS", "5000"))
+PING_SECONDS = float(os.getenv("LEADERBOARD_LIVE_PING_SECONDS", "25"))
+
+SCOPES = ("group", "friends")
+
+# Snapshot documents per multi-get during resync
+_RESYNC_BATCH = 100
+# Per-process salt for member ids handed to clients
+_MEMBER_KEY_SALT = os.urandom(16)
+
+
+class UnknownUser(LookupError):
+    """No users/{uid} document for the caller."""
+
+
+class TooManyConnections(RuntimeError):
+    pass
+
+
+def member_key(user_id: str) -> str:
+    return hashlib.blake2b(user_id.encode("utf-8"), key=_MEMBER_KEY_SALT, digest_size=6).hexdigest()
+
+
+def _friend_set_hash(friend_ids: Iterable[str]) -> str:
+    return hashlib.sha1("\x1f".join(sorted(friend_ids)).encode("utf-8")).hexdigest()[:16]
+
+
+def _row(user_id: str, data: Dict[str, Any], tier_name: str) -> Dict[str, Any]:
+    return {
+        "userID": user_id,
+        "username": str(data.get("username") or "Player"),
+        "totalXP": int(data.get("totalXP") or 0),
+        "tierName": tier_name,
+    }
+
+
+# ======= Channels and subscribers =======
+
+class _Channel:
+    """One live board: current rows, their ranking, and who is watching."""
+
+    def __init__(self, key: Tuple[Any, ...], member_ids: Iterable[str] = ()) -> None:
+        self.key = key
+        self.scope = key[0]
+        # Friends boards: the ids asked for (some may have no profile yet)
+        self.member_ids: Set[str] = set(member_ids)
+        self.rows: Dict[str, Dict[str, Any]] = {}
+        self.order: List[str] = []
+        self.version: Optional[int] = None
+        self.seq = 0
+        self.subscribers: Set["Subscriber"] = set()
+
+    def commit(self, rows: Dict[str, Dict[str, Any]]) -> Tuple[bool, List[Dict[str, Any]]]:
+        """Replace the rows; returns (membership_changed, changed rows in delta form)."""
+        old_rows, old_rank = self.rows, {uid: i + 1 for i, uid in enumerate(self.order)}
+        self.rows = rows
+        self.order = [m["userID"] for m in rank_members(rows.values())]
+        if set(old_rows) != set(rows):
+            self.seq += 1
+            return True, []
+        changes = []
+        for i, uid in enumerate(self.order):
+            new, old = rows[uid], old_rows[uid]
+            if old_rank[uid] != i + 1 or any(new[f] != old[f] for f in ("username", "totalXP", "tierName")):
+                changes.append({
+                    "id": member_key(uid),
+                    "rank": i + 1,
+                    "previousRank": old_rank[uid],
+                    "username": new["username"],
+                    "totalXP": new["totalXP"],
+                    "tierName": new["tierName"],
+                })
+        if changes:
+            self.seq += 1
+        return False, changes
+
+    def items(self, user_id: str) -> List[Dict[str, Any]]:
+        return [
+            {
+                "id": member_key(uid),
+                "rank": i + 1,
+                "username": self.rows[uid]["username"],
+                "totalXP": self.rows[uid]["totalXP"],
+                "tierName": self.rows[uid]["tierName"],
+                "isCurrentUser": uid == user_id,
+            }
+            for i, uid in enumerate(self.order)
+        ]
+
+
+class Subscriber:
+    """One socket: its channels and an outbox the socket writer drains."""
+
+    def __init__(self, user_id: str, queue_size: int = QUEUE_SIZE) -> None:
+        self.user_id = user_id
+        self.channels: Dict[str, _Channel] = {}
+        self._outbox: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=max(2, queue_size))
+        # Scopes to send as a full snapshot once the outbox has room again
+        self._resync: Set[str] = set()
+        # seq of the last snapshot sent per scope; older queued deltas are already in it
+        self._sent_seq: Dict[str, int] = {}
+        self.dropped = 0
+        self.snapshots_sent = 0
+
+    def snapshot(self, scope: str) -> Dict[str, Any]:
+        channel = self.channels[scope]
+        self._sent_seq[scope] = channel.seq
+        self.snapshots_sent += 1
+        return {
+            "type": "snapshot",
+            "scope": scope,
+            "seq": channel.seq,
+            "version": channel.version,
+            "items": channel.items(self.user_id),
+        }
+
+    def push(self, message: Dict[str, Any]) -> None:
+        scope = message.get("scope")
+        if scope in self._resync:
+            return  # a fresh snapshot is already due
+        try:
+            self._outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            # Too far behind: drop what is queued and send current snapshots instead
+            self.dropped += self._outbox.qsize()
+            while not self._outbox.empty():
+                self._outbox.get_nowait()
+            self.request_resync()
+
+    def discard(self, scope: str) -> None:
+        """Forget queued deltas of a scope whose board was swapped (its snapshot follows)."""
+        kept = []
+        while not self._outbox.empty():
+            message = self._outbox.get_nowait()
+            if message.get("scope") != scope:
+                kept.append(message)
+        for message in kept:
+            self._outbox.put_nowait(message)
+
+    def request_resync(self, scopes: Optional[Iterable[str]] = None) -> None:
+        self._resync.update(scopes if scopes is not None else self.channels)
+        if self._outbox.empty():
+            self._outbox.put_nowait({"type": "_wake"})  # wake a writer waiting on the outbox
+
+    async def next_message(self, timeout: float = PING_SECONDS) -> Dict[str, Any]:
+        """The next message to send; a ping if nothing happened within `timeout`."""
+        while True:
+            if self._resync:
+                scope = self._resync.pop()
+                if scope in self.channels:
+                    return self.snapshot(scope)
+                continue
+            try:
+                message = await asyncio.wait_for(self._outbox.get(), timeout)
+            except asyncio.TimeoutError:
+                return {"type": "ping"}
+            if message.get("type") == "_wake":
+                continue
+            if message.get("type") == "delta" and message["seq"] <= self._sent_seq.get(message["scope"], -1):
+                continue
+            return message
+
+
+# ======= Hub =======
+
+class LeaderboardHub:
+    def __init__(self, get_db: Callable[[], Any], resync_seconds: float = RESYNC_SECONDS,
+                 max_connections: int = MAX_CONNECTIONS) -> None:
+        self._get_db = get_db
+        self._resync_seconds = resync_seconds
+        self._max_connections = max_connections
+        self._channels: Dict[Tuple[Any, ...], _Channel] = {}
+        self._by_member: Dict[str, Set[_Channel]] = defaultdict(set)
+        self._subscribers: Set[Subscriber] = set()
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._background: Set["asyncio.Task[Any]"] = set()
+        self.deltas = 0
+        self.snapshots = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.resync_reads = 0
+
+    def start(self) -> None:
+        if self._task is None and self._resync_seconds > 0:
+            self._task = asyncio.create_task(self._resync_loop())
+
+    async def stop(self) -> None:
+        tasks = [t for t in [self._task, *self._background] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    # --- subscriptions ---
+
+    async def subscribe(self, user_id: str, scopes: Iterable[str] = SCOPES) -> Subscriber:
+        """Register a socket for the caller's boards and queue their initial snapshots."""
+        if len(self._subscribers) >= self._max_connections:
+            raise TooManyConnections(f"{len(self._subscribers)} live leaderboard connections")
+        db = self._get_db()
+        me = await asyncio.to_thread(read_user_placement, db, user_id)
+        if me is None:
+            raise UnknownUser(user_id)
+
+        sub = Subscriber(user_id)
+        try:
+            if "group" in scopes:
+                self._join(sub, "group", await self._group_channel(db, me["tierID"], me["groupID"], user_id))
+            if "friends" in scopes:
+                self._join(sub, "friends", await self._friends_channel(db, set(me["friends"]) | {user_id}))
+        except BaseException:
+            # Also on cancellation: don't leave the sub in a channel nobody will unsubscribe it from
+            self.unsubscribe(sub)
+            raise
+        self._subscribers.add(sub)
+        sub.request_resync()
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        if sub in self._subscribers:
+            self._subscribers.discard(sub)
+            self.snapshots += sub.snapshots_sent
+            self.dropped += sub.dropped
+        for channel in sub.channels.values():
+            self._leave(sub, channel)
+        sub.channels = {}
+
+    def _join(self, sub: Subscriber, scope: str, channel: _Channel) -> None:
+        previous = sub.channels.get(scope)
+        if previous is not None and previous is not channel:
+            self._leave(sub, previous)
+            sub.discard(scope)
+        sub.channels[scope] = channel
+        channel.subscribers.add(sub)
+
+    def _leave(self, sub: Subscriber, channel: _Channel) -> None:
+        channel.subscribers.discard(sub)
+        if not channel.subscribers and self._channels.get(channel.key) is channel:
+            del self._channels[channel.key]
+            self._unindex(channel, channel.rows)
+
+    def _index(self, channel: _Channel, rows: Iterable[str]) -> None:
+        for uid in rows:
+            self._by_member[uid].add(channel)
+
+    def _unindex(self, channel: _Channel, rows: Iterable[str]) -> None:
+        for uid in rows:
+            channels = self._by_member.get(uid)
+            if channels is not None:
+                channels.discard(channel)
+                if not channels:
+                    del self._by_member[uid]
+
+    async def _group_channel(self, db, tier_id: int, group_id: int, user_id: str) -> _Channel:
+        key = ("group", tier_id, group_id)
+        channel = self._channels.get(key)
+        if channel is not None and user_id in channel.rows:
+            return channel
+        # New board, or the caller joined the group since it was loaded
+        snapshot = await asyncio.to_thread(get_group_snapshot, db, tier_id, group_id, user_id)
+        channel = self._channels.setdefault(key, _Channel(key))
+        self._update(channel, self._group_rows(tier_id, snapshot), snapshot.get("version"))
+        return channel
+
+    async def _friends_channel(self, db, friend_ids: Set[str]) -> _Channel:
+        key = ("friends", _friend_set_hash(friend_ids))
+        channel = self._channels.get(key)
+        if channel is not None:
+            return channel
+        rows = await asyncio.to_thread(fetch_user_rows, db, friend_ids)
+        channel = self._channels.setdefault(key, _Channel(key, friend_ids))
+        self._update(channel, self._friend_rows(channel, rows))
+        return channel
+
+    @staticmethod
+    def _group_rows(tier_id: int, snapshot: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        tier_name = tier_name_for(tier_id)
+        members = [m for m in snapshot.get("members") or [] if m.get("userID")]
+        return {str(m["userID"]): _row(str(m["userID"]), m, tier_name) for m in members}
+
+    @staticmethod
+    def _friend_rows(channel: _Channel, rows: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        return {
+            uid: _row(uid, data, tier_name_for(int(data.get("tierID") or 0)))
+            for uid, data in rows.items()
+            if uid in channel.member_ids
+        }
+
+    # --- change stream ---
+
+    def member_changed(self, user_id: str, total_xp: Optional[int] = None, username: Optional[str] = None) -> None:
+        """A member's XP or username changed (call on the event loop, after the write committed)."""
+        for channel in list(self._by_member.get(user_id, ())):
+            row = dict(channel.rows[user_id])
+            if total_xp is not None:
+                row["totalXP"] = int(total_xp)
+            if username is not None:
+                row["username"] = username
+            self._update(channel, {**channel.rows, user_id: row})
+
+    def _update(self, channel: _Channel, rows: Dict[str, Dict[str, Any]], version: Optional[int] = None) -> None:
+        if version is not None:
+            channel.version = int(version)
+        old_ids = list(channel.rows)
+        membership_changed, changes = channel.commit(rows)
+        if membership_changed:
+            self._unindex(channel, old_ids)
+            self._index(channel, channel.rows)
+            for sub in channel.subscribers:
+                sub.request_resync([channel.scope])
+            return
+        if not changes:
+            return
+        message = {"type": "delta", "scope": channel.scope, "seq": channel.seq, "changes": changes}
+        for sub in channel.subscribers:
+            if sub.channels.get(channel.scope) is channel:
+                sub.push(message)
+        self.deltas += len(channel.subscribers)
+
+    # --- resync from Firestore ---
+
+    async def _resync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._resync_seconds)
+            try:
+                await self.resync()
+            except Exception as e:
+                logging.warning(f"Live leaderboard resync failed: {e}")
+
+    async def resync(self) -> None:
+        """Re-read every live board (batched) and push what changed, e.g. writes from other instances."""
+        db = self._get_db()
+        groups = [c for c in self._channels.values() if c.scope == "group"]
+        friends = [c for c in self._channels.values() if c.scope == "friends"]
+
+        if groups:
+            docs = await asyncio.to_thread(self._read_snapshots, db, [(c.key[1], c.key[2]) for c in groups])
+            for channel in groups:
+                data = docs.get((channel.key[1], channel.key[2]))
+                if data is not None and self._channels.get(channel.key) is channel:
+                    self._update(channel, self._group_rows(channel.key[1], data), data.get("version"))
+                    self._relocate_missing(channel)
+
+        watchers = [sub for sub in self._subscribers if "friends" in sub.channels]
+        if watchers:
+            await self._refresh_friend_sets(db, watchers)
+            friends = [c for c in self._channels.values() if c.scope == "friends"]
+
+        if friends:
+            ids = set().union(*(c.member_ids for c in friends))
+            rows = await asyncio.to_thread(fetch_user_rows, db, ids)
+            self.resync_reads += len(ids)
+            for channel in friends:
+                if self._channels.get(channel.key) is channel:
+                    self._update(channel, self._friend_rows(channel, rows))
+        self.resyncs += 1
+
+    async def _refresh_friend_sets(self, db, watchers: List[Subscriber]) -> None:
+        # Friends added or removed since connecting: move the watcher to the board of the new set
+        lists = await asyncio.to_thread(fetch_user_rows, db, {sub.user_id for sub in watchers}, ["friends"])
+        self.resync_reads += len(watchers)
+        for sub in watchers:
+            data = lists.get(sub.user_id)
+            if data is None or sub not in self._subscribers:
+                continue
+            friend_ids = {f.strip() for f in data.get("friends") or [] if isinstance(f, str) and f.strip()}
+            friend_ids.add(sub.user_id)
+            if sub.channels["friends"].key == ("friends", _friend_set_hash(friend_ids)):
+                continue
+            channel = await self._friends_channel(db, friend_ids)
+            if sub in self._subscribers:
+                self._join(sub, "friends", channel)
+                sub.request_resync(["friends"])
+            else:
+                self._leave(sub, channel)  # disconnected meanwhile; drop the board if nobody watches it
+
+    def _read_snapshots(self, db, groups: List[Tuple[int, int]]) -> Dict[Tuple[int, int], Dict[str, Any]]:
+        out: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        for i in range(0, len(groups), _RESYNC_BATCH):
+            chunk = groups[i:i + _RESYNC_BATCH]
+            refs = {snapshot_ref(db, t, g).id: (t, g) for t, g in chunk}
+            for doc in db.get_all([snapshot_ref(db, t, g) for t, g in chunk]):
+                if doc.exists:
+                    out[refs[doc.id]] = doc.to_dict() or {}
+        self.resync_reads += len(groups)
+        return out
+
+    def _relocate_missing(self, channel: _Channel) -> None:
+        # After a rotation a watcher may no longer be in this group: move them to their new board
+        for sub in list(channel.subscribers):
+            if sub.user_id not in channel.rows:
+                task = asyncio.create_task(self._relocate(sub))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+
+    async def _relocate(self, sub: Subscriber) -> None:
+        db = self._get_db()
+        me = await asyncio.to_thread(read_user_placement, db, sub.user_id)
+        if me is None or sub not in self._subscribers:
+            return
+        self._join(sub, "group", await self._group_channel(db, me["tierID"], me["groupID"], sub.user_id))
+        sub.request_resync(["group"])
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "connections": len(self._subscribers),
+            "group_channels": sum(1 for c in self._channels.values() if c.scope == "group"),
+            "friends_channels": sum(1 for c in self._channels.values() if c.scope == "friends"),
+            "deltas_sent": self.deltas,
+            "snapshots_sent": self.snapshots + sum(s.snapshots_sent for s in self._subscribers),
+            "resyncs": self.resyncs,
+            "resync_reads": self.resync_reads,
+            "dropped": self.dropped + sum(s.dropped for s in self._subscribers),
+        }
@@ -1,17 +1,83 @@
 # ATutor/leaderboard_refresh.py
-# Periodic reshuffle + tier rotation script aligned to the 5-tier scheme.
+# Periodic tier rotation script aligned to the 5-tier scheme.
 # Uses the shared constants and FirebaseManager so it stays in sync with the app.
-
-from collections import defaultdict
-from datetime import datetime, timedelta
-from typing import Any, Dict, List
+# The rotation itself is computed by the pure engine in rotation_engine.py; this script
+# only reads users, applies the resulting assignments and rebuilds leaderboard snapshots.
+#
+# Users are streamed page by page with a field mask (only what rotation needs — no friends
+# arrays etc.) into compact records, so memory stays proportional to the user count, not
+# document size.
+#
+# Env:
+#   REFRESH_SCAN_PAGE_SIZE   documents per paginated read (default 2000)
+#   REFRESH_PROGRESS_EVERY   print a progress line every N users (default 50000)
+#   REFRESH_MAX_MEMORY_MB    abort the scan if the rotation's peak memory (records + rotation
+#                            working set) would exceed this (default 1024)
+#
+# Only users whose tier/group actually changed are written, through a parallel BulkWriter
+# (ramped rate limit, exponential retry). By default every changed tier is regrouped each week,
+# so most assignments change; with ROTATION_KEEP_GROUPS=1 users who stay in their tier keep
+# their group (see rotation_engine.py) and the writes shrink to the movers:
+#   REFRESH_WRITE_OPS_PER_SECOND       initial write rate (default 500, Firestore's 500/50/5 ramp-up rule)
+#   REFRESH_MAX_WRITE_OPS_PER_SECOND   ceiling the writer may ramp up to (default 5000)
+#   REFRESH_WRITE_MAX_ATTEMPTS         attempts per document before it is reported as failed (default 5)
+#   ROTATION_SEED                      tie-break seed (default: the ISO year+week, e.g. 202542)
+#   ROTATION_KEEP_GROUPS               "1" keeps stayers in their group instead of regrouping (default 0)
+#   ROTATION_MIN_GROUP_SIZE            with ROTATION_KEEP_GROUPS, merge groups smaller than this
+#                                      (default half of GROUP_SIZE)
+#
+# Rolling mode (--rolling) spreads a cycle over many short runs instead; see "Rolling rotation" below:
+#   ROTATION_SHARDS_PER_RUN    shards processed per invocation (default 1)
+#   ROTATION_LEASE_SECONDS     how long a run holds the cycle before another run may take over (default 900)
+#   ROTATION_MAX_OPEN_GROUPS   partially filled groups remembered per tier for incoming movers (default 2000)
+
+import argparse
+import hashlib
+import os
+import socket
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriterOptions
+from google.cloud.firestore_v1.field_path import FieldPath
 
 from utils import FirebaseManager
 from constants import TIERS, GROUP_SIZE
+from leaderboard_snapshots import (
+    member_row,
+    rebuild_snapshots,
+    snapshot_id,
+    snapshot_payload,
+    snapshot_ref,
+)
+from rotation_engine import ROTATION_BYTES_PER_USER, UserRecord, rotate, rotate_group
 
 # Firestore client (requires project_id, client_email, private_key env vars)
 db = FirebaseManager().get_db_client()
 
+# The only user fields rotation reads
+ROTATION_FIELDS = ["userID", "username", "tierID", "groupID", "totalXP", "lastLoginDate"]
+
+SCAN_PAGE_SIZE = int(os.getenv("REFRESH_SCAN_PAGE_SIZE", "2000"))
+PROGRESS_EVERY = int(os.getenv("REFRESH_PROGRESS_EVERY", "50000"))
+MAX_MEMORY_MB = int(os.getenv("REFRESH_MAX_MEMORY_MB", "1024"))
+
+WRITE_OPS_PER_SECOND = int(os.getenv("REFRESH_WRITE_OPS_PER_SECOND", "500"))
+MAX_WRITE_OPS_PER_SECOND = int(os.getenv("REFRESH_MAX_WRITE_OPS_PER_SECOND", "5000"))
+WRITE_MAX_ATTEMPTS = int(os.getenv("REFRESH_WRITE_MAX_ATTEMPTS", "5"))
+
+ROTATION_SEED = int(os.getenv("ROTATION_SEED") or time.strftime("%G%V"))
+KEEP_GROUPS = os.getenv("ROTATION_KEEP_GROUPS", "0").strip().lower() in ("1", "true", "yes", "on")
+MIN_GROUP_SIZE = int(os.getenv("ROTATION_MIN_GROUP_SIZE") or max(1, GROUP_SIZE // 2))
+
+CHECKPOINT_COLLECTION = "leaderboardRotations"
+SHARDS_PER_RUN = int(os.getenv("ROTATION_SHARDS_PER_RUN", "1"))
+LEASE_SECONDS = int(os.getenv("ROTATION_LEASE_SECONDS", "900"))
+MAX_OPEN_GROUPS = int(os.getenv("ROTATION_MAX_OPEN_GROUPS", "2000"))
+
 
 def _safe_int(v: Any, default: int = 0) -> int:
     try:
@@ -39,199 +105,452 @@ def _to_datetime(value: Any) -> datetime:
     return datetime.min
 
 
-def get_promotion_demotion_counts(tier_id: int) -> (int, int):
-    """
-    Promotion/demotion counts per group for the 5-tier model (0..4).
+def _to_timestamp(value: Any) -> float:
+    """POSIX seconds for a lastLoginDate value (0.0 when missing/unparseable)."""
+    dt = _to_datetime(value)
+    if dt == datetime.min:
+        return 0.0
+    try:
+        return dt.timestamp()
+    except (OverflowError, OSError, ValueError):
+        return 0.0
 
-    Simple policy:
-      - Bottom tier (0): promote 10, demote 0
-      - Top tier (4):    promote 0,  demote 10
-      - Middle tiers:    promote decreases as you go up; demote increases
-        (mirrors the previous intent but bounded to 5 tiers)
-    """
-    top_index = len(TIERS) - 1
-    if tier_id <= 0:
-        return 10, 0
-    if tier_id >= top_index:
-        return 0, 10
-    # Middle tiers (1..3)
-    promote = max(1, 10 - tier_id - 1)  # 1:8, 2:7, 3:6
-    demote = max(1, 3 + (tier_id - 1) + 1)  # 1:4, 2:5, 3:6
-    return promote, demote
-
-
-def get_all_users_grouped() -> Dict[int, List[Dict[str, Any]]]:
-    """Get all users grouped by tier with lastLoginDate normalized to datetime."""
-    all_users = db.collection("users").get()
-    tier_users: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
-
-    for user_doc in all_users:
-        user_data = user_doc.to_dict() or {}
-        tier_id = _safe_int(user_data.get("tierID"), 0)
-        user_data["lastLoginDateTime"] = _to_datetime(user_data.get("lastLoginDate"))
-        user_data["userID"] = user_data.get("userID") or user_doc.id
-        user_data["username"] = user_data.get("username") or "Player"
-        user_data["totalXP"] = _safe_int(user_data.get("totalXP"), 0)
-        tier_users[tier_id].append(user_data)
 
-    return tier_users
+def user_record_from_doc(doc) -> UserRecord:
+    """Compact rotation record for a (field-masked) user document; timestamps parsed once here."""
+    data = doc.to_dict() or {}
+    return UserRecord(
+        user_id=str(data.get("userID") or doc.id),
+        username=str(data.get("username") or "Player"),
+        tier_id=_safe_int(data.get("tierID"), 0),
+        group_id=_safe_int(data.get("groupID"), 0),
+        total_xp=_safe_int(data.get("totalXP"), 0),
+        last_active=_to_timestamp(data.get("lastLoginDate")),
+    )
+
 
+class MemoryBudgetExceeded(RuntimeError):
+    pass
 
-def shuffle_users_by_activity(users: List[Dict[str, Any]], group_size: int = GROUP_SIZE) -> List[List[Dict[str, Any]]]:
+
+def stream_users(page_size: int = SCAN_PAGE_SIZE) -> Iterator[UserRecord]:
+    """
+    Yield every user as a UserRecord, reading field-masked pages ordered by document id.
+    Paginating (instead of one long stream) keeps each RPC short and restartable.
+    """
+    query = db.collection("users").select(ROTATION_FIELDS).order_by(FieldPath.document_id()).limit(page_size)
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page.stream())
+        for doc in docs:
+            yield user_record_from_doc(doc)
+        if len(docs) < page_size:
+            return
+        last_doc = docs[-1]
+
+
+def get_all_users_grouped(max_memory_mb: int = MAX_MEMORY_MB) -> Dict[int, List[UserRecord]]:
     """
-    Shuffle users into groups while keeping recently active users together.
-    Recent = last 7 days. Within recent/inactive, sort by XP desc then by last seen (recent first).
+    Stream all users into compact records grouped by tier, reporting progress. The memory budget
+    covers the records and the per-user working set of the rotation that follows.
     """
-    now = datetime.now()
-    recent_threshold = now - timedelta(days=7)
+    tier_users: Dict[int, List[UserRecord]] = defaultdict(list)
+    budget = max_memory_mb * 1024 * 1024
+    used = 0
+    count = 0
+    started = time.monotonic()
 
-    recent_users = [u for u in users if _to_datetime(u["lastLoginDateTime"]) >= recent_threshold]
-    inactive_users = [u for u in users if _to_datetime(u["lastLoginDateTime"]) < recent_threshold]
+    for user in stream_users():
+        tier_users[user.tier_id].append(user)
+        count += 1
+        # The record itself plus what rotate() and the snapshot rebuild will allocate for it
+        used += user.approx_bytes() + ROTATION_BYTES_PER_USER
+        if used > budget:
+            raise MemoryBudgetExceeded(
+                f"User scan exceeded REFRESH_MAX_MEMORY_MB={max_memory_mb} after {count} users; "
+                "raise the budget or run a sharded rotation"
+            )
+        if PROGRESS_EVERY > 0 and count % PROGRESS_EVERY == 0:
+            elapsed = time.monotonic() - started
+            print(f"Scanned {count} users ({count / max(elapsed, 1e-6):.0f}/s, ~{used / 1024 / 1024:.0f} MB)")
+
+    elapsed = time.monotonic() - started
+    print(f"Scan complete: {count} users in {elapsed:.1f}s (~{used / 1024 / 1024:.0f} MB expected peak)")
+    return tier_users
 
-    # Sort: XP desc, then recent first
-    recent_users.sort(key=lambda u: (-_safe_int(u["totalXP"], 0), -_to_datetime(u["lastLoginDateTime"]).timestamp()))
-    inactive_users.sort(key=lambda u: (-_safe_int(u["totalXP"], 0), -_to_datetime(u["lastLoginDateTime"]).timestamp()))
 
-    groups: List[List[Dict[str, Any]]] = []
-    r_idx = 0
-    i_idx = 0
+def apply_assignments(
+    tier_users: Dict[int, List[UserRecord]], assignments: Dict[str, Tuple[int, int]]
+) -> Tuple[List[Tuple[str, int, int]], int]:
+    """
+    Move each record to its new (tier, group) in place and collect the ones that changed, so
+    the rotation result can be dropped before snapshots are rebuilt.
+    Returns ([(user_id, tier_id, group_id), ...] for changed users, unchanged_count).
+    """
+    changed: List[Tuple[str, int, int]] = []
+    unchanged = 0
+    for users in tier_users.values():
+        for u in users:
+            new = assignments.get(u.user_id)
+            if new is None or new == (u.tier_id, u.group_id):
+                unchanged += 1
+                continue
+            changed.append((u.user_id, new[0], new[1]))
+            u.tier_id, u.group_id = new
+    return changed, unchanged
+
+
+def batch_update_users(updates: List[Tuple[str, int, int]]) -> Dict[str, int]:
+    """
+    Write tierID/groupID for each (user_id, tier_id, group_id) through a BulkWriter: batches are sent in parallel,
+    throttled (ramping from REFRESH_WRITE_OPS_PER_SECOND) and retried with exponential backoff.
+    Returns {"written": n, "failed": n}.
+    """
+    if not updates:
+        return {"written": 0, "failed": 0}
 
-    while r_idx < len(recent_users) or i_idx < len(inactive_users):
-        group: List[Dict[str, Any]] = []
+    writer = db.bulk_writer(
+        BulkWriterOptions(
+            initial_ops_per_second=WRITE_OPS_PER_SECOND,
+            max_ops_per_second=max(WRITE_OPS_PER_SECOND, MAX_WRITE_OPS_PER_SECOND),
+            retry=BulkRetry.exponential,
+        )
+    )
+    failed: List[str] = []
 
-        # Up to 70% recent users
-        recent_slots = min(int(group_size * 0.7), len(recent_users) - r_idx)
-        for _ in range(recent_slots):
-            if r_idx < len(recent_users):
-                group.append(recent_users[r_idx])
-                r_idx += 1
+    def on_error(failure, _writer) -> bool:
+        if failure.attempts < WRITE_MAX_ATTEMPTS:
+            return True  # retry
+        failed.append(failure.operation.reference.id)
+        print(f"Giving up on {failure.operation.reference.id} after {failure.attempts} attempts: {failure.message}")
+        return False
 
-        # Fill remaining with inactive
-        remaining = group_size - len(group)
-        for _ in range(remaining):
-            if i_idx < len(inactive_users):
-                group.append(inactive_users[i_idx])
-                i_idx += 1
+    writer.on_write_error(on_error)
+    users = db.collection("users")
+    for user_id, tier_id, group_id in updates:
+        writer.update(users.document(user_id), {"tierID": tier_id, "groupID": group_id})
+    writer.close()  # flushes and waits for every write (including retries)
 
-        if group:
-            groups.append(group)
+    return {"written": len(updates) - len(failed), "failed": len(failed)}
 
-    return groups
 
+def rotate_tiers() -> None:
+    """Promote/demote across all 5 tiers and regroup the changed tiers (or place movers, ROTATION_KEEP_GROUPS)."""
+    print("Starting tier rotation...")
 
-def batch_update_users(updates: List[Dict[str, Any]]) -> None:
-    """Batch update users to avoid Firestore limits (500 ops per batch)."""
-    if not updates:
+    tier_users = get_all_users_grouped()
+    for tier_id in range(len(TIERS)):
+        tier_name = TIERS[tier_id]["name"]
+        count = len(tier_users.get(tier_id, []))
+        print(f"Processing {tier_name} tier with {count} users" if count else f"No users in {tier_name} tier")
+
+    started = time.monotonic()
+    result = rotate(
+        (u for users in tier_users.values() for u in users),
+        num_tiers=len(TIERS),
+        group_size=GROUP_SIZE,
+        now=time.time(),
+        seed=ROTATION_SEED,
+        keep_groups=KEEP_GROUPS,
+        min_group_size=MIN_GROUP_SIZE,
+    )
+    print(
+        f"Rotation computed in {time.monotonic() - started:.1f}s: "
+        f"{result.promoted} promoted, {result.demoted} demoted (seed {ROTATION_SEED})"
+    )
+
+    # Apply only the assignments that actually changed; the records now hold the new placement
+    changed, unchanged = apply_assignments(tier_users, result.assignments)
+    total = len(changed) + unchanged
+    del result
+    if changed:
+        print(f"Applying {len(changed)} updates ({unchanged} unchanged users skipped)...")
+        started = time.monotonic()
+        result = batch_update_users(changed)
+        elapsed = time.monotonic() - started
+        print(
+            f"Write summary: {result['written']} written, {result['failed']} failed, "
+            f"{unchanged} writes avoided ({100.0 * unchanged / max(1, total):.0f}% of users), "
+            f"{elapsed:.1f}s ({result['written'] / max(elapsed, 1e-6):.0f} writes/s)"
+        )
+        print("Tier rotation completed successfully!")
+    else:
+        print(f"No updates needed ({unchanged} users already in place).")
+    del changed
+
+    # Re-materialise every group's leaderboard snapshot from the final assignments
+    written = rebuild_snapshots(db, (u.as_assignment() for users in tier_users.values() for u in users))
+    print(f"Rebuilt {written} leaderboard snapshots.")
+
+
+# ======= Rolling rotation =======
+#
+# Rotates a cycle (one ISO week by default) a few shards per run instead of all at once:
+#   --shard-by tier           one shard per tier
+#   --shard-by group          --shards N shards of groups, hashed on "{tierID}_{groupID}"
+#
+# Groups are enumerated as 0..highest groupID of each tier in users (one indexed query per tier
+# at the start of a run), so groups without a leaderboard snapshot are rotated too and no shard
+# scans a whole tier before querying its groups; an unused id in between costs one read.
+#
+# Each existing group is rotated in its own transaction: its promoted/demoted members take free
+# places in the neighbouring tier (groups already rotated this cycle first, then new groups), every
+# member is stamped with rotationCycle, and the affected leaderboard snapshots and the checkpoint
+# are written in the same commit. A user sees either their old group and board or the new ones,
+# never a mix, and a group whose members already carry this cycle's stamp is skipped, so an
+# interrupted run is simply resumed by the next one.
+#
+# Progress lives in leaderboardRotations/{cycle}: completed shards, per-tier intake state and a
+# lease that keeps overlapping scheduled runs apart. Groups are kept as they are (like the full
+# rotation with ROTATION_KEEP_GROUPS=1); here promotion is decided per existing group rather
+# than per activity-packed group.
+
+class RotationLeaseHeld(RuntimeError):
+    pass
+
+
+def current_cycle() -> str:
+    return time.strftime("%G-W%V")
+
+
+def checkpoint_ref(cycle: str):
+    return db.collection(CHECKPOINT_COLLECTION).document(cycle)
+
+
+def group_shard(tier_id: int, group_id: int, shards: int) -> int:
+    """Stable shard for a group (independent of Python's per-process hash seed)."""
+    digest = hashlib.blake2b(snapshot_id(tier_id, group_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+def shard_groups(shard_by: str, shard: int, shards: int, next_free: Dict[int, int]) -> List[Tuple[int, int]]:
+    """The (tierID, groupID) pairs that make up one shard; `next_free` is first_free_group_id per tier."""
+    if shard_by == "tier":
+        return [(shard, group_id) for group_id in range(next_free.get(shard, 0))]
+    return [
+        (tier_id, group_id)
+        for tier_id in range(len(TIERS))
+        for group_id in range(next_free.get(tier_id, 0))
+        if group_shard(tier_id, group_id, shards) == shard
+    ]
+
+
+def first_free_group_id(tier_id: int) -> int:
+    """One past the highest groupID currently used in a tier."""
+    docs = list(
+        db.collection("users")
+        .where("tierID", "==", tier_id)
+        .order_by("groupID", direction=firestore.Query.DESCENDING)
+        .limit(1)
+        .select(["groupID"])
+        .stream()
+    )
+    return _safe_int((docs[0].to_dict() or {}).get("groupID"), 0) + 1 if docs else 0
+
+
+def claim_cycle(cycle: str, shard_by: str, shards: int, owner: str) -> Dict[str, Any]:
+    """Create or resume the cycle's checkpoint and take its lease; returns the checkpoint."""
+    ref = checkpoint_ref(cycle)
+
+    @firestore.transactional
+    def claim(txn) -> Dict[str, Any]:
+        snap = ref.get(transaction=txn)
+        state = (snap.to_dict() or {}) if snap.exists else {}
+        now = time.time()
+        if not state:
+            state = {"cycle": cycle, "shardBy": shard_by, "shards": shards, "completedShards": [], "intake": {}}
+            txn.set(ref, {**state, "startedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+        elif state.get("shardBy") != shard_by or _safe_int(state.get("shards"), 0) != shards:
+            raise ValueError(
+                f"Cycle {cycle} was started with --shard-by {state.get('shardBy')} ({state.get('shards')} shards); "
+                "finish it with the same settings"
+            )
+        elif state.get("leaseOwner") not in (None, owner) and float(state.get("leaseUntil") or 0) > now:
+            raise RotationLeaseHeld(f"Cycle {cycle} is being rotated by {state.get('leaseOwner')}")
+        txn.set(
+            ref,
+            {"leaseOwner": owner, "leaseUntil": now + LEASE_SECONDS, "updatedAt": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+        return state
+
+    return claim(db.transaction())
+
+
+def release_cycle(cycle: str, owner: str) -> None:
+    """Drop our lease so the next scheduled run need not wait for it to expire."""
+    ref = checkpoint_ref(cycle)
+
+    @firestore.transactional
+    def release(txn) -> None:
+        snap = ref.get(transaction=txn)
+        if snap.exists and (snap.to_dict() or {}).get("leaseOwner") == owner:
+            txn.set(ref, {"leaseOwner": None, "leaseUntil": 0}, merge=True)
+
+    release(db.transaction())
+
+
+def _intake_entry(intake: Dict[str, Any], tier_id: int, next_free: Dict[int, int]) -> Dict[str, Any]:
+    key = str(tier_id)
+    if key not in intake:
+        intake[key] = {"nextGroupID": next_free.get(tier_id, 0), "open": []}
+    return intake[key]
+
+
+def _take_slot(intake: Dict[str, Any], tier_id: int, next_free: Dict[int, int]) -> int:
+    """A group in `tier_id` with room for one more member (part-filled groups first)."""
+    entry = _intake_entry(intake, tier_id, next_free)
+    open_groups = entry["open"]
+    if not open_groups:
+        open_groups.append({"groupID": entry["nextGroupID"], "free": GROUP_SIZE})
+        entry["nextGroupID"] += 1
+    slot = open_groups[0]
+    slot["free"] -= 1
+    if slot["free"] <= 0:
+        open_groups.pop(0)
+    return slot["groupID"]
+
+
+def _add_open_group(intake: Dict[str, Any], tier_id: int, group_id: int, free: int, next_free: Dict[int, int]) -> None:
+    entry = _intake_entry(intake, tier_id, next_free)
+    if free > 0 and len(entry["open"]) < MAX_OPEN_GROUPS:
+        entry["open"].append({"groupID": group_id, "free": free})
+
+
+def rotate_existing_group(
+    cycle: str, owner: str, tier_id: int, group_id: int, next_free: Dict[int, int]
+) -> Optional[Dict[str, int]]:
+    """
+    Rotate one group atomically (users, snapshots and checkpoint in one transaction).
+    `next_free` (first_free_group_id per tier) is read before the transaction, so the transaction
+    only reads the checkpoint, the members and the affected snapshots.
+    Returns {"promoted", "demoted", "stayed"}, {"empty": 1} for an unused group id, or None if the
+    group was already rotated this cycle.
+    """
+    ref = checkpoint_ref(cycle)
+    users = db.collection("users")
+    members_query = (
+        users.where("tierID", "==", tier_id)
+        .where("groupID", "==", group_id)
+        .select(ROTATION_FIELDS + ["rotationCycle"])
+    )
+
+    @firestore.transactional
+    def run(txn) -> Optional[Dict[str, int]]:
+        # All reads first (Firestore requirement), then every write in the same commit
+        state = ref.get(transaction=txn).to_dict() or {}
+        if state.get("leaseOwner") != owner:
+            raise RotationLeaseHeld(f"Lost the lease on cycle {cycle} to {state.get('leaseOwner')}")
+        docs = list(txn.get(members_query))
+        if not docs:
+            return {"empty": 1}
+        if any((doc.to_dict() or {}).get("rotationCycle") == cycle for doc in docs):
+            return None
+        doc_refs = {}
+        members = []
+        for doc in docs:
+            user = user_record_from_doc(doc)
+            doc_refs[user.user_id] = doc.reference
+            members.append(user)
+
+        promoted, staying, demoted = rotate_group(members, tier_id, len(TIERS), ROTATION_SEED)
+        intake = state.get("intake") or {}
+        placements: Dict[str, Tuple[int, int]] = {}
+        for movers, destination in ((promoted, tier_id + 1), (demoted, tier_id - 1)):
+            for user in movers:
+                placements[user.user_id] = (destination, _take_slot(intake, destination, next_free))
+        _add_open_group(intake, tier_id, group_id, GROUP_SIZE - len(staying), next_free)
+
+        boards: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+        for key in sorted(set(placements.values())):
+            snap = snapshot_ref(db, *key).get(transaction=txn)
+            boards[key] = list(((snap.to_dict() or {}).get("members") or []) if snap.exists else [])
+        boards[(tier_id, group_id)] = [member_row(u.user_id, u.as_assignment()) for u in staying]
+        for user in promoted + demoted:
+            boards[placements[user.user_id]].append(member_row(user.user_id, user.as_assignment()))
+
+        for user in members:
+            update: Dict[str, Any] = {"rotationCycle": cycle}
+            if user.user_id in placements:
+                update["tierID"], update["groupID"] = placements[user.user_id]
+            txn.update(doc_refs[user.user_id], update)
+        for (t, g), rows in boards.items():
+            txn.set(snapshot_ref(db, t, g), snapshot_payload(t, g, rows), merge=True)
+        txn.set(
+            ref,
+            {"intake": intake, "leaseUntil": time.time() + LEASE_SECONDS, "updatedAt": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+        return {"promoted": len(promoted), "demoted": len(demoted), "stayed": len(staying)}
+
+    return run(db.transaction())
+
+
+def rolling_rotation(
+    shard_by: str = "tier",
+    shards: int = 16,
+    shards_per_run: int = SHARDS_PER_RUN,
+    cycle: Optional[str] = None,
+) -> None:
+    """Rotate the next `shards_per_run` pending shards of the current cycle."""
+    cycle = cycle or current_cycle()
+    total = len(TIERS) if shard_by == "tier" else max(1, shards)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    state = claim_cycle(cycle, shard_by, total, owner)
+    done = {_safe_int(s, -1) for s in state.get("completedShards") or []}
+    pending = [s for s in range(total) if s not in done]
+    print(f"Rolling rotation {cycle} (by {shard_by}, seed {ROTATION_SEED}): {len(pending)}/{total} shards pending")
+    if not pending:
+        release_cycle(cycle, owner)
         return
 
-    batch = db.batch()
-    count = 0
-
-    for upd in updates:
-        user_ref = db.collection("users").document(upd["user_id"])
-        batch.update(user_ref, {"tierID": upd["tier_id"], "groupID": upd["group_id"]})
-        count += 1
-        if count >= 500:
-            batch.commit()
-            batch = db.batch()
-            count = 0
-
-    if count > 0:
-        batch.commit()
+    # Read once, outside any transaction: lists the groups and seeds each tier's intake
+    next_free = {tier_id: first_free_group_id(tier_id) for tier_id in range(len(TIERS))}
 
+    ref = checkpoint_ref(cycle)
+    try:
+        for shard in pending[:max(1, shards_per_run)]:
+            started = time.monotonic()
+            totals: Counter = Counter()
+            groups = shard_groups(shard_by, shard, total, next_free)
+            for tier_id, group_id in groups:
+                result = rotate_existing_group(cycle, owner, tier_id, group_id, next_free)
+                totals.update(result if result is not None else {"skipped": 1})
+            ref.set(
+                {"completedShards": firestore.ArrayUnion([shard]), "updatedAt": firestore.SERVER_TIMESTAMP},
+                merge=True,
+            )
+            print(
+                f"Shard {shard}: {len(groups)} groups in {time.monotonic() - started:.1f}s — "
+                f"{totals['promoted']} promoted, {totals['demoted']} demoted, {totals['stayed']} stayed, "
+                f"{totals['skipped']} groups already rotated, {totals['empty']} unused group ids"
+            )
+    finally:
+        release_cycle(cycle, owner)
+
+    remaining = max(0, len(pending) - max(1, shards_per_run))
+    if remaining:
+        print(f"{remaining} shards left in cycle {cycle}.")
+    else:
+        ref.set({"completedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+        print(f"Rotation cycle {cycle} complete.")
 
-def rotate_tiers() -> None:
-    """Promote/demote and reshuffle groups across all 5 tiers."""
-    print("Starting tier rotation with shuffling...")
-
-    tier_users = get_all_users_grouped()
-    all_updates: List[Dict[str, Any]] = []
 
-    top_index = len(TIERS) - 1
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rotate leaderboard tiers and groups")
+    parser.add_argument("--rolling", action="store_true", help="Rotate the current cycle shard by shard")
+    parser.add_argument("--shard-by", choices=["tier", "group"], default="tier", help="Rolling shard unit")
+    parser.add_argument("--shards", type=int, default=16, help="Number of group-hash shards (--shard-by group)")
+    parser.add_argument("--shards-per-run", type=int, default=SHARDS_PER_RUN, help="Shards to process this run")
+    parser.add_argument("--cycle", type=str, help="Cycle id (default: current ISO week, e.g. 2025-W42)")
+    args = parser.parse_args()
 
-    for tier_id in range(len(TIERS)):
-        tier_name = TIERS[tier_id]["name"]
-        users = tier_users.get(tier_id, [])
-
-        if not users:
-            print(f"No users in {tier_name} tier")
-            continue
-
-        print(f"Processing {tier_name} tier with {len(users)} users")
-
-        # Shuffle users into new groups based on activity
-        new_groups = shuffle_users_by_activity(users, GROUP_SIZE)
-
-        promote_count, demote_count = get_promotion_demotion_counts(tier_id)
-
-        promoted_users: List[Dict[str, Any]] = []
-        demoted_users: List[Dict[str, Any]] = []
-        staying_users: List[Dict[str, Any]] = []
-
-        for group in new_groups:
-            # Sort group by totalXP descending
-            sorted_group = sorted(group, key=lambda u: _safe_int(u["totalXP"], 0), reverse=True)
-
-            # Promotions (skip if top tier)
-            group_promoted = 0
-            if tier_id < top_index and promote_count > 0:
-                to_promote = min(promote_count, len(sorted_group))
-                promoted_users.extend(sorted_group[:to_promote])
-                group_promoted = to_promote
-
-            # Demotions (skip if bottom tier)
-            group_demoted = 0
-            if tier_id > 0 and demote_count > 0:
-                # Demote from the bottom of the group, but don't collide with promoted slice
-                available_for_demote = len(sorted_group) - group_promoted
-                to_demote = min(demote_count, max(0, available_for_demote))
-                if to_demote > 0:
-                    demoted_users.extend(sorted_group[-to_demote:])
-                    group_demoted = to_demote
-
-            # Those who stay in current tier
-            end_idx = len(sorted_group) - group_demoted if group_demoted > 0 else len(sorted_group)
-            staying_segment = sorted_group[group_promoted:end_idx]
-            staying_users.extend(staying_segment)
-
-        # Repack staying users within current tier
-        staying_groups = shuffle_users_by_activity(staying_users, GROUP_SIZE)
-        for g_idx, group in enumerate(staying_groups):
-            for user in group:
-                all_updates.append({"user_id": user["userID"], "tier_id": tier_id, "group_id": g_idx})
-
-        # Handle promotions → next tier
-        if promoted_users and tier_id < top_index:
-            target_tier_users = tier_users.get(tier_id + 1, [])
-            combined = target_tier_users + promoted_users
-            target_groups = shuffle_users_by_activity(combined, GROUP_SIZE)
-            promoted_ids = {u["userID"] for u in promoted_users}
-            for g_idx, group in enumerate(target_groups):
-                for user in group:
-                    if user["userID"] in promoted_ids:
-                        all_updates.append({"user_id": user["userID"], "tier_id": tier_id + 1, "group_id": g_idx})
-                        print(f"Promoting {user.get('username','Player')} to {TIERS[tier_id + 1]['name']}")
-
-        # Handle demotions → previous tier
-        if demoted_users and tier_id > 0:
-            target_tier_users = tier_users.get(tier_id - 1, [])
-            combined = target_tier_users + demoted_users
-            target_groups = shuffle_users_by_activity(combined, GROUP_SIZE)
-            demoted_ids = {u["userID"] for u in demoted_users}
-            for g_idx, group in enumerate(target_groups):
-                for user in group:
-                    if user["userID"] in demoted_ids:
-                        all_updates.append({"user_id": user["userID"], "tier_id": tier_id - 1, "group_id": g_idx})
-                        print(f"Demoting {user.get('username','Player')} to {TIERS[tier_id - 1]['name']}")
-
-    # Apply all updates
-    if all_updates:
-        print(f"Applying {len(all_updates)} updates...")
-        batch_update_users(all_updates)
-        print("Tier rotation and shuffling completed successfully!")
+    if args.rolling:
+        rolling_rotation(args.shard_by, args.shards, args.shards_per_run, args.cycle)
     else:
-        print("No updates needed.")
+        rotate_tiers()
 
 
 if __name__ == "__main__":
-    rotate_tiers()
+    main()
@@ -2,14 +2,51 @@
 # FastAPI routes for leaderboard features (tiered + friends).
 # Verifies the caller's Firebase ID token and forwards to the existing
 # business logic functions in ATutor/leaderboard.py.
+#
+# Leaderboard screens are polled often, so Firestore results are kept in a short-TTL
+# in-process cache (stale-while-revalidate, single-flight per key):
+#   ("user", uid)                      → the caller's tier/group/friends
+#   ("group", tierID, groupID)         → the group's snapshot document
+#   ("friends", uid, friend-set hash)  → the friends' leaderboard rows
+#
+# Live boards: instead of polling, the app can open
+#   WS /leaderboard/live?scopes=group,friends     (Authorization: Bearer <ID_TOKEN>, or a first
+#                                                  message {"type": "auth", "token": "<ID_TOKEN>"})
+# and receive a snapshot on connect followed by rank deltas (see leaderboard_live.py).
+# Tokens never go in the URL, where proxies and access logs would keep them.
+#
+# Env:
+#   LEADERBOARD_CACHE_TTL_SECONDS     serve from memory without re-reading (default 15; 0 disables)
+#   LEADERBOARD_CACHE_STALE_SECONDS   then serve stale while refreshing in the background (default 60)
+#   LEADERBOARD_LIVE_AUTH_SECONDS     time a socket without an Authorization header has to send its
+#                                     auth message (default 10)
 
-from typing import Any, Dict, List, Union
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect, status
 
-from auth_utils import require_user_id
-from constants import TIERS, GROUP_SIZE
-from leaderboard import tiered_leaderboard_desc, get_friend_leaderboard_desc
+from auth_utils import require_user_id, verify_request_and_get_uid
+from constants import TIERS, tier_name_for
+from leaderboard import (
+    MAX_AROUND,
+    MAX_WINDOW_LIMIT,
+    decode_cursor,
+    fetch_user_rows,
+    friend_board_items,
+    group_board_items,
+    read_user_placement,
+    snapshot_has_member,
+    tier_window,
+    window_items,
+)
+from leaderboard_live import SCOPES, LeaderboardHub, TooManyConnections, UnknownUser
+from leaderboard_snapshots import get_group_snapshot
+from swr_cache import SWRCache
 from utils import FirebaseManager
 
 router = APIRouter(prefix="/leaderboard", tags=["leaderboard"])
@@ -17,40 +54,96 @@ router = APIRouter(prefix="/leaderboard", tags=["leaderboard"])
 # Use the existing Firebase singleton to get a Firestore client on demand.
 _firebase_manager = FirebaseManager()
 
+_cache = SWRCache(
+    ttl_seconds=float(os.getenv("LEADERBOARD_CACHE_TTL_SECONDS", "15")),
+    stale_seconds=float(os.getenv("LEADERBOARD_CACHE_STALE_SECONDS", "60")),
+    name="leaderboard-cache",
+)
 
-def _normalize_result(result: Union[List[Dict[str, Any]], Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """
-    Your leaderboard.py functions usually return a list on success,
-    but may return {"status": "error", "message": "..."} on failure.
-    Normalize to a list or raise an HTTP error.
-    """
-    if isinstance(result, list):
-        return result
-    if isinstance(result, dict) and result.get("status") == "error":
-        msg = result.get("message", "Unknown error")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=msg)
-    # Unexpected shape
-    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Unexpected leaderboard response")
+
+_live = LeaderboardHub(get_db=_firebase_manager.get_db_client)
+_LIVE_AUTH_SECONDS = float(os.getenv("LEADERBOARD_LIVE_AUTH_SECONDS", "10"))
+
+
+def leaderboard_cache_stats() -> Dict[str, int]:
+    return _cache.stats()
+
+
+def live_leaderboard_stats() -> Dict[str, int]:
+    return _live.stats()
+
+
+def publish_member_change(user_id: str, total_xp: Optional[int] = None, username: Optional[str] = None) -> None:
+    """Push a committed XP/username change to live boards (in-process change stream)."""
+    _live.member_changed(user_id, total_xp=total_xp, username=username)
+
+
+def start_live_leaderboards() -> None:
+    _live.start()
+
+
+async def stop_live_leaderboards() -> None:
+    await _live.stop()
+
+
+async def _placement(db, user_id: str) -> Optional[Dict[str, Any]]:
+    return await _cache.get(("user", user_id), lambda: read_user_placement(db, user_id))
+
+
+def _friend_set_hash(friend_ids: List[str]) -> str:
+    return hashlib.sha1("\x1f".join(sorted(friend_ids)).encode("utf-8")).hexdigest()[:16]
+
+
+async def _group_snapshot(db, me: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    tier_id, group_id = me["tierID"], me["groupID"]
+    key = ("group", tier_id, group_id)
+    snapshot = await _cache.get(key, lambda: get_group_snapshot(db, tier_id, group_id))
+    if not snapshot_has_member(snapshot, user_id):
+        # Newly placed in this group since the snapshot was taken; refresh it once for everyone
+        snapshot = await _cache.refresh(key, lambda: get_group_snapshot(db, tier_id, group_id, user_id=user_id))
+    return snapshot
+
+
+async def _friend_rows(db, me: Dict[str, Any], user_id: str) -> Dict[str, Dict[str, Any]]:
+    friend_ids = sorted(set(me["friends"]) | {user_id})
+    return await _cache.get(
+        ("friends", user_id, _friend_set_hash(friend_ids)),
+        lambda: fetch_user_rows(db, friend_ids),
+    )
 
 
 @router.post("/tiered")
-async def tiered_leaderboard(user_id: str = Depends(require_user_id)) -> Dict[str, Any]:
+async def tiered_leaderboard(
+    user_id: str = Depends(require_user_id),
+    version: Optional[int] = Query(default=None, description="Snapshot version the client already has"),
+) -> Dict[str, Any]:
     """
     Return the caller's tier+group leaderboard:
     {
       "items": [
         {"rank": 1, "username": "...", "totalXP": 1234, "tierName": "Banana", "isCurrentUser": false},
         ...
-      ]
+      ],
+      "version": 17
     }
+    If `?version=` matches the current snapshot, returns {"unchanged": true, "version": 17} instead.
     """
-    class _Req:
-        def __init__(self, uid: str) -> None:
-            self.user_id = uid
+    try:
+        db = _firebase_manager.get_db_client()
+        me = await _placement(db, user_id)
+        if me is None:
+            return {"items": [], "version": 0}
+        tier_id = me["tierID"]
+        snapshot = await _group_snapshot(db, me, user_id)
+    except Exception as e:
+        logging.error(f"Leaderboard (tiered) query failed: {e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database operation failed")
 
-    result = tiered_leaderboard_desc(_Req(user_id), TIERS, GROUP_SIZE, _firebase_manager)
-    items = _normalize_result(result)
-    return {"items": items}
+    snapshot_version = int(snapshot.get("version") or 0)
+    if version is not None and version == snapshot_version:
+        return {"unchanged": True, "version": snapshot_version}
+    items = group_board_items(snapshot, tier_name_for(tier_id), user_id)
+    return {"items": items, "version": snapshot_version}
 
 
 @router.post("/friends")
@@ -64,10 +157,144 @@ async def friends_leaderboard(user_id: str = Depends(require_user_id)) -> Dict[s
       ]
     }
     """
-    class _Req:
-        def __init__(self, uid: str) -> None:
-            self.user_id = uid
+    try:
+        db = _firebase_manager.get_db_client()
+        me = await _placement(db, user_id)
+        if me is None:
+            return {"items": []}
+
+        rows = await _friend_rows(db, me, user_id)
+    except Exception as e:
+        logging.error(f"Leaderboard (friends) query failed: {e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database operation failed")
+
+    return {"items": friend_board_items(rows, TIERS, user_id)}
+
+
+@router.post("/window")
+async def windowed_leaderboard(
+    user_id: str = Depends(require_user_id),
+    scope: str = Query(default="group", pattern="^(group|friends|tier)$"),
+    limit: int = Query(default=10, ge=1, le=MAX_WINDOW_LIMIT),
+    cursor: Optional[str] = Query(default=None, description="nextCursor from the previous page"),
+    around: int = Query(default=0, ge=0, le=MAX_AROUND, description="Rows to include above and below the caller"),
+) -> Dict[str, Any]:
+    """
+    Bounded leaderboard window — "top `limit` plus `around` either side of me":
+    {
+      "items":  [...one page of ranked rows...],
+      "around": [...rows around the caller, caller included...],
+      "me":     {"rank": 42, "totalXP": 1234} | null,
+      "total":  250,
+      "nextCursor": "..." | null
+    }
+    scope=group|friends window the (cached) group snapshot / friends board;
+    scope=tier pages through the caller's whole tier with limited queries + count aggregations.
+    """
+    try:
+        decode_cursor(cursor, scope)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    try:
+        db = _firebase_manager.get_db_client()
+        me = await _placement(db, user_id)
+        if me is None:
+            return {"items": [], "around": [], "me": None, "total": 0, "nextCursor": None}
+
+        if scope == "tier":
+            return await asyncio.to_thread(tier_window, db, TIERS, user_id, me["tierID"], limit, cursor, around)
+        if scope == "friends":
+            items = friend_board_items(await _friend_rows(db, me, user_id), TIERS, user_id)
+        else:
+            items = group_board_items(await _group_snapshot(db, me, user_id), tier_name_for(me["tierID"]), user_id)
+    except Exception as e:
+        logging.error(f"Leaderboard ({scope} window) query failed: {e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database operation failed")
+
+    return window_items(items, limit, cursor, around)
+
+
+async def _receive_message(websocket: WebSocket) -> Any:
+    """Next client frame, decoded as JSON. ValueError for binary or non-JSON frames."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+    text = message.get("text")
+    if text is None:
+        raise ValueError("binary frame")
+    return json.loads(text)  # json.JSONDecodeError is a ValueError
+
+
+@router.websocket("/live")
+async def live_leaderboard(
+    websocket: WebSocket,
+    scopes: str = Query(default="group,friends", description="Comma-separated: group, friends"),
+) -> None:
+    """
+    Live group/friends boards: a {"type": "snapshot"} per scope on connect, then {"type": "delta"}
+    messages as ranks change. Clients that cannot set an Authorization header send
+    {"type": "auth", "token": "<ID_TOKEN>"} as their first message. Send {"type": "resync"} for
+    fresh snapshots; {"type": "ping"} is answered with {"type": "pong"}. Close codes: 1003 non-JSON
+    frame, 1008 unauthorised, 1013 try again later, 4404 no profile.
+    """
+    await websocket.accept()
+    authorization = websocket.headers.get("authorization")
+    if not authorization:
+        try:
+            message = await asyncio.wait_for(_receive_message(websocket), _LIVE_AUTH_SECONDS)
+        except WebSocketDisconnect:
+            return
+        except (ValueError, asyncio.TimeoutError):
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+        if isinstance(message, dict) and message.get("type") == "auth" and isinstance(message.get("token"), str):
+            authorization = f"Bearer {message['token']}"
+    try:
+        user_id = verify_request_and_get_uid(authorization)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    wanted = [s for s in scopes.split(",") if s in SCOPES] or list(SCOPES)
+
+    try:
+        sub = await _live.subscribe(user_id, wanted)
+    except UnknownUser:
+        await websocket.close(code=4404)
+        return
+    except TooManyConnections:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    except Exception as e:
+        logging.error(f"Live leaderboard subscribe failed: {e}")
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        return
+
+    async def receive() -> None:
+        while True:
+            try:
+                message = await _receive_message(websocket)
+            except ValueError:
+                await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+                return
+            kind = message.get("type") if isinstance(message, dict) else None
+            if kind == "resync":
+                sub.request_resync()
+            elif kind == "ping":
+                sub.push({"type": "pong"})  # through the outbox: one writer per socket
 
-    result = get_friend_leaderboard_desc(_Req(user_id), TIERS, GROUP_SIZE, _firebase_manager)
-    items = _normalize_result(result)
-    return {"items": items}
+    receiver = asyncio.create_task(receive())
+    try:
+        while not receiver.done():
+            next_message = asyncio.create_task(sub.next_message())
+            await asyncio.wait({next_message, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_message.done():
+                next_message.cancel()
+                break
+            await websocket.send_json(next_message.result())
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        _live.unsubscribe(sub)  # before awaiting, so a cancelled handler still leaves its channels
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
@@ -0,0 +1,225 @@
+# ATutor/leaderboard_snapshots.py
+# Materialised per-(tier, group) leaderboard snapshots.
+#
+# Instead of every member of a group re-running the same
+#   where(tierID) / where(groupID) / order_by(totalXP)
+# query, each group has one document holding its ranked member rows:
+#
+#   leaderboardSnapshots/{tierID}_{groupID} = {
+#       "tierID": 2, "groupID": 3,
+#       "version": 17,                       # bumped on every change; clients send it back to skip unchanged boards
+#       "updatedAt": <server timestamp>,
+#       "members": [{"userID": "...", "username": "...", "totalXP": 1234}, ...]   # totalXP desc
+#   }
+#
+# • leaderboard_refresh rebuilds every snapshot after a rotation (rebuild_snapshots).
+# • XP / username changes patch a single row in a transaction (apply_member_update).
+# • A missing or stale snapshot (caller not in it, or older than the max age) is rebuilt from
+#   the query on first read. The max age covers XP the app still writes straight to users/{uid};
+#   an age-based rebuild that finds the same rows only refreshes updatedAt, not the version.
+#
+# A group is at most GROUP_SIZE users, so a snapshot stays far below the 1 MiB document limit.
+#
+# Env:
+#   LEADERBOARD_SNAPSHOT_MAX_AGE_SECONDS   rebuild snapshots older than this on read (default 300; 0 = never)
+
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from firebase_admin import firestore
+
+SNAPSHOT_COLLECTION = "leaderboardSnapshots"
+SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv("LEADERBOARD_SNAPSHOT_MAX_AGE_SECONDS", "300"))
+
+# Firestore batches are limited to 500 writes
+_BATCH_LIMIT = 500
+
+
+def _safe_str(v: Any, default: str = "") -> str:
+    return str(v).strip() if isinstance(v, str) else default
+
+
+def _safe_int(v: Any, default: int = 0) -> int:
+    try:
+        return int(v)
+    except Exception:
+        return default
+
+
+def snapshot_id(tier_id: int, group_id: int) -> str:
+    return f"{int(tier_id)}_{int(group_id)}"
+
+
+def snapshot_ref(db, tier_id: int, group_id: int):
+    return db.collection(SNAPSHOT_COLLECTION).document(snapshot_id(tier_id, group_id))
+
+
+def member_row(user_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """The compact row stored per member."""
+    return {
+        "userID": _safe_str(data.get("userID")) or user_id,
+        "username": _safe_str(data.get("username"), "Player"),
+        "totalXP": _safe_int(data.get("totalXP"), 0),
+    }
+
+
+def rank_members(members: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # XP desc; ties broken by userID so every reader sees the same order
+    return sorted(members, key=lambda m: (-_safe_int(m.get("totalXP"), 0), _safe_str(m.get("userID"))))
+
+
+def snapshot_payload(tier_id: int, group_id: int, members: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    # Always written with merge=True: a plain set() would replace the document and restart the version at 1
+    return {
+        "tierID": int(tier_id),
+        "groupID": int(group_id),
+        "members": rank_members(members),
+        "version": firestore.Increment(1),
+        "updatedAt": firestore.SERVER_TIMESTAMP,
+    }
+
+
+# ======= Reads =======
+
+def read_snapshot(db, tier_id: int, group_id: int) -> Optional[Dict[str, Any]]:
+    doc = snapshot_ref(db, tier_id, group_id).get()
+    if not doc.exists:
+        return None
+    return doc.to_dict() or {}
+
+
+def rebuild_group_snapshot(db, tier_id: int, group_id: int, current: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Re-materialise one group from the users collection; returns the stored snapshot.
+    `current` is the stored snapshot, if any: when its rows are unchanged only updatedAt is
+    refreshed, so the version (and the clients' cached boards) stay valid.
+    """
+    users = (
+        db.collection("users")
+        .where("tierID", "==", int(tier_id))
+        .where("groupID", "==", int(group_id))
+        .select(["userID", "username", "totalXP"])
+        .get()
+    )
+    members = [member_row(doc.id, doc.to_dict() or {}) for doc in users]
+    ref = snapshot_ref(db, tier_id, group_id)
+    if current is not None and current.get("members") == rank_members(members):
+        ref.update({"updatedAt": firestore.SERVER_TIMESTAMP})
+        return {**current, "updatedAt": datetime.now(timezone.utc)}
+    ref.set(snapshot_payload(tier_id, group_id, members), merge=True)
+    logging.info(f"Leaderboard snapshot {snapshot_id(tier_id, group_id)} rebuilt with {len(members)} members")
+    return ref.get().to_dict() or {}
+
+
+def _is_expired(snap: Dict[str, Any]) -> bool:
+    if SNAPSHOT_MAX_AGE_SECONDS <= 0:
+        return False
+    updated_at = snap.get("updatedAt")
+    if not isinstance(updated_at, datetime):
+        return True
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - updated_at).total_seconds() > SNAPSHOT_MAX_AGE_SECONDS
+
+
+def get_group_snapshot(db, tier_id: int, group_id: int, user_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    The group's snapshot (one document read). Rebuilt on the spot if it does not exist yet,
+    has expired, or does not contain `user_id` (e.g. a user who joined since the last rotation).
+    """
+    snap = read_snapshot(db, tier_id, group_id)
+    if snap is not None and not _is_expired(snap) and (
+        not user_id or any(_safe_str(m.get("userID")) == user_id for m in snap.get("members") or [])
+    ):
+        return snap
+    return rebuild_group_snapshot(db, tier_id, group_id, current=snap)
+
+
+# ======= Incremental updates =======
+
+def _apply_member_update(transaction, db, tier_id: int, group_id: int, user_id: str, fields: Dict[str, Any]) -> None:
+    ref = snapshot_ref(db, tier_id, group_id)
+    doc = ref.get(transaction=transaction)
+    if not doc.exists:
+        return  # materialised lazily on first read
+    members = list((doc.to_dict() or {}).get("members") or [])
+    for m in members:
+        if _safe_str(m.get("userID")) == user_id:
+            if all(m.get(k) == v for k, v in fields.items()):
+                return  # nothing changed; keep the version
+            m.update(fields)
+            break
+    else:
+        members.append(member_row(user_id, fields))
+    transaction.set(ref, snapshot_payload(tier_id, group_id, members), merge=True)
+
+
+def apply_member_update(
+    db,
+    tier_id: int,
+    group_id: int,
+    user_id: str,
+    total_xp: Optional[int] = None,
+    username: Optional[str] = None,
+    transaction=None,
+) -> None:
+    """
+    Patch one member's row (XP and/or username) and bump the snapshot version.
+    Pass `transaction` to make the patch part of a larger transaction (the caller must
+    not have written yet — Firestore requires all reads before writes).
+    """
+    fields: Dict[str, Any] = {}
+    if total_xp is not None:
+        fields["totalXP"] = _safe_int(total_xp, 0)
+    if username is not None:
+        fields["username"] = _safe_str(username, "Player")
+    if not fields:
+        return
+
+    if transaction is not None:
+        _apply_member_update(transaction, db, tier_id, group_id, user_id, fields)
+        return
+
+    @firestore.transactional
+    def run(txn) -> None:
+        _apply_member_update(txn, db, tier_id, group_id, user_id, fields)
+
+    try:
+        run(db.transaction())
+    except Exception as e:
+        # The snapshot is derived data; a failed patch is repaired by the next rebuild
+        logging.warning(f"Leaderboard snapshot {snapshot_id(tier_id, group_id)} update failed: {e}")
+
+
+# ======= Bulk rebuild (leaderboard_refresh) =======
+
+def rebuild_snapshots(db, assignments: Iterable[Dict[str, Any]]) -> int:
+    """
+    Write fresh snapshots for every (tier, group) in `assignments` and delete snapshots of
+    groups that no longer exist. Each assignment needs userID, username, totalXP, tierID, groupID.
+    Returns the number of snapshot documents written.
+    """
+    groups: Dict[Tuple[int, int], List[Dict[str, Any]]] = defaultdict(list)
+    for a in assignments:
+        key = (_safe_int(a.get("tierID"), 0), _safe_int(a.get("groupID"), 0))
+        groups[key].append(member_row(_safe_str(a.get("userID")), a))
+
+    live_ids = {snapshot_id(t, g) for t, g in groups}
+    stale = [doc.reference for doc in db.collection(SNAPSHOT_COLLECTION).select([]).stream() if doc.id not in live_ids]
+
+    ops = [("set", snapshot_ref(db, t, g), snapshot_payload(t, g, members)) for (t, g), members in groups.items()]
+    ops += [("delete", ref, None) for ref in stale]
+    for i in range(0, len(ops), _BATCH_LIMIT):
+        batch = db.batch()
+        for op, ref, data in ops[i:i + _BATCH_LIMIT]:
+            if op == "set":
+                batch.set(ref, data, merge=True)
+            else:
+                batch.delete(ref)
+        batch.commit()
+
+    logging.info(f"Leaderboard snapshots rebuilt: {len(groups)} written, {len(stale)} stale removed")
+    return len(groups)
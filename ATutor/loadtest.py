@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# ATutor/loadtest.py
+# Offline load test for the ATutor API: no real Firebase, Mathpix or Gemini needed.
+#
+# The harness starts
+#   • loadtest_fakes.py   — fake Mathpix + Gemini with configurable latency distributions
+#   • server.py (uvicorn) — pointed at the fakes (MATHPIX_API_URL / GEMINI_API_ENDPOINT) and at the
+#                           Firestore emulator, accepting emulator-issued (unsigned) ID tokens
+# seeds bot users into the emulator (seed_bots.py population mode, deterministic ids), then runs
+# virtual users through scripted journeys at the chosen concurrency:
+#   analyse       POST /analyse-work
+#   stuck         POST /stuck-at-question
+#   chat          POST /chat
+#   stream        POST /analyse-work-stream + POST /chat-stream (first byte recorded separately)
+#   leaderboards  POST /leaderboard/tiered (+ ?version= revalidation), /friends, /window
+#   profile       GET /users/me (+ If-None-Match revalidation), occasionally PATCH /users/me
+#
+# It reports client-side latency percentiles and status codes per endpoint, the server's own
+# per-stage timings, and event-loop lag from GET /metrics — a blocking call creeping onto the
+# event loop shows up as loop lag and as p99s that grow with concurrency.
+#
+# Usage (from ATutor/):
+#   firebase emulators:start --only firestore        # from the repo root; not needed for tutor-only journeys
+#   python loadtest.py --concurrency 50 --duration 60
+#   python loadtest.py --journeys analyse=3,stream=1 --concurrency 200 --gemini-latency lognormal:2500:0.6
+#   python loadtest.py --server-url http://127.0.0.1:8000 ...   # measure a server you started yourself
+#   python loadtest.py ... --fail-on-loop-lag 50                 # exit 1 if server loop lag p99 > 50 ms (CI)
+
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from loadtest_fakes import latency_spec
+from seed_bots import population_bot_id
+
+BOT_PREFIX = "Load"
+PROJECT_ID = "demo-atutor"
+
+JOURNEYS = ("analyse", "stuck", "chat", "stream", "leaderboards", "profile")
+# Journeys that read Firestore (and need the emulator + seeded users)
+FIRESTORE_JOURNEYS = {"leaderboards", "profile"}
+DEFAULT_MIX = "analyse=3,stuck=1,chat=2,stream=2,leaderboards=3,profile=2"
+
+_QUESTION = {
+    "question_stem": "Solve the quadratic equation.",
+    "question_part": "Find all real x with x^2 - 4 = 0.",
+    "solution_text": "x^2 = 4, so x = 2 or x = -2.",
+}
+
+
+# ======= Recording =======
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))]
+
+
+class Recorder:
+    """Latencies and status codes per endpoint, shared by all virtual users."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[float]] = defaultdict(list)
+        self._statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.total = 0
+
+    def record(self, name: str, seconds: float, status: Any) -> None:
+        with self._lock:
+            self._samples[name].append(seconds)
+            self._statuses[name][str(status)] += 1
+            self.total += 1
+
+    def rows(self, elapsed: float) -> List[Dict[str, Any]]:
+        with self._lock:
+            samples = {k: sorted(v) for k, v in self._samples.items()}
+            statuses = {k: dict(v) for k, v in self._statuses.items()}
+        rows = []
+        for name in sorted(samples):
+            values = samples[name]
+            codes = statuses.get(name, {})
+            rows.append({
+                "endpoint": name,
+                "count": len(values),
+                "rps": round(len(values) / max(elapsed, 1e-6), 1),
+                "errors": sum(n for code, n in codes.items() if not code.startswith(("2", "3"))),
+                "statuses": codes,
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1) if values else 0.0,
+            })
+        return rows
+
+
+# ======= Fixtures =======
+
+def emulator_token(uid: str, project_id: str = PROJECT_ID) -> str:
+    """Unsigned ID token as the Auth emulator issues them (accepted when FIREBASE_AUTH_EMULATOR_HOST is set)."""
+    def b64(obj: Dict[str, Any]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(obj).encode("utf-8")).rstrip(b"=").decode("ascii")
+
+    now = int(time.time())
+    claims = {
+        "iss": f"https://securetoken.google.com/{project_id}",
+        "aud": project_id,
+        "sub": uid,
+        "user_id": uid,
+        "email": f"{uid}@loadtest.invalid",
+        "iat": now,
+        "auth_time": now,
+        "exp": now + 3600,
+        "firebase": {"sign_in_provider": "password", "identities": {}},
+    }
+    return f"{b64({'alg': 'none', 'typ': 'JWT'})}.{b64(claims)}."
+
+
+def make_images(count: int, seed: int) -> List[str]:
+    """Distinct small "photos" of handwriting-like strokes, as base64 JPEGs."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        img = Image.new("L", (1200, 900), 235)
+        draw = ImageDraw.Draw(img)
+        for _ in range(rng.randint(15, 40)):
+            x, y = rng.randint(100, 1000), rng.randint(100, 750)
+            draw.line([(x, y), (x + rng.randint(20, 150), y + rng.randint(-30, 30))], fill=rng.randint(0, 60), width=4)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85)
+        images.append(base64.b64encode(buf.getvalue()).decode("ascii"))
+    return images
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for part in value.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in JOURNEYS:
+            raise argparse.ArgumentTypeError(f"Unknown journey {name!r}; choose from {', '.join(JOURNEYS)}")
+        try:
+            mix[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Bad weight for {name!r}: {weight!r}")
+    return mix
+
+
+# ======= Virtual users =======
+
+class VirtualUser:
+    def __init__(self, base_url: str, uid: Optional[str], images: List[str], rng: random.Random,
+                 recorder: Recorder, vision_mode: Optional[str], bypass_cache: bool) -> None:
+        self._base = base_url.rstrip("/")
+        self._session = requests.Session()
+        self._auth = {"Authorization": f"Bearer {emulator_token(uid)}"} if uid else {}
+        self._images = images
+        self._rng = rng
+        self._recorder = recorder
+        self._vision_mode = vision_mode
+        self._bypass_cache = bypass_cache
+        self._profile_etag: Optional[str] = None
+        self._board_version: Optional[int] = None
+
+    def _call(self, method: str, path: str, name: Optional[str] = None, stream: bool = False,
+              auth: bool = False, **kwargs) -> Optional[requests.Response]:
+        name = name or f"{method} {path.split('?')[0]}"
+        headers = dict(kwargs.pop("headers", {}))
+        if auth:
+            headers.update(self._auth)
+        start = time.perf_counter()
+        try:
+            resp = self._session.request(method, self._base + path, headers=headers, stream=stream, timeout=120, **kwargs)
+            if stream:
+                first = True
+                for _chunk in resp.iter_content(chunk_size=None):
+                    if first:
+                        self._recorder.record(f"{name} (first byte)", time.perf_counter() - start, resp.status_code)
+                        first = False
+            else:
+                resp.content  # read the body inside the measurement
+        except requests.RequestException as e:
+            self._recorder.record(name, time.perf_counter() - start, type(e).__name__)
+            return None
+        self._recorder.record(name, time.perf_counter() - start, resp.status_code)
+        return resp
+
+    def _tutor_body(self) -> Dict[str, Any]:
+        body: Dict[str, Any] = {
+            **_QUESTION,
+            "image_data": self._rng.choice(self._images),
+            "question_id": "loadtest_q1",
+            "bypass_cache": self._bypass_cache,
+        }
+        if self._vision_mode:
+            body["vision_mode"] = self._vision_mode
+        return body
+
+    def _chat_body(self) -> Dict[str, Any]:
+        history = [
+            {"text": "I got x = 2, is that it?", "is_user": True},
+            {"text": "Good — is that the only solution?", "is_user": False},
+            {"text": "Maybe x = -2 as well?", "is_user": True},
+        ]
+        return {**_QUESTION, "student_work": "x^2 = 4, x = 2", "conversation_history": history}
+
+    # --- journeys ---
+
+    def analyse(self) -> None:
+        self._call("POST", "/analyse-work", json=self._tutor_body())
+
+    def stuck(self) -> None:
+        self._call("POST", "/stuck-at-question", json=self._tutor_body())
+
+    def chat(self) -> None:
+        self._call("POST", "/chat", json=self._chat_body())
+
+    def stream(self) -> None:
+        self._call("POST", "/analyse-work-stream", stream=True, json=self._tutor_body())
+        self._call("POST", "/chat-stream", stream=True, json=self._chat_body())
+
+    def leaderboards(self) -> None:
+        resp = self._call("POST", "/leaderboard/tiered", auth=True)
+        if resp is not None and resp.ok:
+            self._board_version = resp.json().get("version")
+        if self._board_version is not None:
+            self._call("POST", f"/leaderboard/tiered?version={self._board_version}",
+                       name="POST /leaderboard/tiered (revalidate)", auth=True)
+        self._call("POST", "/leaderboard/friends", auth=True)
+        self._call("POST", "/leaderboard/window?scope=group&limit=10&around=2", auth=True)
+
+    def profile(self) -> None:
+        headers = {"If-None-Match": self._profile_etag} if self._profile_etag else {}
+        name = "GET /users/me (revalidate)" if self._profile_etag else None
+        resp = self._call("GET", "/users/me", name=name, auth=True, headers=headers)
+        if resp is not None and resp.status_code == 200:
+            self._profile_etag = resp.headers.get("ETag")
+        if self._rng.random() < 0.1:
+            resp = self._call("PATCH", "/users/me", auth=True,
+                              json={"displayName": f"Load {self._rng.randrange(10 ** 6)}"})
+            if resp is not None and resp.ok:
+                self._profile_etag = resp.headers.get("ETag")
+
+
+def run_load(base_url: str, mix: Dict[str, float], concurrency: int, duration: float, ramp_up: float,
+             users: int, images: List[str], seed: int, vision_mode: Optional[str], bypass_cache: bool,
+             think_seconds: float) -> Tuple[Recorder, float]:
+    recorder = Recorder()
+    names, weights = list(mix), list(mix.values())
+    deadline = time.monotonic() + ramp_up + duration
+    uses_firestore = bool(FIRESTORE_JOURNEYS & set(mix))
+
+    def worker(index: int) -> None:
+        time.sleep(ramp_up * index / max(1, concurrency))
+        rng = random.Random(seed * 1_000_003 + index)
+        uid = population_bot_id(BOT_PREFIX, index % users) if uses_firestore else None
+        vu = VirtualUser(base_url, uid, images, rng, recorder, vision_mode, bypass_cache)
+        while time.monotonic() < deadline:
+            getattr(vu, rng.choices(names, weights=weights)[0])()
+            if think_seconds:
+                time.sleep(rng.expovariate(1 / think_seconds))
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    last_total, last_time = 0, started
+    while any(t.is_alive() for t in threads):
+        time.sleep(1)
+        now = time.monotonic()
+        if now - last_time >= 10:
+            print(f"[loadtest] {now - started:5.0f}s  {recorder.total} requests  "
+                  f"{(recorder.total - last_total) / (now - last_time):.1f} req/s")
+            last_total, last_time = recorder.total, now
+    return recorder, max(1e-6, time.monotonic() - started - ramp_up)
+
+
+# ======= Processes =======
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _reachable(host_port: str) -> bool:
+    host, _, port = host_port.rpartition(":")
+    try:
+        with socket.create_connection((host or "127.0.0.1", int(port)), timeout=1):
+            return True
+    except (OSError, ValueError):
+        return False
+
+
+def _wait_ready(url: str, proc: subprocess.Popen, name: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{name} exited with code {proc.returncode} before becoming ready")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{name} did not become ready within {timeout:.0f}s")
+
+
+def seed_users(firestore_host: str, users: int, seed: int) -> None:
+    import seed_bots
+    from constants import TIERS
+
+    seed_bots.init_db()
+    first = seed_bots.DB.collection("users").document(seed_bots.population_bot_id(BOT_PREFIX, 0)).get()
+    if first.exists:
+        print(f"[loadtest] Emulator at {firestore_host} already has {BOT_PREFIX} bots; not reseeding.")
+        return
+    weights = [float(w) for w in seed_bots.DEFAULT_TIER_WEIGHTS.split(",")][:len(TIERS)]
+    seed_bots.seed_population(users, seed, BOT_PREFIX, weights, friends_shape="random", avg_friends=10)
+
+
+def _print_report(rows: List[Dict[str, Any]], elapsed: float, server_metrics: Optional[Dict[str, Any]],
+                  upstream_calls: Optional[Dict[str, int]]) -> None:
+    total = sum(r["count"] for r in rows if not r["endpoint"].endswith("(first byte)"))
+    print(f"\n[loadtest] {total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)\n")
+    width = max([len(r["endpoint"]) for r in rows] + [8])
+    print(f"{'endpoint':<{width}}  {'count':>6} {'rps':>7} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  statuses")
+    for r in rows:
+        statuses = " ".join(f"{code}:{n}" for code, n in sorted(r["statuses"].items()))
+        print(f"{r['endpoint']:<{width}}  {r['count']:>6} {r['rps']:>7} {r['errors']:>6} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8}  {statuses}")
+
+    if server_metrics:
+        loop = server_metrics.get("event_loop") or {}
+        print(f"\nEvent loop lag (ms): p50 {loop.get('p50_ms')}  p95 {loop.get('p95_ms')}  p99 {loop.get('p99_ms')}  "
+              f"max {loop.get('max_ms')}  stalls>{loop.get('stall_threshold_ms')}ms: {loop.get('stalls')}")
+        print("\nServer stages, p95 ms:")
+        for route, data in sorted((server_metrics.get("routes") or {}).items()):
+            stages = "  ".join(f"{name} {s['p95_ms']}" for name, s in sorted(data["stages"].items()))
+            print(f"  {route}: {stages}")
+    if upstream_calls:
+        print("\nUpstream calls: " + "  ".join(f"{k} {v}" for k, v in sorted(upstream_calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the ATutor API.")
+    parser.add_argument("--concurrency", type=int, default=20, help="Virtual users (default 20)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load after ramp-up (default 30)")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds to start all virtual users (default 5)")
+    parser.add_argument("--think-ms", type=float, default=0, help="Mean pause between journeys (default 0)")
+    parser.add_argument("--journeys", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Journey mix as name=weight,... (default {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for users, images and journey choice (default 1)")
+    parser.add_argument("--users", type=int, default=500, help="Bot users seeded into the emulator (default 500)")
+    parser.add_argument("--images", type=int, default=20, help="Distinct photos sent (default 20)")
+    parser.add_argument("--vision-mode", choices=("ocr", "direct", "race"), help="Override the server's vision mode")
+    parser.add_argument("--bypass-cache", action="store_true", help="Ask the server to skip its response cache")
+
+    env = parser.add_argument_group("environment")
+    env.add_argument("--server-url", help="Use this running server instead of starting one (fakes/seeding are up to you)")
+    env.add_argument("--server-workers", type=int, default=1, help="uvicorn workers (default 1; /metrics covers one)")
+    env.add_argument("--firestore-emulator", default=os.getenv("FIRESTORE_EMULATOR_HOST", "127.0.0.1:8080"),
+                     help="Firestore emulator host:port (default $FIRESTORE_EMULATOR_HOST or 127.0.0.1:8080)")
+    env.add_argument("--no-seed", action="store_true", help="Don't seed bot users")
+
+    fakes = parser.add_argument_group("fake upstreams")
+    fakes.add_argument("--mathpix-latency", type=latency_spec, default=latency_spec("lognormal:600:0.4"),
+                       help="fixed:MS | uniform:LO:HI | lognormal:MEDIAN:SIGMA (default lognormal:600:0.4)")
+    fakes.add_argument("--gemini-latency", type=latency_spec, default=latency_spec("lognormal:1800:0.5"),
+                       help="Time to first token (default lognormal:1800:0.5)")
+    fakes.add_argument("--gemini-chunk-ms", type=float, default=50, help="Gap between streamed chunks (default 50)")
+    fakes.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream calls that fail (default 0)")
+
+    parser.add_argument("--report-json", help="Also write the report to this file")
+    parser.add_argument("--fail-on-loop-lag", type=float, metavar="MS",
+                        help="Exit 1 if the server's event-loop lag p99 exceeds this")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    mix = args.journeys
+    uses_firestore = bool(FIRESTORE_JOURNEYS & set(mix))
+    processes: List[subprocess.Popen] = []
+    fakes_url: Optional[str] = None
+
+    try:
+        base_url = args.server_url
+        if base_url is None:
+            if uses_firestore and not _reachable(args.firestore_emulator):
+                sys.exit(
+                    f"[loadtest] No Firestore emulator at {args.firestore_emulator} "
+                    f"(needed for {', '.join(sorted(FIRESTORE_JOURNEYS & set(mix)))}). "
+                    "Start it with `firebase emulators:start --only firestore`, or drop those journeys."
+                )
+            emulator_env = {
+                "FIRESTORE_EMULATOR_HOST": args.firestore_emulator,
+                "FIREBASE_AUTH_EMULATOR_HOST": os.getenv("FIREBASE_AUTH_EMULATOR_HOST", "127.0.0.1:9099"),
+                "project_id": PROJECT_ID,
+                "GOOGLE_CLOUD_PROJECT": PROJECT_ID,
+            }
+            os.environ.update(emulator_env)
+            if uses_firestore and not args.no_seed:
+                seed_users(args.firestore_emulator, args.users, args.seed)
+
+            fakes_port = _free_port()
+            fakes_url = f"http://127.0.0.1:{fakes_port}"
+            fakes_cmd = [
+                sys.executable, os.path.join(here, "loadtest_fakes.py"), "--port", str(fakes_port),
+                "--mathpix-latency", args.mathpix_latency.spec, "--gemini-latency", args.gemini_latency.spec,
+                "--gemini-chunk-ms", str(args.gemini_chunk_ms), "--error-rate", str(args.error_rate),
+            ]
+            processes.append(subprocess.Popen(fakes_cmd, cwd=here))
+            _wait_ready(f"{fakes_url}/stats", processes[-1], "fake upstreams")
+
+            server_port = _free_port()
+            base_url = f"http://127.0.0.1:{server_port}"
+            server_env = {
+                **os.environ,
+                **emulator_env,
+                "MATHPIX_API_URL": f"{fakes_url}/v3/text",
+                "MATHPIX_APP_ID": "loadtest",
+                "MATHPIX_APP_KEY": "loadtest",
+                "GEMINI_API_ENDPOINT": fakes_url,
+                "GOOGLE_API_KEY": "loadtest",
+                "EMAIL_TRANSPORT": "local",
+                "EMAIL_LOCAL_OUTBOX_DIR": tempfile.mkdtemp(prefix="atutor-loadtest-outbox-"),
+                "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+                "LOG_PAYLOAD_SAMPLE_RATE": "0",
+            }
+            server_cmd = [
+                sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(server_port),
+                "--workers", str(args.server_workers), "--log-level", "warning",
+            ]
+            processes.append(subprocess.Popen(server_cmd, cwd=here, env=server_env))
+            _wait_ready(f"{base_url}/metrics", processes[-1], "ATutor server")
+
+        print(f"[loadtest] {args.concurrency} virtual users for {args.duration:.0f}s against {base_url}: "
+              + ", ".join(f"{k}={v:g}" for k, v in mix.items()))
+        images = make_images(args.images, args.seed)
+        recorder, elapsed = run_load(base_url, mix, args.concurrency, args.duration, args.ramp_up, args.users,
+                                     images, args.seed, args.vision_mode, args.bypass_cache, args.think_ms / 1000.0)
+
+        server_metrics = None
+        upstream_calls = None
+        try:
+            server_metrics = requests.get(f"{base_url}/metrics", timeout=10).json()
+            if fakes_url:
+                upstream_calls = requests.get(f"{fakes_url}/stats", timeout=10).json()
+        except requests.RequestException as e:
+            print(f"[loadtest] Could not read server metrics: {e}")
+
+        rows = recorder.rows(elapsed)
+        _print_report(rows, elapsed, server_metrics, upstream_calls)
+        if args.report_json:
+            with open(args.report_json, "w") as f:
+                json.dump({
+                    "config": {k: (v.spec if hasattr(v, "spec") else v) for k, v in vars(args).items()},
+                    "elapsed_seconds": round(elapsed, 2),
+                    "endpoints": rows,
+                    "event_loop": (server_metrics or {}).get("event_loop"),
+                    "server_routes": (server_metrics or {}).get("routes"),
+                    "upstream_calls": upstream_calls,
+                }, f, indent=2)
+            print(f"\n[loadtest] Report written to {args.report_json}")
+
+        if args.fail_on_loop_lag is not None:
+            lag = float(((server_metrics or {}).get("event_loop") or {}).get("p99_ms") or 0.0)
+            if server_metrics is None or lag > args.fail_on_loop_lag:
+                print(f"[loadtest] FAIL: event-loop lag p99 {lag} ms > {args.fail_on_loop_lag} ms")
+                sys.exit(1)
+    finally:
+        for proc in reversed(processes):
+            proc.terminate()
+        for proc in processes:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# ATutor/loadtest_fakes.py
+# Local stand-ins for Mathpix and Gemini, for load tests (see loadtest.py).
+#
+#   python loadtest_fakes.py --port 8790 --mathpix-latency lognormal:600:0.4 --gemini-latency lognormal:1800:0.5
+#
+# Serves:
+#   POST /v3/text                                        → Mathpix: {"text": "...", "confidence": 0.99}
+#   POST /v1beta/models/{model}:generateContent          → Gemini (REST transport)
+#   POST /v1beta/models/{model}:streamGenerateContent    → Gemini stream, chunks spaced by --gemini-chunk-ms
+#   GET  /stats                                          → calls per upstream (to see what the server's caches saved)
+#
+# Replies are shaped like the real ones: JSON tutor verdicts when the request asks for
+# application/json (with a "transcription" when an image is attached), otherwise chat text ending
+# in a [[STATUS: ...]] tag. Latencies are drawn per call from a distribution:
+#   fixed:MS   uniform:LO_MS:HI_MS   lognormal:MEDIAN_MS:SIGMA
+# Point the server at it with MATHPIX_API_URL=http://HOST:PORT/v3/text and
+# GEMINI_API_ENDPOINT=http://HOST:PORT.
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+from collections import Counter
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+class LatencyDistribution:
+    """Parsed latency spec; sample() returns seconds."""
+
+    KINDS = ("fixed", "uniform", "lognormal")
+
+    def __init__(self, spec: str) -> None:
+        kind, *params = spec.strip().lower().split(":")
+        try:
+            values = [float(p) for p in params]
+        except ValueError:
+            raise ValueError(f"Bad latency spec {spec!r}: parameters must be numbers")
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}.get(kind)
+        if expected is None or len(values) != expected:
+            raise ValueError(f"Bad latency spec {spec!r}; use fixed:MS, uniform:LO:HI or lognormal:MEDIAN:SIGMA")
+        self.spec = spec
+        self._kind = kind
+        self._values = values
+
+    def sample(self, rng: random.Random = random) -> float:
+        if self._kind == "fixed":
+            ms = self._values[0]
+        elif self._kind == "uniform":
+            ms = rng.uniform(*self._values)
+        else:
+            median, sigma = self._values
+            ms = median * rng.lognormvariate(0, sigma)
+        return max(0.0, ms) / 1000.0
+
+
+def latency_spec(value: str) -> LatencyDistribution:
+    """argparse type for latency specs."""
+    try:
+        return LatencyDistribution(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+_VERDICTS = ("CORRECT", "INCORRECT", "PARTIAL")
+_FILLER = (
+    "Nice start. You expanded the bracket correctly, but check the sign when you moved the term across. "
+    "Try substituting your answer back into the original equation to see whether both sides agree. "
+)
+
+
+def _digest(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _filler(n_chars: int) -> str:
+    return (_FILLER * (n_chars // len(_FILLER) + 1))[:n_chars].rstrip()
+
+
+def _tutor_reply(seed: int, with_transcription: bool, reply_chars: int) -> str:
+    reply: Dict[str, Any] = {
+        "analysis": _VERDICTS[seed % len(_VERDICTS)],
+        "reason": _filler(reply_chars) + r" Remember \(a^2 - b^2 = (a-b)(a+b)\).",
+        "is_complete": seed % 4 == 0,
+    }
+    if with_transcription:
+        reply["transcription"] = f"x^2 - {seed % 9 + 1} = 0"
+    return json.dumps(reply)
+
+
+def _chat_reply(seed: int, reply_chars: int) -> str:
+    status = "COMPLETE" if seed % 5 == 0 else "CONTINUE"
+    return f"{_filler(reply_chars)}\n[[STATUS: {status}]]"
+
+
+def _candidate(text: str) -> Dict[str, Any]:
+    # finishReason 1 == STOP (the REST transport asks for integer enums)
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": 1, "index": 0}]}
+
+
+def create_app(
+    mathpix_latency: LatencyDistribution,
+    gemini_latency: LatencyDistribution,
+    chunk_seconds: float = 0.05,
+    chunk_chars: int = 40,
+    reply_chars: int = 600,
+    error_rate: float = 0.0,
+) -> FastAPI:
+    app = FastAPI()
+    calls: Counter = Counter()
+
+    def _fail() -> bool:
+        return error_rate > 0 and random.random() < error_rate
+
+    @app.post("/v3/text")
+    async def mathpix(request: Request) -> Response:
+        body = await request.json()
+        calls["mathpix"] += 1
+        await asyncio.sleep(mathpix_latency.sample())
+        if _fail():
+            calls["mathpix_errors"] += 1
+            return JSONResponse({"error": "Simulated overload"}, status_code=503)
+        seed = _digest(str(body.get("src", "")))
+        return JSONResponse({"text": f"x^2 - {seed % 9 + 1} = 0 \\\\ x = \\pm {seed % 7 + 1}", "confidence": 0.99})
+
+    @app.post("/v1beta/models/{model_action:path}")
+    async def gemini(model_action: str, request: Request) -> Response:
+        body = await request.json()
+        model, _, action = model_action.partition(":")
+        stream = action == "streamGenerateContent"
+        calls["gemini_stream" if stream else "gemini"] += 1
+
+        parts: List[Dict[str, Any]] = [p for c in body.get("contents") or [] for p in c.get("parts") or []]
+        prompt = "".join(str(p.get("text", "")) for p in parts)
+        wants_json = (body.get("generationConfig") or {}).get("responseMimeType") == "application/json"
+        with_image = any("inlineData" in p for p in parts)
+        seed = _digest(prompt)
+        text = _tutor_reply(seed, with_image, reply_chars) if wants_json else _chat_reply(seed, reply_chars)
+
+        # Time to first token; streams then trickle the rest
+        await asyncio.sleep(gemini_latency.sample())
+        if _fail():
+            calls["gemini_errors"] += 1
+            return JSONResponse({"error": {"code": 503, "message": "Simulated overload", "status": "UNAVAILABLE"}}, status_code=503)
+        if not stream:
+            return JSONResponse(_candidate(text))
+
+        async def chunks():
+            pieces = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or [""]
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(chunk_seconds)
+                yield ("[" if i == 0 else ",\r\n") + json.dumps(_candidate(piece))
+            yield "]"
+
+        return StreamingResponse(chunks(), media_type="application/json")
+
+    @app.get("/stats")
+    async def stats() -> Dict[str, int]:
+        return dict(calls)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Mathpix + Gemini upstreams for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--mathpix-latency", type=latency_spec, default=latency_spec("lognormal:600:0.4"),
+                        help="Mathpix latency (default lognormal:600:0.4)")
+    parser.add_argument("--gemini-latency", type=latency_spec, default=latency_spec("lognormal:1800:0.5"),
+                        help="Gemini latency to the first token (default lognormal:1800:0.5)")
+    parser.add_argument("--gemini-chunk-ms", type=float, default=50, help="Gap between streamed chunks (default 50)")
+    parser.add_argument("--reply-chars", type=int, default=600, help="Length of generated feedback (default 600)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with 503 (default 0)")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    app = create_app(
+        mathpix_latency=args.mathpix_latency,
+        gemini_latency=args.gemini_latency,
+        chunk_seconds=args.gemini_chunk_ms / 1000.0,
+        reply_chars=args.reply_chars,
+        error_rate=args.error_rate,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
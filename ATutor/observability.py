@@ -0,0 +1,313 @@
+# ATutor/observability.py
+# Structured logging, per-request ids and per-stage timings for the ATutor API.
+#
+# • configure_logging()  → one-line JSON logs carrying the current request id.
+# • TimingMiddleware     → assigns a request id, collects stage durations recorded with `stage()`,
+#                          and returns them as `Server-Timing` + `X-Request-ID` headers.
+# • stage("ocr")         → context manager that times one step of the current request.
+# • metrics_snapshot()   → rolling per-route/per-stage latency percentiles for GET /metrics.
+# • log_payload()        → sampled logging of prompts/model replies (off by default in production).
+# • LoopLagMonitor       → measures how late the event loop wakes up; a blocking call on the loop
+#                          shows up as lag (and a warning naming the requests in flight).
+#
+# Env:
+#   LOG_LEVEL                 default INFO
+#   LOG_FORMAT                "json" (default) or "text"
+#   ENV                       "production" turns payload logging off unless LOG_PAYLOAD_SAMPLE_RATE is set
+#   LOG_PAYLOAD_SAMPLE_RATE   0.0..1.0 fraction of requests whose payloads are logged
+#   LOG_PAYLOAD_MAX_CHARS     truncate logged payloads (default 2000)
+#   LOOP_LAG_INTERVAL_MS      how often the event loop is probed (default 100)
+#   LOOP_LAG_WARN_MS          log a warning when a probe is this late (default 200)
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+_IS_PRODUCTION = os.getenv("ENV", "").strip().lower() in ("prod", "production")
+PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0" if _IS_PRODUCTION else "1"))
+PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+
+# Metrics key for requests that matched no route
+_UNMATCHED_ROUTE = "<unmatched>"
+# Samples kept per (route, stage) for percentile estimates
+_WINDOW = 2048
+
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", "100"))
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "200"))
+
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+_stages_var: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("stages", default=None)
+_payload_sampled_var: contextvars.ContextVar[bool] = contextvars.ContextVar("payload_sampled", default=False)
+
+
+# ======= Logging =======
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if isinstance(fields, dict):
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging() -> None:
+    """Install the request-id aware handler on the root logger (idempotent)."""
+    root = logging.getLogger()
+    if any(getattr(h, "_atutor", False) for h in root.handlers):
+        return
+    handler = logging.StreamHandler()
+    handler._atutor = True  # type: ignore[attr-defined]
+    handler.addFilter(_RequestIdFilter())
+    if os.getenv("LOG_FORMAT", "json").strip().lower() == "text":
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+    else:
+        handler.setFormatter(_JsonFormatter())
+    root.addHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+
+def log_payload(logger: logging.Logger, label: str, payload: Any) -> None:
+    """Log a (possibly large) prompt/reply only for sampled requests, truncated."""
+    if not _payload_sampled_var.get():
+        return
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False, default=str)
+    if len(text) > PAYLOAD_MAX_CHARS:
+        text = text[:PAYLOAD_MAX_CHARS] + f"... [{len(text) - PAYLOAD_MAX_CHARS} more chars]"
+    logger.info(label, extra={"fields": {"payload": text}})
+
+
+# ======= Stage timings =======
+
+def record_stage(name: str, seconds: float) -> None:
+    """Add a duration to the current request's stage timings (no-op outside a request)."""
+    stages = _stages_var.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a block as one stage of the current request (e.g. auth, ocr, prompt, llm, parse)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def current_stages() -> Dict[str, float]:
+    return dict(_stages_var.get() or {})
+
+
+def _server_timing_header(stages: Dict[str, float], total: float) -> str:
+    parts = [f"{name};dur={secs * 1000:.1f}" for name, secs in stages.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+# ======= Metrics =======
+
+class _Metrics:
+    """Rolling latency samples per (route, stage), plus request/error counts per route."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._samples: Dict[Tuple[str, str], Deque[float]] = defaultdict(lambda: deque(maxlen=_WINDOW))
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._errors: Dict[str, int] = defaultdict(int)
+
+    def observe(self, route: str, stages: Dict[str, float], total: float, status_code: int) -> None:
+        with self._lock:
+            self._counts[route] += 1
+            if status_code >= 500:
+                self._errors[route] += 1
+            self._samples[(route, "total")].append(total)
+            for name, secs in stages.items():
+                self._samples[(route, name)].append(secs)
+
+    @staticmethod
+    def _percentile(sorted_values: List[float], pct: float) -> float:
+        if not sorted_values:
+            return 0.0
+        idx = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+        return sorted_values[idx]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = {k: sorted(v) for k, v in self._samples.items()}
+            counts = dict(self._counts)
+            errors = dict(self._errors)
+
+        routes: Dict[str, Any] = {}
+        for (route, name), values in samples.items():
+            r = routes.setdefault(route, {"count": counts.get(route, 0), "errors": errors.get(route, 0), "stages": {}})
+            r["stages"][name] = {
+                "samples": len(values),
+                "p50_ms": round(self._percentile(values, 50) * 1000, 1),
+                "p95_ms": round(self._percentile(values, 95) * 1000, 1),
+                "p99_ms": round(self._percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+            }
+        return {"routes": routes}
+
+
+_metrics = _Metrics()
+
+# Routes currently being served (for naming suspects when the loop stalls)
+_in_flight: Dict[int, str] = {}
+
+
+def metrics_snapshot() -> Dict[str, Any]:
+    return _metrics.snapshot()
+
+
+# ======= Event-loop lag =======
+
+class LoopLagMonitor:
+    """
+    Sleeps `interval` at a time and records how much later than requested it woke up. On an idle
+    or healthy loop that is well under a millisecond; anything that blocks the loop (sync I/O,
+    heavy CPU in a handler) adds its full duration to the next sample.
+    """
+
+    def __init__(self, interval_ms: float = LOOP_LAG_INTERVAL_MS, warn_ms: float = LOOP_LAG_WARN_MS) -> None:
+        self._interval = max(0.001, interval_ms / 1000.0)
+        self._warn = warn_ms / 1000.0
+        self._lock = threading.Lock()
+        self._samples: Deque[float] = deque(maxlen=_WINDOW)
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._logger = logging.getLogger("atutor.loop")
+        self.stalls = 0
+        self.worst = 0.0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            expected = time.perf_counter() + self._interval
+            await asyncio.sleep(self._interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            with self._lock:
+                self._samples.append(lag)
+                self.worst = max(self.worst, lag)
+            if lag >= self._warn:
+                self.stalls += 1
+                self._logger.warning(
+                    "event loop stalled",
+                    extra={"fields": {"lag_ms": round(lag * 1000, 1), "in_flight": sorted(set(_in_flight.values()))}},
+                )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            values = sorted(self._samples)
+        return {
+            "samples": len(values),
+            "interval_ms": round(self._interval * 1000, 1),
+            "p50_ms": round(_Metrics._percentile(values, 50) * 1000, 2),
+            "p95_ms": round(_Metrics._percentile(values, 95) * 1000, 2),
+            "p99_ms": round(_Metrics._percentile(values, 99) * 1000, 2),
+            "max_ms": round(self.worst * 1000, 2),
+            "stalls": self.stalls,
+            "stall_threshold_ms": round(self._warn * 1000, 1),
+        }
+
+
+# ======= Middleware =======
+
+class TimingMiddleware:
+    """
+    Pure ASGI middleware (works with streaming responses):
+    - request id from the incoming X-Request-ID header, or a fresh one
+    - Server-Timing header with the stages completed before the response started
+    - metrics/log line recorded once the full body has been sent
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self._logger = logging.getLogger("atutor.request")
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        stages: Dict[str, float] = {}
+        rid_token = request_id_var.set(request_id)
+        stages_token = _stages_var.set(stages)
+        sampled_token = _payload_sampled_var.set(random.random() < PAYLOAD_SAMPLE_RATE)
+
+        start = time.perf_counter()
+        status_holder = {"code": 500}
+        _in_flight[id(scope)] = f"{scope.get('method', '')} {scope.get('path', '?')}"
+
+        async def send_wrapper(message) -> None:
+            if message["type"] == "http.response.start":
+                status_holder["code"] = message["status"]
+                elapsed = time.perf_counter() - start
+                extra = [
+                    (b"server-timing", _server_timing_header(stages, elapsed).encode("latin-1")),
+                    (b"x-request-id", request_id.encode("latin-1")),
+                ]
+                message = dict(message)
+                message["headers"] = list(message.get("headers") or []) + extra
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _in_flight.pop(id(scope), None)
+            total = time.perf_counter() - start
+            route_template = getattr(scope.get("route"), "path", None)
+            route_path = route_template or scope.get("path", "?")
+            # Unmatched requests (404s, scanners) share one key, or every random URL would keep its own samples
+            metrics_key = f"{scope.get('method', '')} {route_template}" if route_template else _UNMATCHED_ROUTE
+            _metrics.observe(metrics_key, stages, total, status_holder["code"])
+            self._logger.info(
+                "request finished",
+                extra={
+                    "fields": {
+                        "method": scope.get("method"),
+                        "path": route_path,
+                        "status": status_holder["code"],
+                        "duration_ms": round(total * 1000, 1),
+                        "stages_ms": {k: round(v * 1000, 1) for k, v in stages.items()},
+                    }
+                },
+            )
+            _payload_sampled_var.reset(sampled_token)
+            _stages_var.reset(stages_token)
+            request_id_var.reset(rid_token)
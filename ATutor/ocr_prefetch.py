@@ -0,0 +1,161 @@
+# ATutor/ocr_prefetch.py
+# OCR result cache + speculative prefetch handles.
+#
+# The app can POST a photo to /ocr/prefetch (authenticated) as soon as it is captured. We return an opaque
+# image handle straight away and run OCR in the background while the student decides between
+# "analyse" and "I'm stuck". The tutoring endpoints then send the handle instead of the image
+# and usually find the transcription already done.
+#
+# • Transcriptions are cached by a hash of the image data, so re-sending the same photo is free.
+# • Concurrent requests for the same image share one in-flight OCR call.
+# • A handle whose OCR is still running is simply awaited.
+#
+# Env:
+#   OCR_CACHE_TTL_SECONDS    how long transcriptions / handles live (default 900)
+#   OCR_CACHE_MAX_ENTRIES    default 5000
+
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from observability import stage
+
+TTL_SECONDS = int(os.getenv("OCR_CACHE_TTL_SECONDS", "900"))
+MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "5000"))
+
+Transcriber = Callable[[str], Awaitable[str]]
+
+
+class UnknownImageHandle(KeyError):
+    """The handle was never issued, or has expired."""
+
+
+def image_digest(image_data: str) -> str:
+    return hashlib.sha256(image_data.encode("ascii", errors="ignore")).hexdigest()
+
+
+def _log_failure(task: "asyncio.Task[str]") -> None:
+    # Retrieving the exception also stops asyncio warning about it when nobody awaited the prefetch
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"OCR prefetch failed: {task.exception()}")
+
+
+class OcrStore:
+    def __init__(self, ttl_seconds: int = TTL_SECONDS, max_entries: int = MAX_ENTRIES) -> None:
+        self._ttl = ttl_seconds
+        self._max = max_entries
+        # image digest -> (expires_at, transcription)
+        self._results: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # image digest -> running OCR task
+        self._inflight: Dict[str, "asyncio.Task[str]"] = {}
+        # handle -> (expires_at, image digest)
+        self._handles: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+
+    # ----- cache -----
+
+    def _get_result(self, digest: str) -> Optional[str]:
+        entry = self._results.get(digest)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._results.pop(digest, None)
+            return None
+        self._results.move_to_end(digest)
+        return entry[1]
+
+    def _put_result(self, digest: str, text: str) -> None:
+        self._results[digest] = (time.monotonic() + self._ttl, text)
+        self._results.move_to_end(digest)
+        while len(self._results) > self._max:
+            self._results.popitem(last=False)
+
+    def _start(self, digest: str, image_data: str, transcribe: Transcriber) -> "asyncio.Task[str]":
+        task = self._inflight.get(digest)
+        if task is not None:
+            return task
+
+        async def run() -> str:
+            try:
+                text = await transcribe(image_data)
+                self._put_result(digest, text)
+                return text
+            finally:
+                self._inflight.pop(digest, None)
+
+        task = asyncio.create_task(run())
+        task.add_done_callback(_log_failure)
+        self._inflight[digest] = task
+        return task
+
+    # ----- public API -----
+
+    async def transcribe(self, image_data: str, transcribe: Transcriber) -> str:
+        """Cached OCR: reuse a stored or in-flight result for identical image data."""
+        digest = image_digest(image_data)
+        cached = self._get_result(digest)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        # shield: a cancelled request must not cancel OCR another request is waiting on
+        return await asyncio.shield(self._start(digest, image_data, transcribe))
+
+    def prefetch(self, image_data: str, transcribe: Transcriber) -> str:
+        """Start OCR in the background (unless already known) and return a handle for it."""
+        self._evict_expired_handles()
+        digest = image_digest(image_data)
+        if self._get_result(digest) is None:
+            self._start(digest, image_data, transcribe)
+        self.prefetches += 1
+        handle = secrets.token_urlsafe(16)
+        self._handles[handle] = (time.monotonic() + self._ttl, digest)
+        while len(self._handles) > self._max:
+            self._handles.popitem(last=False)
+        return handle
+
+    async def resolve(self, handle: str) -> str:
+        """Transcription for a prefetch handle, waiting for the background OCR if needed."""
+        entry = self._handles.get(handle)
+        if entry is None or entry[0] < time.monotonic():
+            self._handles.pop(handle, None)
+            raise UnknownImageHandle(handle)
+        digest = entry[1]
+
+        cached = self._get_result(digest)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._inflight.get(digest)
+        if task is None:
+            # Prefetch finished but failed (or the result was evicted): caller must resend the image
+            raise UnknownImageHandle(handle)
+        self.misses += 1
+        with stage("ocr_wait"):
+            return await asyncio.shield(task)
+
+    def _evict_expired_handles(self) -> None:
+        now = time.monotonic()
+        while self._handles:
+            handle, (expires_at, _) = next(iter(self._handles.items()))
+            if expires_at >= now:
+                break
+            self._handles.pop(handle, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "results": len(self._results),
+            "inflight": len(self._inflight),
+            "handles": len(self._handles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetches": self.prefetches,
+        }
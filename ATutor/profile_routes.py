@@ -7,21 +7,49 @@
 # • Requires Firebase ID token in "Authorization: Bearer <ID_TOKEN>".
 # • Reads/writes the user doc at:   users/{uid}
 # • Devices (if your app records them) are read from: users/{uid}/devices/*
+#   (read concurrently with the user doc)
+# • The profile is fetched at every app launch, so it is cached per uid for a few seconds and
+#   carries an ETag: a launch that sends If-None-Match with an unchanged profile gets a 304.
+#   PATCH invalidates the entry, including a read still in flight (XP flushes do too); other
+#   instances may serve their copy until it expires.
+#
+# Env:
+#   PROFILE_CACHE_TTL_SECONDS   per-uid profile cache lifetime (default 10; 0 disables)
 
-from typing import Any, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
 from pydantic import BaseModel, Field
 from firebase_admin import firestore
 
 from auth_utils import require_user_id
 from utils import FirebaseManager
 from constants import clamp_tier_id, TIER_ID_TO_NAME
+from leaderboard_routes import publish_member_change
+from leaderboard_snapshots import apply_member_update
+from observability import stage
+from swr_cache import SWRCache
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 _firebase = FirebaseManager()
 
+_profile_cache = SWRCache(
+    ttl_seconds=float(os.getenv("PROFILE_CACHE_TTL_SECONDS", "10")),
+    stale_seconds=0,
+    name="profile-cache",
+)
+_devices_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="profile-devices")
+
+
+class ProfileNotFound(LookupError):
+    pass
+
 
 # ======= Request / Response Models =======
 
@@ -89,12 +117,54 @@ def _read_devices_for(uid: str, db) -> List[Dict[str, Any]]:
     return items
 
 
+def _read_profile(db, uid: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """(user doc, devices) — the devices query runs alongside the user doc read."""
+    devices_future = _devices_pool.submit(_read_devices_for, uid, db)
+    doc = db.collection("users").document(uid).get()
+    devices = devices_future.result()
+    if not doc.exists:
+        raise ProfileNotFound(uid)
+    return doc.to_dict() or {}, devices
+
+
+def _profile_etag(payload: Dict[str, Any]) -> str:
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return '"' + hashlib.sha1(body.encode("utf-8")).hexdigest()[:20] + '"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    # Weak validators (W/"...") compare equal for If-None-Match
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def invalidate_profile(uid: str) -> None:
+    """Drop the cached profile for a uid (after anything that changes users/{uid})."""
+    _profile_cache.invalidate(uid)
+
+
+def profile_cache_stats() -> Dict[str, int]:
+    return _profile_cache.stats()
+
+
+def _profile_response(response: Response, payload: Dict[str, Any]) -> Dict[str, Any]:
+    response.headers["ETag"] = _profile_etag(payload)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return {"user": payload}
+
+
 # ======= Routes =======
 
 @router.get("/me")
-async def get_me(user_id: str = Depends(require_user_id)) -> Dict[str, Any]:
+async def get_me(
+    response: Response,
+    user_id: str = Depends(require_user_id),
+    if_none_match: Optional[str] = Header(None),
+) -> Any:
     """
-    Return the caller's profile.
+    Return the caller's profile (304 if If-None-Match carries the current ETag).
     Shape:
     {
       "user": {
@@ -114,20 +184,33 @@ async def get_me(user_id: str = Depends(require_user_id)) -> Dict[str, Any]:
     }
     """
     db = _firebase.get_db_client()
-    doc = db.collection("users").document(user_id).get()
-    if not doc.exists:
+    try:
+        with stage("profile_read"):
+            # Missing profiles raise and are therefore never cached (a new sign-up shows up at once)
+            user_data, devices = await _profile_cache.get(user_id, lambda: _read_profile(db, user_id))
+    except ProfileNotFound:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User profile not found")
 
-    user_data = doc.to_dict() or {}
-    devices = _read_devices_for(user_id, db)
-    return {"user": _build_profile_payload(user_id, user_data, devices)}
+    payload = _build_profile_payload(user_id, user_data, devices)
+    etag = _profile_etag(payload)
+    if _etag_matches(if_none_match, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": etag, "Cache-Control": "private, no-cache"},
+        )
+    return _profile_response(response, payload)
 
 
 @router.patch("/me")
-async def update_me(body: ProfileUpdateRequest, user_id: str = Depends(require_user_id)) -> Dict[str, Any]:
+async def update_me(
+    body: ProfileUpdateRequest,
+    response: Response,
+    user_id: str = Depends(require_user_id),
+) -> Dict[str, Any]:
     """
     Update the caller's profile (ONLY displayName/username).
-    Returns the updated profile in the same shape as GET /users/me.
+    Returns the updated profile in the same shape as GET /users/me (built from the document
+    read before the update plus the new values — no second read).
     """
     updates: Dict[str, Any] = {}
     # Normalize inputs (trim whitespace)
@@ -146,24 +229,38 @@ async def update_me(body: ProfileUpdateRequest, user_id: str = Depends(require_u
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="username too long")
         updates["username"] = uname
 
-    if not updates:
-        # Nothing to change; return current profile
-        return await get_me(user_id)  # type: ignore
-
     db = _firebase.get_db_client()
-    user_ref = db.collection("users").document(user_id)
 
-    # Ensure the doc exists before update
-    doc = user_ref.get()
-    if not doc.exists:
+    # Ensure the doc exists before update (user doc + devices, read concurrently)
+    try:
+        current, devices = await asyncio.to_thread(_read_profile, db, user_id)
+    except ProfileNotFound:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User profile not found")
 
+    if not updates:
+        # Nothing to change; return current profile
+        return _profile_response(response, _build_profile_payload(user_id, current, devices))
+
+    user_ref = db.collection("users").document(user_id)
     try:
         # Add a lightweight updatedAt; Firestore server timestamp if available
-        updates["updatedAt"] = firestore.SERVER_TIMESTAMP
-        user_ref.update(updates)
+        await asyncio.to_thread(user_ref.update, {**updates, "updatedAt": firestore.SERVER_TIMESTAMP})
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to update profile: {e}")
+    finally:
+        invalidate_profile(user_id)
+
+    # Keep the group's leaderboard snapshot in step with the new username
+    if "username" in updates:
+        await asyncio.to_thread(
+            apply_member_update,
+            db,
+            _safe_int(current.get("tierID"), 0),
+            _safe_int(current.get("groupID"), 0),
+            user_id,
+            username=updates["username"],
+        )
+        publish_member_change(user_id, username=updates["username"])
 
-    # Return the fresh profile
-    return await get_me(user_id)  # type: ignore
+    # Return the merged profile
+    return _profile_response(response, _build_profile_payload(user_id, {**current, **updates}, devices))
@@ -209,11 +209,28 @@ Analyze the provided work and output ONLY the JSON object described above.
 """
 
 
-def get_chat_prompt(question_part: str, student_work: str, solution_text: str, formatted_history: str) -> str:
+# Placeholder used for the transcription when the student's work is sent as an image instead
+IMAGE_WORK_PLACEHOLDER = "(see the attached image of the student's handwritten work)"
+
+
+def with_image_transcription(prompt: str) -> str:
     """
-    Generates the system prompt for the ongoing chat conversation.
+    Adapts an analysis/hint prompt for direct image input (no OCR step): the model reads the attached
+    image itself and returns its transcription alongside the usual keys.
     """
-    return f"""
+    return prompt + """
+--- IMAGE INPUT (OVERRIDES THE RESPONSE FORMAT ABOVE) ---
+The student's work is attached as an image instead of a transcription.
+1. First transcribe the student's work faithfully, line by line, as plain text with all math in LaTeX inside $...$.
+   Transcribe what is written, even if it is wrong. Do not correct or complete it.
+2. Then do the task above using your transcription as the student's work.
+3. In addition to the keys above, your JSON object MUST include:
+   "transcription": "<your transcription of the student's work>"
+   The same JSON & math safety rules apply to "transcription" (escape LaTeX backslashes, use \\n for line breaks).
+"""
+
+
+_CHAT_TUTOR_RULES = """
 Core Identity: A Socratic Math Tutor
 You are an AI math tutor. Your purpose is to help students truly understand mathematical concepts by guiding them to find their own answers. Your entire interaction should be shaped by this goal. You are kind, patient, encouraging, and focused on building the student's knowledge and fundamentals of math.
 
@@ -274,16 +291,74 @@ This is your foundational understanding of the world. It's not a script to be re
 - Your Purpose: Your function is to teach math to help humans understand the fundamental code of existence.
 
 Ultimately just be kind and helpful; everything here is just a rough guide.
+"""
 
+
+def get_chat_context_prompt(question_part: str, student_work: str, solution_text: str) -> str:
+    """
+    Generates the fixed part of the chat prompt: tutor rules plus the question context.
+    It does not change between turns, so it can be reused as a cached prefix.
+    """
+    return _CHAT_TUTOR_RULES + f"""
 --- CONTEXT FOR THIS CONVERSATION ---
 - Original Question: "{question_part}"
 - Student's Original Work: "{student_work}"
 - Model Solution (For your reference ONLY): "{solution_text}"
+"""
+
 
+def get_chat_turn_prompt(formatted_history: str, conversation_summary: str = "") -> str:
+    """
+    Generates the per-turn part of the chat prompt (optional running summary + recent history + task).
+    """
+    summary_block = ""
+    if conversation_summary:
+        summary_block = f"""
+--- SUMMARY OF EARLIER CONVERSATION ---
+{conversation_summary}
+"""
+    return summary_block + f"""
 --- CONVERSATION HISTORY ---
 {formatted_history}
 
 --- YOUR TASK ---
 Continue the conversation by providing your next response. Adhere strictly to the formatting and tutoring approach rules.
 End your message with exactly one status token line: [[STATUS: COMPLETE]] or [[STATUS: CONTINUE]]
-"""
\ No newline at end of file
+"""
+
+
+def get_chat_prompt(question_part: str, student_work: str, solution_text: str, formatted_history: str) -> str:
+    """
+    Generates the system prompt for the ongoing chat conversation.
+    """
+    return get_chat_context_prompt(question_part, student_work, solution_text) + get_chat_turn_prompt(formatted_history)
+
+
+def get_chat_summary_prompt(previous_summary: str, formatted_turns: str) -> str:
+    """
+    Generates the prompt used to fold older chat turns into a running summary.
+    """
+    return f"""
+You are summarising part of a tutoring conversation between a student and an AI math tutor.
+The summary replaces the original messages, so the tutor must be able to continue the conversation from it.
+
+Keep:
+- what the student has tried, and which steps were confirmed correct or found wrong,
+- hints, formulas and explanations the tutor has already given (so they are not repeated verbatim),
+- any misconception the student showed, and any question still open.
+
+Rules:
+- Plain text, at most 150 words, written in the third person ("The student...", "The tutor...").
+- Keep math in LaTeX inside $...$.
+- Do NOT add new hints or judgements.
+- Do NOT include any [[STATUS: ...]] token.
+
+--- EXISTING SUMMARY (may be empty) ---
+{previous_summary}
+
+--- MESSAGES TO FOLD IN ---
+{formatted_turns}
+
+--- YOUR TASK ---
+Output only the updated summary.
+"""
@@ -0,0 +1,120 @@
+# ATutor/response_cache.py
+# In-process cache for /analyse-work and /stuck-at-question model responses.
+#
+# Many students submit the same final working for the same question part. The cache key is
+#   (kind, question id, question part, prompt version, normalised transcription)
+# where the transcription is normalised for whitespace and purely-presentational LaTeX, and the
+# prompt version is a fingerprint of the prompt template — editing prompts.py invalidates old entries.
+#
+# Env:
+#   RESPONSE_CACHE_TTL_SECONDS   default 86400 (0 disables the cache)
+#   RESPONSE_CACHE_MAX_ENTRIES   default 20000
+
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "20000"))
+
+# LaTeX that changes how math looks, not what it says (whole command names only: \rightarrow stays)
+_LATEX_NOISE = re.compile(
+    r"\\(?:(?:left|right|displaystyle|textstyle|quad|qquad)(?![A-Za-z])|,|;|:|!|\s)"
+    r"|\\\(|\\\)|\\\[|\\\]|\$"
+)
+_SINGLE_CHAR_GROUP = re.compile(r"([\^_])\{(\w)\}")
+_SPACE_AROUND_SYMBOL = re.compile(r"\s*([^\w\s\\])\s*")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_transcription(text: str) -> str:
+    """
+    Canonical form of an OCR transcription for cache keying:
+    `$x^{2} = \\dfrac{1}{2}$` and `\\( x^2=\\frac{1}{2} \\)` normalise to the same string.
+    """
+    t = (text or "").replace("−", "-").replace("×", "\\times")
+    t = re.sub(r"\\[dt]frac", r"\\frac", t)
+    t = _LATEX_NOISE.sub(" ", t)
+    t = t.replace("~", " ")
+    t = _SINGLE_CHAR_GROUP.sub(r"\1\2", t)
+    t = _SPACE_AROUND_SYMBOL.sub(r"\1", t)
+    return _WHITESPACE.sub(" ", t).strip()
+
+
+def prompt_version(prompt_fn: Callable[..., str]) -> str:
+    """Fingerprint of a prompt template (rendered with empty context)."""
+    rendered = prompt_fn(question_part="", solution_text="", transcribed_text="")
+    return hashlib.sha256(rendered.encode("utf-8")).hexdigest()[:12]
+
+
+def make_cache_key(
+    kind: str,
+    question_id: Optional[str],
+    question_part: str,
+    version: str,
+    transcription: str,
+    solution_text: str = "",
+) -> str:
+    # Without a stable question id, fall back to the solution text to tell questions apart
+    question = question_id or "sol:" + hashlib.sha256(solution_text.encode("utf-8")).hexdigest()[:16]
+    raw = "\x1f".join([kind, question, question_part.strip(), version, normalize_transcription(transcription)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Thread-safe TTL + LRU cache with per-key hit counts."""
+
+    def __init__(self, ttl_seconds: int = TTL_SECONDS, max_entries: int = MAX_ENTRIES) -> None:
+        self._ttl = ttl_seconds
+        self._max = max_entries
+        self._lock = threading.Lock()
+        # key -> (expires_at, value, hits)
+        self._entries: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl > 0 and self._max > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            expires_at, value, hits = entry
+            self._entries[key] = (expires_at, value, hits + 1)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            hits = self._entries.get(key, (0.0, None, 0))[2]
+            self._entries[key] = (time.monotonic() + self._ttl, value, hits)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max:
+                self._entries.popitem(last=False)
+
+    def stats(self, top: int = 10) -> Dict[str, Any]:
+        with self._lock:
+            hottest = sorted(self._entries.items(), key=lambda kv: kv[1][2], reverse=True)[:top]
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "top_keys": [{"key": k[:12], "hits": v[2]} for k, v in hottest if v[2] > 0],
+            }
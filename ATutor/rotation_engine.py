@@ -0,0 +1,410 @@
+# ATutor/rotation_engine.py
+# Pure, side-effect-free tier rotation: records in, new (tier, group) assignments out.
+#
+# No Firestore, no clock reads, no printing — the caller passes `now` and a `seed`, so the same
+# input always produces the same output and the engine can be benchmarked offline:
+#
+#     python rotation_engine.py --synthetic 1000000 --seed 7
+#     python rotation_engine.py --snapshot users.json --out assignments.json
+#
+# Per tier (same policy as the original leaderboard_refresh):
+#   1. pack the tier's users into activity-aware groups (≤70% recently active per group),
+#   2. in each packed group promote the top N / demote the bottom M by XP,
+#   3. every user's destination tier is then packed ONCE into final groups 0..k-1, so each week
+#      everyone gets a fresh, activity-balanced group.
+# With keep_groups=True (a product choice, off by default) step 3 instead leaves users who stay in
+# their tier in their group: promoted/demoted users fill the free places of the destination tier's
+# groups (same 70% activity cap), the overflow is packed into new groups numbered after the tier's
+# highest group id, and groups that fall below min_group_size are merged into the others. Only the
+# movers (and merged groups) then change assignment, at the cost of the weekly regrouping.
+# Sort keys are computed once per user, so a run is a handful of O(n log n) sorts plus linear passes.
+
+import argparse
+import hashlib
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+RECENT_SECONDS = 7 * 24 * 3600
+RECENT_SHARE = 0.7
+
+# Peak extra memory per user while rotate() runs (sort keys, tier lists, packed groups, the
+# assignment map), on top of UserRecord.approx_bytes(). Measured with tracemalloc at ~400 bytes
+# on 200k synthetic users; rebuilding snapshots afterwards needs less. Used for memory budgets.
+ROTATION_BYTES_PER_USER = 480
+
+
+class UserRecord:
+    """Compact per-user rotation state; `last_active` is POSIX seconds (0.0 = never)."""
+
+    __slots__ = ("user_id", "username", "tier_id", "group_id", "total_xp", "last_active")
+
+    def __init__(
+        self,
+        user_id: str,
+        username: str,
+        tier_id: int,
+        group_id: int,
+        total_xp: int,
+        last_active: float,
+    ) -> None:
+        self.user_id = user_id
+        self.username = username
+        self.tier_id = tier_id
+        self.group_id = group_id
+        self.total_xp = total_xp
+        self.last_active = last_active
+
+    def approx_bytes(self) -> int:
+        # Object + both strings + one list slot; ints/floats are mostly small and shared
+        return sys.getsizeof(self) + sys.getsizeof(self.user_id) + sys.getsizeof(self.username) + 8
+
+    def as_assignment(self) -> Dict[str, Any]:
+        return {
+            "userID": self.user_id,
+            "username": self.username,
+            "totalXP": self.total_xp,
+            "tierID": self.tier_id,
+            "groupID": self.group_id,
+        }
+
+
+@dataclass
+class RotationResult:
+    # user_id -> (tier_id, group_id)
+    assignments: Dict[str, Tuple[int, int]]
+    # (user_id, from_tier, to_tier) for every promotion/demotion
+    moves: List[Tuple[str, int, int]] = field(default_factory=list)
+    groups_per_tier: Dict[int, int] = field(default_factory=dict)
+
+    @property
+    def promoted(self) -> int:
+        return sum(1 for _, src, dst in self.moves if dst > src)
+
+    @property
+    def demoted(self) -> int:
+        return sum(1 for _, src, dst in self.moves if dst < src)
+
+
+def get_promotion_demotion_counts(tier_id: int, num_tiers: int) -> Tuple[int, int]:
+    """
+    Promotion/demotion counts per group for the 5-tier model (0..4).
+
+    Simple policy:
+      - Bottom tier (0): promote 10, demote 0
+      - Top tier (4):    promote 0,  demote 10
+      - Middle tiers:    promote decreases as you go up; demote increases
+    """
+    top_index = num_tiers - 1
+    if tier_id <= 0:
+        return 10, 0
+    if tier_id >= top_index:
+        return 0, 10
+    promote = max(1, 10 - tier_id - 1)  # 1:8, 2:7, 3:6
+    demote = max(1, 3 + (tier_id - 1) + 1)  # 1:4, 2:5, 3:6
+    return promote, demote
+
+
+def _tiebreak(seed: int, user_id: str) -> int:
+    digest = hashlib.blake2b(f"{seed}:{user_id}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def pack_by_activity(
+    users: Sequence[UserRecord],
+    group_size: int,
+    recent_threshold: float,
+    keys: Dict[str, Tuple[int, float, int]],
+) -> List[List[UserRecord]]:
+    """
+    Pack users into groups of `group_size`, each up to 70% recently active users, filled with
+    inactive ones. Within each pool: XP desc, then most recently active, then the seeded tiebreak.
+    """
+    recent = [u for u in users if u.last_active >= recent_threshold]
+    inactive = [u for u in users if u.last_active < recent_threshold]
+    recent.sort(key=lambda u: keys[u.user_id])
+    inactive.sort(key=lambda u: keys[u.user_id])
+
+    recent_slots = max(1, int(group_size * RECENT_SHARE))
+    groups: List[List[UserRecord]] = []
+    r_idx = i_idx = 0
+    while r_idx < len(recent) or i_idx < len(inactive):
+        take_recent = min(recent_slots, len(recent) - r_idx)
+        group = recent[r_idx:r_idx + take_recent]
+        r_idx += take_recent
+        take_inactive = min(group_size - len(group), len(inactive) - i_idx)
+        group += inactive[i_idx:i_idx + take_inactive]
+        i_idx += take_inactive
+        groups.append(group)
+    return groups
+
+
+def rotate(
+    users: Iterable[UserRecord],
+    num_tiers: int,
+    group_size: int,
+    now: float,
+    seed: int = 0,
+    tiers: Optional[Iterable[int]] = None,
+    keep_groups: bool = False,
+    min_group_size: Optional[int] = None,
+) -> RotationResult:
+    """
+    Compute new (tier, group) assignments. Pure: `users` are not modified.
+    `tiers` limits which source tiers rotate (default: all); users of other tiers are only
+    touched if someone is promoted/demoted into their tier, in which case that tier is repacked.
+    With `keep_groups`, changed tiers are not repacked: stayers keep their group id, movers are
+    placed with place_movers, and groups smaller than `min_group_size` (default half a group)
+    are merged into the rest.
+    """
+    recent_threshold = now - RECENT_SECONDS
+    by_tier: Dict[int, List[UserRecord]] = defaultdict(list)
+    keys: Dict[str, Tuple[int, float, int]] = {}
+    for u in users:
+        by_tier[min(max(u.tier_id, 0), num_tiers - 1)].append(u)
+        keys[u.user_id] = (-u.total_xp, -u.last_active, _tiebreak(seed, u.user_id))
+
+    rotating = set(range(num_tiers)) if tiers is None else {t for t in tiers if 0 <= t < num_tiers}
+    destination: Dict[int, List[UserRecord]] = defaultdict(list)
+    moves: List[Tuple[str, int, int]] = []
+
+    for tier_id in range(num_tiers):
+        members = by_tier.get(tier_id, [])
+        if tier_id not in rotating:
+            destination[tier_id].extend(members)
+            continue
+        for group in pack_by_activity(members, group_size, recent_threshold, keys):
+            promoted, staying, demoted = rotate_group(group, tier_id, num_tiers, seed)
+            for u in promoted:
+                destination[tier_id + 1].append(u)
+                moves.append((u.user_id, tier_id, tier_id + 1))
+            for u in demoted:
+                destination[tier_id - 1].append(u)
+                moves.append((u.user_id, tier_id, tier_id - 1))
+            destination[tier_id].extend(staying)
+
+    changed_tiers = rotating | {dst for _, _, dst in moves}
+    moved = {uid for uid, _, _ in moves}
+    if min_group_size is None:
+        min_group_size = max(1, group_size // 2)
+    assignments: Dict[str, Tuple[int, int]] = {}
+    groups_per_tier: Dict[int, int] = {}
+    for tier_id, members in destination.items():
+        if tier_id not in changed_tiers:
+            for u in members:
+                assignments[u.user_id] = (tier_id, u.group_id)
+            continue
+        if not keep_groups:
+            # Repack each affected destination tier exactly once
+            groups = pack_by_activity(members, group_size, recent_threshold, keys)
+            groups_per_tier[tier_id] = len(groups)
+            for g_idx, group in enumerate(groups):
+                for u in group:
+                    assignments[u.user_id] = (tier_id, g_idx)
+            continue
+
+        # Stayers keep their group; movers (and users whose stored tier was out of range) are placed
+        occupied: Dict[int, List[UserRecord]] = defaultdict(list)
+        incoming: List[UserRecord] = []
+        for u in members:
+            if u.tier_id == tier_id and u.user_id not in moved:
+                occupied[u.group_id].append(u)
+            else:
+                incoming.append(u)
+        for uid, group_id in place_movers(occupied, incoming, group_size, recent_threshold, keys).items():
+            assignments[uid] = (tier_id, group_id)
+        for group_id, group in occupied.items():
+            for u in group:
+                assignments[u.user_id] = (tier_id, group_id)
+
+        # Merge groups that ended up too small (stayers drained by promotions and demotions)
+        final: Dict[int, List[UserRecord]] = defaultdict(list)
+        for u in members:
+            final[assignments[u.user_id][1]].append(u)
+        small = sorted((g for g, group in final.items() if len(group) < min_group_size), key=lambda g: -len(final[g]))
+        if len(final) > 1 and small:
+            keep = {g: group for g, group in final.items() if len(group) >= min_group_size}
+            if not keep:
+                keep = {small[0]: final[small[0]]}  # the largest small group stays as the base
+            displaced = [u for g, group in final.items() if g not in keep for u in group]
+            for uid, group_id in place_movers(keep, displaced, group_size, recent_threshold, keys).items():
+                assignments[uid] = (tier_id, group_id)
+        groups_per_tier[tier_id] = len({assignments[u.user_id][1] for u in members})
+
+    return RotationResult(assignments=assignments, moves=moves, groups_per_tier=groups_per_tier)
+
+
+def place_movers(
+    occupied: Dict[int, Sequence[UserRecord]],
+    incoming: Sequence[UserRecord],
+    group_size: int,
+    recent_threshold: float,
+    keys: Dict[str, Tuple[int, float, int]],
+) -> Dict[str, int]:
+    """
+    Group ids for users arriving in a tier whose groups (`occupied`: group id -> members) are
+    kept. Free places are filled first (lowest group id first, at most 70% recently active per
+    group, best-ranked arrivals first); whoever is left is packed by activity into new groups
+    after the highest group id in use.
+    """
+    if not incoming:
+        return {}
+    size: Dict[int, int] = {}
+    recent_in_group: Dict[int, int] = {}
+    for group_id, group in occupied.items():
+        size[group_id] = len(group)
+        recent_in_group[group_id] = sum(1 for u in group if u.last_active >= recent_threshold)
+
+    recent = sorted((u for u in incoming if u.last_active >= recent_threshold), key=lambda u: keys[u.user_id])
+    inactive = sorted((u for u in incoming if u.last_active < recent_threshold), key=lambda u: keys[u.user_id])
+    recent_slots = max(1, int(group_size * RECENT_SHARE))
+    placed: Dict[str, int] = {}
+    r_idx = i_idx = 0
+    for group_id in sorted(size):
+        if r_idx >= len(recent) and i_idx >= len(inactive):
+            break
+        free = group_size - size[group_id]
+        take_recent = max(0, min(free, recent_slots - recent_in_group[group_id], len(recent) - r_idx))
+        for u in recent[r_idx:r_idx + take_recent]:
+            placed[u.user_id] = group_id
+        r_idx += take_recent
+        take_inactive = max(0, min(free - take_recent, len(inactive) - i_idx))
+        for u in inactive[i_idx:i_idx + take_inactive]:
+            placed[u.user_id] = group_id
+        i_idx += take_inactive
+
+    next_id = max(size) + 1 if size else 0
+    overflow = recent[r_idx:] + inactive[i_idx:]
+    for offset, group in enumerate(pack_by_activity(overflow, group_size, recent_threshold, keys)):
+        for u in group:
+            placed[u.user_id] = next_id + offset
+    return placed
+
+
+def rotate_group(
+    members: Sequence[UserRecord],
+    tier_id: int,
+    num_tiers: int,
+    seed: int = 0,
+) -> Tuple[List[UserRecord], List[UserRecord], List[UserRecord]]:
+    """
+    Split one group into (promoted, staying, demoted), each ranked by XP desc, then most
+    recently active, then the seeded tiebreak. Used per packed group by rotate() and per
+    existing group by the rolling rotation in leaderboard_refresh.
+    """
+    ranked = sorted(members, key=lambda u: (-u.total_xp, -u.last_active, _tiebreak(seed, u.user_id)))
+    promote_count, demote_count = get_promotion_demotion_counts(tier_id, num_tiers)
+    if tier_id >= num_tiers - 1:
+        promote_count = 0
+    if tier_id <= 0:
+        demote_count = 0
+    n_up = min(promote_count, len(ranked))
+    n_down = min(demote_count, len(ranked) - n_up)
+    return ranked[:n_up], ranked[n_up:len(ranked) - n_down], ranked[len(ranked) - n_down:]
+
+
+# ======= CLI: offline simulation / benchmark =======
+
+def synthetic_users(count: int, num_tiers: int, group_size: int, now: float, seed: int) -> List[UserRecord]:
+    rng = random.Random(seed)
+    users: List[UserRecord] = []
+    groups_per_tier = max(1, count // (num_tiers * group_size))
+    for i in range(count):
+        active_days_ago = rng.expovariate(1 / 6.0)
+        users.append(
+            UserRecord(
+                user_id=f"user{i:08d}",
+                username="Player",
+                tier_id=rng.randrange(num_tiers),
+                group_id=rng.randrange(groups_per_tier),
+                total_xp=int(rng.lognormvariate(5, 1)),
+                last_active=now - active_days_ago * 86400,
+            )
+        )
+    return users
+
+
+def load_snapshot(path: str) -> List[UserRecord]:
+    """JSON list of {userID, tierID, groupID, totalXP, lastActive (epoch seconds or ISO-8601)}."""
+    from datetime import datetime
+
+    with open(path, "r", encoding="utf-8") as f:
+        rows = json.load(f)
+    users: List[UserRecord] = []
+    for row in rows:
+        last = row.get("lastActive", row.get("lastLoginDate", 0))
+        if isinstance(last, str):
+            try:
+                last = datetime.fromisoformat(last.replace("Z", "+00:00")).timestamp()
+            except ValueError:
+                last = 0.0
+        users.append(
+            UserRecord(
+                user_id=str(row["userID"]),
+                username=str(row.get("username") or "Player"),
+                tier_id=int(row.get("tierID", 0) or 0),
+                group_id=int(row.get("groupID", 0) or 0),
+                total_xp=int(row.get("totalXP", 0) or 0),
+                last_active=float(last or 0.0),
+            )
+        )
+    return users
+
+
+def _peak_rss_mb() -> float:
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    except Exception:
+        return 0.0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from constants import GROUP_SIZE, TIERS
+
+    parser = argparse.ArgumentParser(description="Run the tier rotation engine offline and time it.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--snapshot", type=str, help="JSON file with user records")
+    source.add_argument("--synthetic", type=int, help="Generate this many synthetic users")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic data and tie-breaking")
+    parser.add_argument("--group-size", type=int, default=GROUP_SIZE)
+    parser.add_argument("--now", type=float, default=None, help="Evaluation time (epoch seconds); default: now")
+    parser.add_argument("--out", type=str, help="Write {userID: [tierID, groupID]} here")
+    parser.add_argument("--keep-groups", action="store_true", help="Leave stayers in their group (see rotate)")
+    parser.add_argument("--min-group-size", type=int, default=None, help="Merge smaller groups (--keep-groups)")
+    args = parser.parse_args(argv)
+
+    now = args.now if args.now is not None else time.time()
+    num_tiers = len(TIERS)
+
+    t0 = time.perf_counter()
+    if args.snapshot:
+        users = load_snapshot(args.snapshot)
+    else:
+        users = synthetic_users(args.synthetic, num_tiers, args.group_size, now, args.seed)
+    t1 = time.perf_counter()
+    result = rotate(users, num_tiers, args.group_size, now=now, seed=args.seed,
+                    keep_groups=args.keep_groups, min_group_size=args.min_group_size)
+    t2 = time.perf_counter()
+
+    unchanged = sum(1 for u in users if result.assignments.get(u.user_id) == (u.tier_id, u.group_id))
+    print(f"[rotation_engine] users={len(users)} load={t1 - t0:.2f}s rotate={t2 - t1:.2f}s "
+          f"({len(users) / max(t2 - t1, 1e-9):,.0f} users/s) peak_rss={_peak_rss_mb():.0f}MB")
+    print(f"[rotation_engine] promoted={result.promoted} demoted={result.demoted} "
+          f"unchanged_assignments={unchanged} groups_per_tier={dict(sorted(result.groups_per_tier.items()))}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({uid: list(tg) for uid, tg in result.assignments.items()}, f)
+        print(f"[rotation_engine] wrote {len(result.assignments)} assignments to {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,11 +1,34 @@
 #!/usr/bin/env python3
+# Seed bot users for leaderboard testing.
+#
+# Small mode (a handful of bots in one group, optionally friends with you):
+#   python seed_bots.py --tier 2 --group 3 --count 15 --friends-of <UID>
+#   python seed_bots.py --mirror-user <UID> --count 19
+#
+# Population mode (production-scale data for load tests; use an emulator or staging project):
+#   python seed_bots.py --population 1000000 --seed 7 --friends-shape power-law --avg-friends 12
+#   python seed_bots.py --teardown --prefix Bot
+#
+# Population bots get deterministic ids (bot_<prefix>_<index>) and data from --seed, a
+# realistic spread of tiers, XP (log-normal, higher in higher tiers) and activity (recently
+# active users with streaks plus a dormant tail), and a friend graph of the chosen shape:
+#   random       each bot befriends ~avg/2 random bots (links are mutual)
+#   small-world  ring lattice with 10% of links rewired (Watts–Strogatz)
+#   power-law    preferential attachment (Barabási–Albert): a few very popular bots
+# Friend lists are part of each bot's first write, so there are no per-bot follow-up updates.
+# All writes go through a BulkWriter (parallel batches, ramped rate limit, retries), together
+# with the groups' leaderboard snapshots. --teardown deletes every bot with the prefix and the
+# snapshots of the groups they were in. Bot groups are numbered past each tier's highest groupID,
+# so population mode refuses to run while bots with the prefix exist; --replace tears them down first.
 import os
 import sys
 import argparse
 import random
 import string
-from datetime import datetime
-from typing import List
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
 from pathlib import Path
 from dotenv import load_dotenv
@@ -55,6 +78,17 @@ def rand_id(n=12):
     alphabet = string.ascii_lowercase + string.digits
     return "".join(random.choice(alphabet) for _ in range(n))
 
+def _bulk_writer(ops_per_second: int = 500):
+    from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriterOptions
+
+    return DB.bulk_writer(
+        BulkWriterOptions(
+            initial_ops_per_second=ops_per_second,
+            max_ops_per_second=max(ops_per_second, 10000),
+            retry=BulkRetry.exponential,
+        )
+    )
+
 def seed_bots(count: int,
               tier_id: int,
               group_id: int,
@@ -66,8 +100,7 @@ def seed_bots(count: int,
     from firebase_admin import firestore as fs
 
     print(f"[seed_bots] Seeding {count} bots into tier {tier_id}, group {group_id}...")
-    batch = DB.batch()
-    batch_ops = 0
+    writer = _bulk_writer()
     bot_ids: List[str] = []
 
     # Create bots with staggered XP so you get a nice ladder
@@ -89,21 +122,14 @@ def seed_bots(count: int,
             "currentStreak": random.randint(0, 5),
             "timeSpentInSeconds": random.randint(0, 3600),
             "lastLoginDate": fs.SERVER_TIMESTAMP,
-            "friends": [],
+            # Mutual friendship is written with the bot itself instead of one update per bot
+            # (not required for your current friends leaderboard)
+            "friends": [friends_of] if friends_of and mutual else [],
+            "isBot": True,
         }
-        batch.set(doc_ref, data)
-        batch_ops += 1
-
-        # Commit in chunks (Firestore batch limit = 500)
-        if batch_ops >= 450:
-            batch.commit()
-            print(f"[seed_bots] Committed 450 ops…")
-            batch = DB.batch()
-            batch_ops = 0
-
-    if batch_ops > 0:
-        batch.commit()
+        writer.set(doc_ref, data)
 
+    writer.close()
     print(f"[seed_bots] Created {len(bot_ids)} bots.")
 
     # Optionally add them to your friends list (so Friends tab populates)
@@ -112,19 +138,256 @@ def seed_bots(count: int,
         user_ref = DB.collection("users").document(friends_of)
         user_ref.update({"friends": fs.ArrayUnion(bot_ids)})
 
-        if mutual:
-            # Make friendship mutual (not required for your current friends leaderboard)
-            for bid in bot_ids:
-                DB.collection("users").document(bid).update({"friends": fs.ArrayUnion([friends_of])})
-
     print("[seed_bots] Done.")
 
+
+# ======= Population seeding (load tests) =======
+
+FRIEND_SHAPES = ("none", "random", "small-world", "power-law")
+DEFAULT_TIER_WEIGHTS = "0.35,0.25,0.20,0.12,0.08"
+_REWIRE_PROBABILITY = 0.1
+
+def population_bot_id(prefix: str, index: int) -> str:
+    return f"bot_{prefix.lower()}_{index:08d}"
+
+def _random_edges(n: int, k: int, rng: random.Random) -> Iterator[Tuple[int, int]]:
+    for i in range(n):
+        for _ in range(k):
+            yield i, rng.randrange(n)
+
+def _small_world_edges(n: int, k: int, rng: random.Random) -> Iterator[Tuple[int, int]]:
+    for i in range(n):
+        for j in range(1, k + 1):
+            target = rng.randrange(n) if rng.random() < _REWIRE_PROBABILITY else (i + j) % n
+            yield i, target
+
+def _power_law_edges(n: int, k: int, rng: random.Random) -> Iterator[Tuple[int, int]]:
+    # Every node appears in `ends` once per link it has, so uniform picks from it are
+    # proportional to degree
+    ends = array("i", range(min(n, k + 1)))
+    for i in range(1, min(n, k + 1)):
+        yield i, i - 1
+    for i in range(k + 1, n):
+        targets: Set[int] = set()
+        while len(targets) < k:
+            targets.add(ends[rng.randrange(len(ends))])
+        for t in targets:
+            yield i, t
+            ends.append(t)
+        ends.extend([i] * k)
+
+def friend_graph(n: int, shape: str, avg_friends: int, rng: random.Random) -> Tuple[array, array]:
+    """
+    Undirected friend graph over bot indices as (offsets, neighbours) arrays: bot i's friends
+    are neighbours[offsets[i]:offsets[i + 1]] (may contain repeats; deduplicated when written).
+    Compact int arrays keep millions of bots well within memory.
+    """
+    k = max(1, avg_friends // 2)
+    generate = {"random": _random_edges, "small-world": _small_world_edges, "power-law": _power_law_edges}.get(shape)
+    src, dst = array("i"), array("i")
+    if generate is not None and n > 1:
+        for a, b in generate(n, k, rng):
+            if a != b:
+                src.append(a)
+                dst.append(b)
+
+    degree = array("i", [0]) * n
+    for a, b in zip(src, dst):
+        degree[a] += 1
+        degree[b] += 1
+    offsets = array("q", [0]) * (n + 1)
+    for i in range(n):
+        offsets[i + 1] = offsets[i] + degree[i]
+    neighbours = array("i", [0]) * offsets[n]
+    fill = array("q", offsets[:n])
+    for a, b in zip(src, dst):
+        neighbours[fill[a]] = b
+        fill[a] += 1
+        neighbours[fill[b]] = a
+        fill[b] += 1
+    return offsets, neighbours
+
+def _first_free_group_ids(num_tiers: int) -> List[int]:
+    """One past the highest groupID per tier, so bots never join real users' groups."""
+    from firebase_admin import firestore as fs
+
+    free = []
+    for tier_id in range(num_tiers):
+        docs = list(
+            DB.collection("users").where("tierID", "==", tier_id)
+            .order_by("groupID", direction=fs.Query.DESCENDING).limit(1).select(["groupID"]).stream()
+        )
+        free.append(int((docs[0].to_dict() or {}).get("groupID", 0)) + 1 if docs else 0)
+    return free
+
+def bot_profile(index: int, tier_id: int, rng: random.Random, now: datetime,
+                xp_median: float, xp_sigma: float, active_mean_days: float, dormant_share: float) -> Dict[str, object]:
+    """Realistic-looking stats for one bot: XP grows with tier, activity has a dormant tail."""
+    xp = int(rng.lognormvariate(0, xp_sigma) * xp_median * (1.4 ** tier_id))
+    if rng.random() < dormant_share:
+        days_ago = rng.uniform(30, 180)
+    else:
+        days_ago = rng.expovariate(1 / max(active_mean_days, 0.01))
+    streak = 0 if days_ago >= 1 else min(365, int(rng.expovariate(1 / 4.0)) + 1)
+    return {
+        "totalXP": xp,
+        "lastLoginDate": now - timedelta(days=days_ago),
+        "currentStreak": streak,
+        "timeSpentInSeconds": int(xp * rng.uniform(10, 40)),
+    }
+
+def seed_population(count: int,
+                    seed: int,
+                    prefix: str,
+                    tier_weights: Sequence[float],
+                    xp_median: float = 300,
+                    xp_sigma: float = 1.0,
+                    active_mean_days: float = 5.0,
+                    dormant_share: float = 0.3,
+                    friends_shape: str = "random",
+                    avg_friends: int = 10,
+                    max_friends: int = 1000,
+                    friends_of: Optional[str] = None,
+                    mutual: bool = False,
+                    ops_per_second: int = 500,
+                    snapshots: bool = True,
+                    replace: bool = False):
+    from firebase_admin import firestore as fs
+    from constants import GROUP_SIZE, TIERS
+    from leaderboard_snapshots import member_row, snapshot_payload, snapshot_ref
+
+    # Group ids start past the current maximum, so reseeding over existing bots would move
+    # them into new groups while the old groups' snapshots still listed them.
+    if list(_bot_id_query(prefix).select(["tierID"]).limit(1).stream()):
+        if not replace:
+            sys.exit(
+                f"[seed_bots] Bots with prefix {prefix!r} already exist; "
+                f"run --teardown first or pass --replace."
+            )
+        print(f"[seed_bots] Removing existing {prefix!r} bots before reseeding...")
+        teardown(prefix, friends_of=friends_of)
+
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    num_tiers = len(TIERS)
+    started = time.monotonic()
+
+    print(f"[seed_bots] Building {friends_shape} friend graph for {count} bots (avg {avg_friends})...")
+    offsets, neighbours = friend_graph(count, friends_shape, avg_friends, rng)
+    me_friends: Set[int] = set(rng.sample(range(count), min(count, avg_friends))) if friends_of else set()
+    print(f"[seed_bots] Graph ready ({len(neighbours) // 2} links, {time.monotonic() - started:.1f}s)")
+
+    group_base = _first_free_group_ids(num_tiers)
+    in_tier = [0] * num_tiers
+    open_groups: Dict[Tuple[int, int], List[Dict[str, object]]] = {}
+    users = DB.collection("users")
+    writer = _bulk_writer(ops_per_second)
+    snapshot_count = 0
+
+    for i in range(count):
+        tier_id = rng.choices(range(num_tiers), weights=tier_weights)[0]
+        group_id = group_base[tier_id] + in_tier[tier_id] // GROUP_SIZE
+        in_tier[tier_id] += 1
+
+        doc_id = population_bot_id(prefix, i)
+        friends = sorted(set(neighbours[offsets[i]:offsets[i + 1]]))[:max_friends]
+        friend_ids = [population_bot_id(prefix, f) for f in friends]
+        if mutual and i in me_friends:
+            friend_ids.append(friends_of)
+        username = f"{prefix} {i}"
+        data = {
+            "userID": doc_id,
+            "username": username,
+            "displayName": username,
+            "tierID": tier_id,
+            "groupID": group_id,
+            "friends": friend_ids,
+            "isBot": True,
+            **bot_profile(i, tier_id, rng, now, xp_median, xp_sigma, active_mean_days, dormant_share),
+        }
+        writer.set(users.document(doc_id), data)
+
+        if snapshots:
+            key = (tier_id, group_id)
+            rows = open_groups.setdefault(key, [])
+            rows.append(member_row(doc_id, data))
+            if len(rows) >= GROUP_SIZE:
+                writer.set(snapshot_ref(DB, *key), snapshot_payload(*key, open_groups.pop(key)), merge=True)
+                snapshot_count += 1
+
+        if (i + 1) % 100000 == 0:
+            elapsed = time.monotonic() - started
+            print(f"[seed_bots] {i + 1} bots queued ({(i + 1) / max(elapsed, 1e-6):.0f}/s)")
+
+    for key, rows in open_groups.items():
+        writer.set(snapshot_ref(DB, *key), snapshot_payload(*key, rows), merge=True)
+        snapshot_count += 1
+    writer.close()
+
+    if friends_of and me_friends:
+        DB.collection("users").document(friends_of).update(
+            {"friends": fs.ArrayUnion([population_bot_id(prefix, f) for f in sorted(me_friends)])}
+        )
+
+    elapsed = time.monotonic() - started
+    print(
+        f"[seed_bots] Seeded {count} bots and {snapshot_count} snapshots in {elapsed:.1f}s "
+        f"({count / max(elapsed, 1e-6):.0f} bots/s); per tier: {in_tier}"
+    )
+
+def _bot_id_query(prefix: str):
+    """Users whose document id starts with bot_<prefix>_, in id order."""
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    doc_id = FieldPath.document_id()
+    users = DB.collection("users")
+    lo, hi = f"bot_{prefix.lower()}_", f"bot_{prefix.lower()}`"  # "`" sorts right after "_"
+    return users.where(doc_id, ">=", users.document(lo)).where(doc_id, "<", users.document(hi)).order_by(doc_id)
+
+def teardown(prefix: str, friends_of: Optional[str] = None, page_size: int = 2000):
+    """Delete every bot with this prefix (small-mode and population bots) and their groups' snapshots."""
+    from firebase_admin import firestore as fs
+    from leaderboard_snapshots import snapshot_ref
+
+    query = _bot_id_query(prefix).select(["tierID", "groupID"]).limit(page_size)
+    writer = _bulk_writer()
+    groups: Set[Tuple[int, int]] = set()
+    deleted_ids: List[str] = []
+    deleted = 0
+    last = None
+    while True:
+        docs = list((query.start_after(last) if last is not None else query).stream())
+        for doc in docs:
+            data = doc.to_dict() or {}
+            groups.add((int(data.get("tierID", 0) or 0), int(data.get("groupID", 0) or 0)))
+            writer.delete(doc.reference)
+            deleted += 1
+            if friends_of:
+                deleted_ids.append(doc.id)
+        if len(docs) < page_size:
+            break
+        last = docs[-1]
+        print(f"[seed_bots] {deleted} bots queued for deletion...")
+
+    # Snapshots are rebuilt from the remaining users on their next read
+    for key in groups:
+        writer.delete(snapshot_ref(DB, *key))
+    writer.close()
+
+    if friends_of and deleted_ids:
+        user_ref = DB.collection("users").document(friends_of)
+        for i in range(0, len(deleted_ids), 500):
+            user_ref.update({"friends": fs.ArrayRemove(deleted_ids[i:i + 500])})
+    print(f"[seed_bots] Teardown done: {deleted} bots and {len(groups)} group snapshots removed.")
+
 def main():
     parser = argparse.ArgumentParser(description="Seed bot users for leaderboard testing.")
     source = parser.add_mutually_exclusive_group(required=True)
     source.add_argument("--tier", type=int, help="Tier ID to place bots into (0..4)")
     parser.add_argument("--group", type=int, help="Group ID to place bots into")
     source.add_argument("--mirror-user", type=str, help="Mirror this user's tierID+groupID (e.g., your UID)")
+    source.add_argument("--population", type=int, help="Seed this many bots across all tiers (load tests)")
+    source.add_argument("--teardown", action="store_true", help="Delete all bots with --prefix")
 
     parser.add_argument("--count", type=int, default=15, help="How many bots to create (default 15)")
     parser.add_argument("--xp-min", type=int, default=80, help="Minimum XP (default 80)")
@@ -134,9 +397,52 @@ def main():
     parser.add_argument("--friends-of", type=str, help="UID to add all bots into `friends` array for this user")
     parser.add_argument("--mutual", action="store_true", help="Also add this user into each bot's friends (optional)")
 
+    population = parser.add_argument_group("population mode")
+    population.add_argument("--seed", type=int, default=0, help="Random seed; same seed, same bots (default 0)")
+    population.add_argument("--tier-weights", type=str, default=DEFAULT_TIER_WEIGHTS,
+                            help=f"Share of bots per tier, low to high (default {DEFAULT_TIER_WEIGHTS})")
+    population.add_argument("--xp-median", type=float, default=300, help="Median XP in the lowest tier (default 300)")
+    population.add_argument("--xp-sigma", type=float, default=1.0, help="Log-normal XP spread (default 1.0)")
+    population.add_argument("--active-mean-days", type=float, default=5.0,
+                            help="Mean days since last login for active bots (default 5)")
+    population.add_argument("--dormant-share", type=float, default=0.3,
+                            help="Share of bots last seen 30-180 days ago (default 0.3)")
+    population.add_argument("--friends-shape", choices=FRIEND_SHAPES, default="random", help="Friend graph shape")
+    population.add_argument("--avg-friends", type=int, default=10, help="Average friends per bot (default 10)")
+    population.add_argument("--max-friends", type=int, default=1000, help="Cap per bot's friends list (default 1000)")
+    population.add_argument("--ops-per-second", type=int, default=500,
+                            help="Initial BulkWriter rate; it ramps up from here (default 500)")
+    population.add_argument("--no-snapshots", action="store_true", help="Don't write leaderboard snapshots")
+    population.add_argument("--replace", action="store_true",
+                            help="Tear down existing bots with --prefix before seeding")
+
     args = parser.parse_args()
 
     init_db()
+    random.seed(args.seed)
+
+    if args.teardown:
+        teardown(args.prefix, friends_of=args.friends_of)
+        return
+    if args.population is not None:
+        weights = [float(w) for w in args.tier_weights.split(",")]
+        seed_population(count=args.population,
+                        seed=args.seed,
+                        prefix=args.prefix,
+                        tier_weights=weights,
+                        xp_median=args.xp_median,
+                        xp_sigma=args.xp_sigma,
+                        active_mean_days=args.active_mean_days,
+                        dormant_share=args.dormant_share,
+                        friends_shape=args.friends_shape,
+                        avg_friends=args.avg_friends,
+                        max_friends=args.max_friends,
+                        friends_of=args.friends_of,
+                        mutual=args.mutual,
+                        ops_per_second=args.ops_per_second,
+                        snapshots=not args.no_snapshots,
+                        replace=args.replace)
+        return
 
     # Resolve tier/group
     t_id = args.tier
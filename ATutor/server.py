@@ -1,39 +1,124 @@
 # ATutor/server.py
 import os
+import base64
+import binascii
 import json
+import logging
 import re
 import requests
 import google.generativeai as genai
 from fastapi import FastAPI, Header, HTTPException, status  # ✅ UPDATED
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from dotenv import load_dotenv
 import asyncio
+import time
 
-from firebase_admin import firestore as admin_firestore  # ✅ NEW
 from utils import FirebaseManager  # ✅ NEW
-from auth_utils import verify_request_and_get_user  # ✅ NEW
-from email_service import send_welcome_email  # ✅ NEW
+from auth_utils import token_cache_stats, verify_request_and_get_user  # ✅ NEW
+from email_queue import EmailQueue
+from image_preprocess import prepare_image_for_ocr
+from observability import (
+    LoopLagMonitor,
+    TimingMiddleware,
+    configure_logging,
+    log_payload,
+    metrics_snapshot,
+    record_stage,
+    stage,
+)
+from upstream_limits import UpstreamOverloaded, limiter_stats, reserve_upstream_slot, upstream_slot
+from response_cache import ResponseCache, make_cache_key, prompt_version
+from ocr_prefetch import OcrStore, UnknownImageHandle
+from answer_check import quick_verdict
 
 # Prompts for tutor features
-from prompts import get_analysis_prompt, get_chat_prompt, get_help_prompt
+from prompts import (
+    IMAGE_WORK_PLACEHOLDER,
+    get_analysis_prompt,
+    get_chat_prompt,
+    get_chat_summary_prompt,
+    get_help_prompt,
+    with_image_transcription,
+)
+
+# Server-side chat sessions (history compaction + cached context prefix)
+from chat_sessions import ChatSessionStore, compact_session
 
 # Mount the new, focused routers
-from leaderboard_routes import router as leaderboard_router
-from profile_routes import router as profile_router
+from leaderboard_routes import (
+    leaderboard_cache_stats,
+    live_leaderboard_stats,
+    router as leaderboard_router,
+    start_live_leaderboards,
+    stop_live_leaderboards,
+)
+from profile_routes import profile_cache_stats, router as profile_router
+from xp_routes import flush_xp_buffer, router as xp_router, xp_buffer_stats
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+# Upstream endpoints are overridable so the load-test harness (loadtest.py) can point them at
+# local stand-ins. GEMINI_API_ENDPOINT switches the Gemini client to its REST transport.
+MATHPIX_API_URL = os.getenv("MATHPIX_API_URL", "https://api.mathpix.com/v3/text")
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "").strip()
+if GEMINI_API_ENDPOINT:
+    genai.configure(
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        transport="rest",
+        client_options={"api_endpoint": GEMINI_API_ENDPOINT},
+    )
+else:
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+configure_logging()
+logger = logging.getLogger("atutor.server")
 
 app = FastAPI()
+app.add_middleware(TimingMiddleware)
+
+# Analysis/hint responses keyed by question + normalised transcription (see response_cache.py)
+_response_cache = ResponseCache()
+ANALYSIS_PROMPT_VERSION = prompt_version(get_analysis_prompt)
+HELP_PROMPT_VERSION = prompt_version(get_help_prompt)
+
+# OCR results by image hash + speculative prefetch handles (see ocr_prefetch.py)
+_ocr_store = OcrStore()
+
+# Persistent background email jobs (see email_queue.py)
+_email_queue = EmailQueue(get_db=FirebaseManager().get_db_client)
+
+# Event-loop lag probe; blocking calls on the loop show up in /metrics and as warnings
+_loop_lag = LoopLagMonitor()
+
+# How tutoring requests read the student's photo:
+#   "ocr"    — Mathpix transcription, then Gemini analysis of the text (two sequential network calls)
+#   "direct" — the image goes straight to Gemini, which returns the transcription with its analysis
+#   "race"   — run both and answer with whichever valid result arrives first
+VISION_MODES = ("ocr", "direct", "race")
+DEFAULT_VISION_MODE = os.getenv("TUTOR_VISION_MODE", "ocr").strip().lower()
 
 # --- Models for our API requests ---
 class AnalysisRequest(BaseModel):
-    image_data: str
+    # Send either the image itself, or a handle returned earlier by /ocr/prefetch
+    image_data: str = ""
+    image_handle: Optional[str] = None
     question_stem: str
     question_part: str
     solution_text: str
+    # Optional (newer apps): stable question id for response caching, and a flag to skip cached answers
+    question_id: Optional[str] = None
+    bypass_cache: bool = False
+    # Optional per-request override of TUTOR_VISION_MODE ("ocr" | "direct" | "race")
+    vision_mode: Optional[str] = None
+    # Optional stored answers for the local fast-path check (see answer_check.py)
+    final_answer: Optional[str] = None
+    correct_choice: Optional[str] = None
+
+class OcrPrefetchRequest(BaseModel):
+    image_data: str
 
 class ChatMessage(BaseModel):
     text: str
@@ -46,6 +131,17 @@ class ChatRequest(BaseModel):
     student_work: str
     conversation_history: List[ChatMessage]
 
+class ChatSessionStartRequest(BaseModel):
+    question_stem: str
+    question_part: str
+    solution_text: str
+    student_work: str
+    # Optional: seed a session from an existing client-side conversation
+    conversation_history: List[ChatMessage] = []
+
+class ChatSessionMessageRequest(BaseModel):
+    text: str
+
 # --- Helpers ---
 
 def _strip_status_tag(text: str):
@@ -104,8 +200,8 @@ def _safe_parse_model_json(raw_text: str):
             return json.loads(repaired)
         except json.JSONDecodeError as e2:
             # Log both errors to help debugging
-            print(f"❌ First JSON parse error: {e1}")
-            print(f"❌ Second JSON parse error after repair: {e2}")
+            logger.warning(f"First JSON parse error: {e1}")
+            logger.warning(f"Second JSON parse error after repair: {e2}")
             raise
 
 
@@ -141,150 +237,488 @@ def _safe_get_text_from_response(resp) -> str:
         return ""
 
 
-# --- Main analysis endpoint ---
-@app.post("/analyse-work")
-async def analyse_work(request: AnalysisRequest):
-    image_b64_string = "data:image/jpeg;base64," + request.image_data
+def _mathpix_transcribe(image_data: str) -> str:
+    """
+    Send a base64 JPEG (without the data: prefix) to Mathpix and return the transcribed text.
+    The image is normalised first (orientation, margins, size) unless OCR_IMAGE_PREPROCESS=off.
+    Raises requests.exceptions.RequestException on transport/HTTP errors.
+    """
+    image_b64_string = "data:image/jpeg;base64," + prepare_image_for_ocr(image_data)
+    r = requests.post(
+        MATHPIX_API_URL,
+        headers={
+            "app_id": os.getenv("MATHPIX_APP_ID"),
+            "app_key": os.getenv("MATHPIX_APP_KEY"),
+            "Content-type": "application/json",
+        },
+        json={"src": image_b64_string, "formats": ["text"]},
+    )
+    r.raise_for_status()
+    transcribed_text = r.json().get("text", "")
+    log_payload(logger, "Mathpix response", transcribed_text)
+    return transcribed_text
+
+
+async def _iterate_in_thread(iterable):
+    """
+    Async-iterate a blocking iterator (e.g. a Gemini stream) by pulling each item in a worker
+    thread, so waiting on the network never blocks the event loop for other requests.
+    """
+    iterator = await asyncio.to_thread(iter, iterable)
+    sentinel = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, sentinel)
+        if item is sentinel:
+            return
+        yield item
+
+
+def _sse_event(event: str, data) -> str:
+    """Format one Server-Sent Events frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _partial_json_string_field(text: str, key: str) -> str:
+    """
+    Best-effort extraction of a (possibly still streaming) JSON string value.
+    Given raw model output such as '{"analysis": "CORRECT", "reason": "Nice wo',
+    returns the decoded prefix of the value for `key` ("Nice wo"), or "" if the
+    field has not started yet. Never throws.
+    """
+    m = re.search(r'"' + re.escape(key) + r'"\s*:\s*"', text)
+    if not m:
+        return ""
+    body = text[m.end():]
+
+    # Walk to the closing quote (if it has arrived), honouring backslash escapes
+    i = 0
+    while i < len(body):
+        ch = body[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == '"':
+            break
+        i += 1
+    value = body[:i]
+
+    # Drop a dangling, half-received escape sequence at the end
+    trailing = len(value) - len(value.rstrip("\\"))
+    if trailing % 2 == 1:
+        value = value[:-1]
+    value = re.sub(r"\\u[0-9a-fA-F]{0,3}$", "", value)
+
     try:
-        r = requests.post(
-            "https://api.mathpix.com/v3/text",
-            headers={
-                "app_id": os.getenv("MATHPIX_APP_ID"),
-                "app_key": os.getenv("MATHPIX_APP_KEY"),
-                "Content-type": "application/json",
-            },
-            json={"src": image_b64_string, "formats": ["text"]},
+        return json.loads('"' + _escape_invalid_backslashes(value) + '"')
+    except Exception:
+        return ""
+
+
+async def _run_mathpix(image_data: str) -> str:
+    async with upstream_slot("mathpix"):
+        with stage("ocr"):
+            return await asyncio.to_thread(_mathpix_transcribe, image_data)
+
+
+async def _transcribe_request(request: AnalysisRequest) -> str:
+    """
+    Transcription for a tutoring request: from a prefetch handle if given (awaiting the background OCR
+    if it is still running), otherwise from the image bytes via the OCR cache.
+    Raises requests.exceptions.RequestException on Mathpix failures, HTTPException 404 for an
+    unknown/expired handle without image_data to fall back to.
+    """
+    if request.image_handle:
+        try:
+            return await _ocr_store.resolve(request.image_handle)
+        except UnknownImageHandle:
+            if not request.image_data:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Image handle not found or expired. Send image_data instead.",
+                )
+    if not request.image_data:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Either image_data or image_handle is required.",
         )
-        r.raise_for_status()
-        transcribed_text = r.json().get("text", "")
-        print(f"✅ Mathpix Response: {transcribed_text}")
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Error calling Mathpix API: {e}")
-        return {"status": "error", "message": "Failed to call Mathpix API."}
+    return await _ocr_store.transcribe(request.image_data, _run_mathpix)
 
-    # --- Use the imported prompt function ---
-    prompt = get_analysis_prompt(
+
+def _cache_key_for(kind: str, version: str, request: AnalysisRequest, transcribed_text: str) -> str:
+    return make_cache_key(
+        kind=kind,
+        question_id=request.question_id,
         question_part=request.question_part,
+        version=version,
+        transcription=transcribed_text,
         solution_text=request.solution_text,
-        transcribed_text=transcribed_text,
     )
 
-    try:
-        generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
-        model = genai.GenerativeModel("gemini-2.5-flash", generation_config=generation_config)
-        gemini_response = model.generate_content(prompt)
 
-        # ✅ Guard .text access
-        raw_text = _safe_get_text_from_response(gemini_response)
+def _cached_result(cache_key: str, request: AnalysisRequest):
+    """Return a copy of a cached result, or None on miss / when the client asked to bypass."""
+    if request.bypass_cache:
+        return None
+    with stage("cache"):
+        cached = _response_cache.get(cache_key)
+    return dict(cached) if cached is not None else None
 
-        try:
-            analysis_data = _safe_parse_model_json(raw_text)
-            if "analysis" not in analysis_data or "reason" not in analysis_data:
-                raise ValueError("Missing 'analysis' or 'reason' key in Gemini response.")
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"❌ Gemini response was not valid JSON or was missing keys: {e}")
-            print(f"Raw Gemini response: {raw_text}")
-            return {"status": "error", "message": "AI response was malformed."}
 
-        print(f"✅ Gemini Analysis: {analysis_data}")
+# --- Speculative OCR prefetch ---
+@app.post("/ocr/prefetch")
+async def ocr_prefetch(request: OcrPrefetchRequest, authorization: str | None = Header(default=None)):
+    """
+    Start OCR for a freshly captured photo and return immediately with a handle.
+    Pass the handle as `image_handle` to /analyse-work, /analyse-work-stream or /stuck-at-question
+    (instead of image_data); by then the transcription is usually ready.
+    Requires: Authorization: Bearer <Firebase ID token> (each call may start a paid Mathpix request).
+    """
+    verify_request_and_get_user(authorization)
+    handle = _ocr_store.prefetch(request.image_data, _run_mathpix)
+    return {"status": "success", "image_handle": handle}
 
-        response = {
-            "status": "success",
-            "result": analysis_data,
-            "transcribed_text": transcribed_text,
-        }
 
-        print(f"➡️ Sending this JSON to the app: {response}")
+# --- Shared analysis / hint pipeline ---
 
-        return response
+class _TutorCallFailed(Exception):
+    """A tutoring pipeline step failed; str(exc) is the message returned to the app."""
 
-    except Exception as e:
-        print(f"❌ Error calling Gemini API: {e}")
-        return {"status": "error", "message": f"Failed to call Gemini API: {e}"}
 
-# --- Main help endpoint ---
-@app.post("/stuck-at-question")
-async def stuck_at_question(request: AnalysisRequest):
-    image_b64_string = "data:image/jpeg;base64," + request.image_data
+def _tutor_prompt_fn(kind: str):
+    return get_analysis_prompt if kind == "analysis" else get_help_prompt
+
+
+def _tutor_prompt_version(kind: str) -> str:
+    return ANALYSIS_PROMPT_VERSION if kind == "analysis" else HELP_PROMPT_VERSION
+
+
+def _parse_tutor_reply(raw_text: str, kind: str) -> dict:
+    """Parse/repair the model JSON and check the keys the app relies on."""
     try:
-        r = requests.post(
-            "https://api.mathpix.com/v3/text",
-            headers={
-                "app_id": os.getenv("MATHPIX_APP_ID"),
-                "app_key": os.getenv("MATHPIX_APP_KEY"),
-                "Content-type": "application/json",
-            },
-            json={"src": image_b64_string, "formats": ["text"]},
+        with stage("parse"):
+            analysis_data = _safe_parse_model_json(raw_text)
+        if "analysis" not in analysis_data or "reason" not in analysis_data:
+            raise ValueError("Missing 'analysis' or 'reason' key in Gemini response.")
+        if kind == "hint":
+            # Ensure is_complete exists (default False) for UI logic
+            analysis_data["is_complete"] = bool(analysis_data.get("is_complete", False))
+    except (json.JSONDecodeError, ValueError) as e:
+        logger.error(f"Gemini response was not valid JSON or was missing keys: {e}")
+        log_payload(logger, "Raw Gemini response", raw_text)
+        raise _TutorCallFailed("AI response was malformed.")
+    return analysis_data
+
+
+async def _quick_verdict_for(request: AnalysisRequest, transcribed_text: str) -> Optional[dict]:
+    """Confident local verdict on the final answer (MCQ label / SymPy equivalence), else None."""
+    with stage("answer_check"):
+        verdict = await quick_verdict(
+            transcribed_text,
+            request.solution_text,
+            final_answer=request.final_answer,
+            correct_choice=request.correct_choice,
         )
-        r.raise_for_status()
-        transcribed_text = r.json().get("text", "")
-        print(f"✅ Mathpix Response: {transcribed_text}")
+    if verdict is not None:
+        logger.info(f"Answer fast-path verdict: {verdict['analysis']}")
+    return verdict
+
+
+async def _tutor_via_ocr(request: AnalysisRequest, kind: str) -> dict:
+    """Mathpix transcription (or prefetch handle), response cache, then Gemini on the text."""
+    try:
+        transcribed_text = await _transcribe_request(request)
     except requests.exceptions.RequestException as e:
-        print(f"❌ Error calling Mathpix API: {e}")
-        return {"status": "error", "message": "Failed to call Mathpix API."}
+        logger.error(f"Error calling Mathpix API: {e}")
+        raise _TutorCallFailed("Failed to call Mathpix API.")
+
+    if kind == "analysis":
+        verdict = await _quick_verdict_for(request, transcribed_text)
+        if verdict is not None:
+            return {"status": "success", "result": verdict, "transcribed_text": transcribed_text, "fast_path": True}
+
+    cache_key = _cache_key_for(kind, _tutor_prompt_version(kind), request, transcribed_text)
+    cached = _cached_result(cache_key, request)
+    if cached is not None:
+        return {"status": "success", "result": cached, "transcribed_text": transcribed_text, "cached": True}
 
     # --- Use the imported prompt function ---
-    prompt = get_help_prompt(
-        question_part=request.question_part,
-        solution_text=request.solution_text,
-        transcribed_text=transcribed_text,
-    )
+    with stage("prompt"):
+        prompt = _tutor_prompt_fn(kind)(
+            question_part=request.question_part,
+            solution_text=request.solution_text,
+            transcribed_text=transcribed_text,
+        )
 
     try:
         generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
         model = genai.GenerativeModel("gemini-2.5-flash", generation_config=generation_config)
-        gemini_response = model.generate_content(prompt)
+        async with upstream_slot(kind):
+            with stage("llm"):
+                gemini_response = await asyncio.to_thread(model.generate_content, prompt)
+    except UpstreamOverloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Error calling Gemini API: {e}")
+        raise _TutorCallFailed(f"Failed to call Gemini API: {e}")
+
+    # ✅ Guard .text access
+    raw_text = _safe_get_text_from_response(gemini_response)
+    analysis_data = _parse_tutor_reply(raw_text, kind)
+
+    log_payload(logger, "Gemini analysis", analysis_data)
+    _response_cache.put(cache_key, analysis_data)
+
+    return {
+        "status": "success",
+        "result": analysis_data,
+        "transcribed_text": transcribed_text,
+    }
 
-        # ✅ Guard .text access
-        raw_text = _safe_get_text_from_response(gemini_response)
 
+async def _tutor_via_image(request: AnalysisRequest, kind: str) -> dict:
+    """Single multimodal Gemini call: the model transcribes the photo and analyses it in one go."""
+    with stage("prompt"):
         try:
-            analysis_data = _safe_parse_model_json(raw_text)
-            if "analysis" not in analysis_data or "reason" not in analysis_data:
-                raise ValueError("Missing 'analysis' or 'reason' key in Gemini response.")
-            # Ensure is_complete exists (default False) for UI logic
-            analysis_data["is_complete"] = bool(analysis_data.get("is_complete", False))
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"❌ Gemini response was not valid JSON or was missing keys: {e}")
-            print(f"Raw Gemini response: {raw_text}")
-            return {"status": "error", "message": "AI response was malformed."}
+            image_bytes = base64.b64decode(
+                await asyncio.to_thread(prepare_image_for_ocr, request.image_data), validate=True
+            )
+        except (binascii.Error, ValueError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="image_data is not valid base64.")
+        # Preprocessing re-encodes to JPEG, but passes the original through when it can't improve it
+        mime_type = "image/png" if image_bytes.startswith(b"\x89PNG") else "image/jpeg"
+        prompt = with_image_transcription(
+            _tutor_prompt_fn(kind)(
+                question_part=request.question_part,
+                solution_text=request.solution_text,
+                transcribed_text=IMAGE_WORK_PLACEHOLDER,
+            )
+        )
 
-        print(f"✅ Gemini Analysis: {analysis_data}")
+    try:
+        generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
+        model = genai.GenerativeModel("gemini-2.5-flash", generation_config=generation_config)
+        async with upstream_slot(kind):
+            with stage("llm_direct"):
+                gemini_response = await asyncio.to_thread(
+                    model.generate_content, [prompt, {"mime_type": mime_type, "data": image_bytes}]
+                )
+    except UpstreamOverloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Error calling Gemini API (direct image): {e}")
+        raise _TutorCallFailed(f"Failed to call Gemini API: {e}")
+
+    raw_text = _safe_get_text_from_response(gemini_response)
+    analysis_data = _parse_tutor_reply(raw_text, kind)
+    transcribed_text = str(analysis_data.pop("transcription", "") or "")
+
+    log_payload(logger, "Gemini analysis (direct image)", analysis_data)
+    # Later OCR-mode submissions of the same working can reuse this answer
+    _response_cache.put(_cache_key_for(kind, _tutor_prompt_version(kind), request, transcribed_text), analysis_data)
+
+    return {
+        "status": "success",
+        "result": analysis_data,
+        "transcribed_text": transcribed_text,
+    }
+
+
+async def _race_tutor_paths(request: AnalysisRequest, kind: str) -> dict:
+    """Run the OCR and direct-image paths together; return the first valid result."""
+    tasks = {
+        asyncio.create_task(_tutor_via_ocr(request, kind)): "ocr",
+        asyncio.create_task(_tutor_via_image(request, kind)): "direct",
+    }
+    first_error: Optional[BaseException] = None
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    logger.info(f"Vision race won by '{tasks[task]}' path")
+                    return task.result()
+                first_error = first_error or task.exception()
+        raise first_error  # both paths failed
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def _tutor_response(request: AnalysisRequest, kind: str) -> dict:
+    mode = (request.vision_mode or DEFAULT_VISION_MODE).strip().lower()
+    if mode not in VISION_MODES:
+        mode = "ocr"
+    if not request.image_data:
+        mode = "ocr"  # a prefetch handle only carries an OCR result, not the image
 
-        response = {
-            "status": "success",
-            "result": analysis_data,
-            "transcribed_text": transcribed_text,
-        }
+    try:
+        if mode == "direct":
+            return await _tutor_via_image(request, kind)
+        if mode == "race":
+            return await _race_tutor_paths(request, kind)
+        return await _tutor_via_ocr(request, kind)
+    except _TutorCallFailed as e:
+        return {"status": "error", "message": str(e)}
 
-        print(f"➡️ Sending this JSON to the app: {response}")
 
-        return response
+# --- Main analysis endpoint ---
+@app.post("/analyse-work")
+async def analyse_work(request: AnalysisRequest):
+    return await _tutor_response(request, "analysis")
 
-    except Exception as e:
-        print(f"❌ Error calling Gemini API: {e}")
-        return {"status": "error", "message": f"Failed to call Gemini API: {e}"}
+# --- Streaming analysis endpoint (new, additive) ---
+@app.post("/analyse-work-stream")
+async def analyse_work_stream(request: AnalysisRequest):
+    """
+    Server-Sent Events version of /analyse-work. This is ADDITIVE: /analyse-work keeps its JSON contract.
+    Events, in order:
+      - ocr_done:          {"transcribed_text": "..."}
+      - analysis_started:  {}
+      - feedback_partial:  {"reason": "<feedback text so far>"}   (zero or more)
+      - final:             exactly the JSON body /analyse-work would have returned
+    On failure a single `final` event carries {"status": "error", "message": "..."}.
+    """
+    if not request.image_data and not request.image_handle:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Either image_data or image_handle is required.",
+        )
+
+    async def event_generator():
+        # 1) OCR — off the event loop (or already done by /ocr/prefetch) so the first frame flushes early
+        try:
+            transcribed_text = await _transcribe_request(request)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error calling Mathpix API: {e}")
+            yield _sse_event("final", {"status": "error", "message": "Failed to call Mathpix API."})
+            return
+        except HTTPException as e:
+            # Overloaded OCR upstream or expired image handle, surfaced once the stream has started
+            final = {"status": "error", "message": e.detail}
+            if isinstance(e, UpstreamOverloaded):
+                final["retry_after"] = e.retry_after
+            yield _sse_event("final", final)
+            return
+
+        yield _sse_event("ocr_done", {"transcribed_text": transcribed_text})
+
+        verdict = await _quick_verdict_for(request, transcribed_text)
+        if verdict is not None:
+            yield _sse_event(
+                "final",
+                {"status": "success", "result": verdict, "transcribed_text": transcribed_text, "fast_path": True},
+            )
+            return
+
+        cache_key = _cache_key_for("analysis", ANALYSIS_PROMPT_VERSION, request, transcribed_text)
+        cached = _cached_result(cache_key, request)
+        if cached is not None:
+            yield _sse_event(
+                "final",
+                {"status": "success", "result": cached, "transcribed_text": transcribed_text, "cached": True},
+            )
+            return
+
+        with stage("prompt"):
+            prompt = get_analysis_prompt(
+                question_part=request.question_part,
+                solution_text=request.solution_text,
+                transcribed_text=transcribed_text,
+            )
+
+        # 2) Analysis — stream the model output and surface the feedback text as it grows
+        yield _sse_event("analysis_started", {})
+        raw_text = ""
+        sent_reason = ""
+        try:
+            generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
+            model = genai.GenerativeModel("gemini-2.5-flash", generation_config=generation_config)
+            async with upstream_slot("analysis"):
+                llm_started = time.perf_counter()
+                stream = await asyncio.to_thread(model.generate_content, prompt, stream=True)
+
+                async for chunk in _iterate_in_thread(stream):
+                    # ✅ chunk.text can THROW if Gemini returned no valid Part
+                    piece = _safe_get_text_from_response(chunk)
+                    if not piece:
+                        continue
+                    raw_text += piece
+                    reason = _partial_json_string_field(raw_text, "reason")
+                    if reason and reason != sent_reason:
+                        sent_reason = reason
+                        yield _sse_event("feedback_partial", {"reason": reason})
+                record_stage("llm", time.perf_counter() - llm_started)
+        except UpstreamOverloaded as e:
+            yield _sse_event(
+                "final",
+                {"status": "error", "message": e.detail, "retry_after": e.retry_after},
+            )
+            return
+        except Exception as e:
+            logger.error(f"Error calling Gemini API (stream): {e}")
+            yield _sse_event("final", {"status": "error", "message": f"Failed to call Gemini API: {e}"})
+            return
+
+        # 3) Parse/repair exactly as /analyse-work does
+        try:
+            with stage("parse"):
+                analysis_data = _safe_parse_model_json(raw_text)
+            if "analysis" not in analysis_data or "reason" not in analysis_data:
+                raise ValueError("Missing 'analysis' or 'reason' key in Gemini response.")
+        except (json.JSONDecodeError, ValueError) as e:
+            logger.error(f"Gemini response was not valid JSON or was missing keys: {e}")
+            log_payload(logger, "Raw Gemini response", raw_text)
+            yield _sse_event("final", {"status": "error", "message": "AI response was malformed."})
+            return
+
+        log_payload(logger, "Gemini analysis (stream)", analysis_data)
+        _response_cache.put(cache_key, analysis_data)
+
+        yield _sse_event(
+            "final",
+            {
+                "status": "success",
+                "result": analysis_data,
+                "transcribed_text": transcribed_text,
+            },
+        )
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Main help endpoint ---
+@app.post("/stuck-at-question")
+async def stuck_at_question(request: AnalysisRequest):
+    return await _tutor_response(request, "hint")
 
 # --- Chat endpoint ---
 @app.post("/chat")
 async def chat(request: ChatRequest):
-    print(f"💬 Received chat request. History has {len(request.conversation_history)} messages.")
+    logger.info(f"Received chat request. History has {len(request.conversation_history)} messages.")
 
     formatted_history = "\n".join(
         [f"{'Student' if msg.is_user else 'Tutor'}: {msg.text}" for msg in request.conversation_history]
     )
 
     # --- Use the imported prompt function ---
-    prompt = get_chat_prompt(
-        question_part=request.question_part,
-        student_work=request.student_work,
-        solution_text=request.solution_text,
-        formatted_history=formatted_history,
-    )
+    with stage("prompt"):
+        prompt = get_chat_prompt(
+            question_part=request.question_part,
+            student_work=request.student_work,
+            solution_text=request.solution_text,
+            formatted_history=formatted_history,
+        )
 
     try:
         model = genai.GenerativeModel("gemini-2.5-flash")
-        gemini_response = model.generate_content(prompt)
+        async with upstream_slot("chat"):
+            with stage("llm"):
+                gemini_response = await asyncio.to_thread(model.generate_content, prompt)
 
         # ✅ Guard .text access (same failure mode can happen here too)
         ai_reply = _safe_get_text_from_response(gemini_response).strip()
@@ -293,18 +727,19 @@ async def chat(request: ChatRequest):
         if not ai_reply:
             ai_reply = "Sorry — I didn’t get a usable response that time. Try sending that again.\n[[STATUS: CONTINUE]]"
 
-        print(f"🤖 AI Reply (raw): {ai_reply}")
+        log_payload(logger, "AI reply (raw)", ai_reply)
 
         # Safe, regex-free parsing of optional trailing [[STATUS: ...]] tag
         ai_reply, complete = _strip_status_tag(ai_reply)
 
-        print(f"🤖 AI Reply (clean): {ai_reply}")
-        print(f"📌 Completion flag: {complete}")
+        logger.info(f"Chat reply ready (complete={complete}, {len(ai_reply)} chars)")
 
         # (Optional) could add capabilities here later without breaking old apps
         return {"status": "success", "reply": ai_reply, "complete": complete}
+    except UpstreamOverloaded:
+        raise
     except Exception as e:
-        print(f"❌ Error in chat endpoint: {e}")
+        logger.error(f"Error in chat endpoint: {e}")
         return {"status": "error", "message": f"Failed in chat endpoint: {e}"}
 
 # --- Streaming chat endpoint (new, additive) ---
@@ -314,7 +749,7 @@ async def chat_stream(request: ChatRequest):
     Streaming version of /chat. This is ADDITIVE: existing apps can keep using /chat.
     New apps can call /chat-stream to get tokens as they are generated.
     """
-    print(f"💬 (stream) Received chat request. History has {len(request.conversation_history)} messages.")
+    logger.info(f"(stream) Received chat request. History has {len(request.conversation_history)} messages.")
 
     formatted_history = "\n".join(
         [f"{'Student' if msg.is_user else 'Tutor'}: {msg.text}" for msg in request.conversation_history]
@@ -327,34 +762,153 @@ async def chat_stream(request: ChatRequest):
         formatted_history=formatted_history,
     )
 
+    # Reserve the chat slot before streaming starts, so overload is still a clean 503/429
+    chat_slot = await reserve_upstream_slot("chat")
+
     async def event_generator():
         try:
             model = genai.GenerativeModel("gemini-2.5-flash")
             # Gemini supports streaming with stream=True
-            stream = model.generate_content(prompt, stream=True)
+            stream = await asyncio.to_thread(model.generate_content, prompt, stream=True)
 
-            for chunk in stream:
+            async for chunk in _iterate_in_thread(stream):
                 # ✅ IMPORTANT: chunk.text can THROW if Gemini returned no valid Part
                 piece = _safe_get_text_from_response(chunk)
                 if piece:
                     yield piece
-                    # tiny pause helps some hosts flush output
-                    await asyncio.sleep(0)
 
         except Exception as e:
-            print(f"❌ Error in chat-stream endpoint: {e}")
+            logger.error(f"Error in chat-stream endpoint: {e}")
             # ✅ Do NOT leak internal markers like [stream-error] into the UI.
             # Provide a user-readable fallback and a status token the client can strip.
             yield "\nSorry — I hit a streaming glitch. Please send that again.\n[[STATUS: CONTINUE]]\n"
+        finally:
+            await chat_slot.aclose()
 
     # plain text streaming; client can rebuild and then strip [[STATUS: ...]] at the end
-    return StreamingResponse(event_generator(), media_type="text/plain")
+    return StreamingResponse(event_generator(), media_type="text/plain", background=BackgroundTask(chat_slot.aclose))
+
+# --- Server-side chat sessions (new, additive) ---
+# The client starts a session once with the question context, then sends ONLY the new message per turn.
+# Older turns are folded into a running summary in the background, and the fixed rules+question context
+# is bound once as the model's system instruction so it is an identical (cacheable) prefix on every turn.
+_chat_sessions = ChatSessionStore()
+_background_tasks = set()
+
+
+async def _summarize_chat_turns(previous_summary: str, formatted_turns: str) -> str:
+    model = genai.GenerativeModel("gemini-2.5-flash")
+    prompt = get_chat_summary_prompt(previous_summary=previous_summary, formatted_turns=formatted_turns)
+    async with upstream_slot("chat"):
+        resp = await asyncio.to_thread(model.generate_content, prompt)
+    return _safe_get_text_from_response(resp)
+
+
+def _schedule_compaction(session) -> None:
+    """Compact after the reply has been sent, so summarisation never sits on the critical path."""
+    task = asyncio.create_task(compact_session(session, _summarize_chat_turns))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _get_chat_session_or_404(session_id: str):
+    session = _chat_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chat session not found or expired. Start a new session.",
+        )
+    if session.model is None:
+        session.model = genai.GenerativeModel("gemini-2.5-flash", system_instruction=session.context_prompt)
+    return session
+
+
+@app.post("/chat/sessions")
+async def start_chat_session(request: ChatSessionStartRequest):
+    session = _chat_sessions.create(
+        question_part=request.question_part,
+        student_work=request.student_work,
+        solution_text=request.solution_text,
+        history=[(msg.is_user, msg.text) for msg in request.conversation_history],
+    )
+    logger.info(f"Started chat session {session.session_id} ({len(session.turns)} seeded messages).")
+    if session.turns:
+        _schedule_compaction(session)
+    return {"status": "success", "session_id": session.session_id}
+
+
+@app.post("/chat/sessions/{session_id}/message")
+async def chat_session_message(session_id: str, request: ChatSessionMessageRequest):
+    session = _get_chat_session_or_404(session_id)
+
+    async with session.lock:
+        prompt = session.turn_prompt(pending_student_message=request.text)
+        try:
+            async with upstream_slot("chat"):
+                with stage("llm"):
+                    gemini_response = await asyncio.to_thread(session.model.generate_content, prompt)
+            ai_reply = _safe_get_text_from_response(gemini_response).strip()
+        except UpstreamOverloaded:
+            raise
+        except Exception as e:
+            logger.error(f"Error in chat session endpoint: {e}")
+            return {"status": "error", "message": f"Failed in chat session endpoint: {e}"}
+
+        if not ai_reply:
+            ai_reply = "Sorry — I didn’t get a usable response that time. Try sending that again.\n[[STATUS: CONTINUE]]"
+
+        ai_reply, complete = _strip_status_tag(ai_reply)
+        session.turns.append((True, request.text))
+        session.turns.append((False, ai_reply))
+
+    _schedule_compaction(session)
+    return {"status": "success", "reply": ai_reply, "complete": complete}
+
+
+@app.post("/chat/sessions/{session_id}/stream")
+async def chat_session_stream(session_id: str, request: ChatSessionMessageRequest):
+    """Streaming variant of /chat/sessions/{id}/message; same plain-text framing as /chat-stream."""
+    session = _get_chat_session_or_404(session_id)
+    chat_slot = await reserve_upstream_slot("chat")
+
+    async def event_generator():
+        pieces: List[str] = []
+        async with session.lock:
+            prompt = session.turn_prompt(pending_student_message=request.text)
+            try:
+                stream = await asyncio.to_thread(session.model.generate_content, prompt, stream=True)
+                async for chunk in _iterate_in_thread(stream):
+                    piece = _safe_get_text_from_response(chunk)
+                    if piece:
+                        pieces.append(piece)
+                        yield piece
+            except Exception as e:
+                logger.error(f"Error in chat session stream: {e}")
+                yield "\nSorry — I hit a streaming glitch. Please send that again.\n[[STATUS: CONTINUE]]\n"
+                return
+            finally:
+                await chat_slot.aclose()
+
+            # Only record the turn once the full reply has been produced
+            ai_reply, _complete = _strip_status_tag("".join(pieces).strip())
+            if ai_reply:
+                session.turns.append((True, request.text))
+                session.turns.append((False, ai_reply))
+
+        _schedule_compaction(session)
+
+    return StreamingResponse(event_generator(), media_type="text/plain", background=BackgroundTask(chat_slot.aclose))
+
+
+@app.delete("/chat/sessions/{session_id}")
+async def end_chat_session(session_id: str):
+    return {"status": "success", "deleted": _chat_sessions.delete(session_id)}
 
 # --- Welcome email endpoint (new, secure + idempotent) ---
 @app.post("/welcome-email")
 async def welcome_email(authorization: str | None = Header(default=None)):
     """
-    Sends the welcome email ONCE per Firebase user.
+    Queues the welcome email ONCE per Firebase user (sent in the background, see email_queue.py).
     Requires: Authorization: Bearer <Firebase ID token>
     """
     user = verify_request_and_get_user(authorization)
@@ -368,34 +922,76 @@ async def welcome_email(authorization: str | None = Header(default=None)):
             detail="User token does not include an email. Cannot send welcome email.",
         )
 
-    db = FirebaseManager().get_db_client()
+    # The job is persisted before we answer; dedupe against users/{uid}.welcomeEmailSentAt
+    # (the canonical iOS user doc path, NOT legacy `Users/{uid}`) happens in the same transaction
+    try:
+        with stage("email_enqueue"):
+            result = await _email_queue.enqueue_welcome(uid, email, name or None)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to queue welcome email: {e}")
 
-    # ✅ IMPORTANT: Use the canonical iOS user doc path (`users/{uid}`), NOT legacy `Users/{uid}`
-    user_ref = db.collection("users").document(uid)
+    # `sent` keeps its old meaning for existing clients ("this call took care of the email");
+    # `queued` says delivery happens in the background
+    if not result["queued"]:
+        return {"ok": True, "sent": False, "queued": False, "reason": result["reason"]}
+    return {"ok": True, "sent": True, "queued": True, "jobId": result["jobId"]}
 
-    snap = user_ref.get()
-    if snap.exists:
-        data = snap.to_dict() or {}
-        if data.get("welcomeEmailSentAt"):
-            return {"ok": True, "sent": False, "reason": "already_sent"}
 
-    # Send email
-    try:
-        send_welcome_email(to_email=email, first_name=(name or None))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send welcome email: {e}")
+@app.on_event("startup")
+async def _start_email_queue():
+    _email_queue.start()
+
+
+@app.on_event("shutdown")
+async def _stop_email_queue():
+    await _email_queue.stop()
+
+
+@app.on_event("startup")
+async def _start_loop_lag_monitor():
+    _loop_lag.start()
+
+
+@app.on_event("shutdown")
+async def _stop_loop_lag_monitor():
+    await _loop_lag.stop()
+
+
+@app.on_event("startup")
+async def _start_live_leaderboards():
+    start_live_leaderboards()
+
+
+@app.on_event("shutdown")
+async def _stop_live_leaderboards():
+    await stop_live_leaderboards()
+
+# --- Metrics endpoint ---
+@app.get("/metrics")
+async def metrics():
+    """Rolling per-route and per-stage latency percentiles (auth, ocr, prompt, llm, parse, total)."""
+    return {
+        **metrics_snapshot(),
+        "event_loop": _loop_lag.stats(),
+        "upstreams": limiter_stats(),
+        "response_cache": _response_cache.stats(),
+        "auth_token_cache": token_cache_stats(),
+        "ocr": _ocr_store.stats(),
+        "leaderboard_cache": leaderboard_cache_stats(),
+        "live_leaderboards": live_leaderboard_stats(),
+        "profile_cache": profile_cache_stats(),
+        "email_queue": _email_queue.stats(),
+        "xp_awards": xp_buffer_stats(),
+    }
 
-    # Mark as sent (idempotency)
-    user_ref.set(
-        {
-            "email": email,
-            "welcomeEmailSentAt": admin_firestore.SERVER_TIMESTAMP,
-        },
-        merge=True,
-    )
 
-    return {"ok": True, "sent": True}
+@app.on_event("shutdown")
+async def _flush_buffered_xp():
+    # Buffered XP awards live in memory; write them out before the process exits (uvicorn runs
+    # shutdown hooks on SIGTERM; a hard kill loses at most XP_FLUSH_DELAY_SECONDS of awards)
+    await flush_xp_buffer()
 
-# ---- Mount feature routers (leaderboard & profile) ----
+# ---- Mount feature routers (leaderboard, profile & XP) ----
 app.include_router(leaderboard_router)
-app.include_router(profile_router)
\ No newline at end of file
+app.include_router(profile_router)
+app.include_router(xp_router)
\ No newline at end of file
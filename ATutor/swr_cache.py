@@ -0,0 +1,122 @@
+# ATutor/swr_cache.py
+# Small in-process TTL cache with stale-while-revalidate and per-key single-flight loads.
+#
+#   fresh  (age < ttl)                → served from memory
+#   stale  (ttl <= age < ttl + stale) → served from memory, one background refresh is started
+#   older / missing                   → loaded now; concurrent callers for the same key share one load
+#
+# Loaders are plain (blocking) functions — typically Firestore reads — and run in a worker thread.
+# invalidate() also detaches a load already in flight for the key: its result still goes to the
+# callers waiting on it, but is not stored, and later callers start a fresh load. Otherwise a read
+# that began before a write would put the pre-write value back until the entry expires.
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+Loader = Callable[[], Any]
+
+
+class SWRCache:
+    def __init__(self, ttl_seconds: float, stale_seconds: float, max_entries: int = 10000, name: str = "cache") -> None:
+        self._ttl = ttl_seconds
+        self._stale = stale_seconds
+        self._max = max_entries
+        self.name = name
+        # key -> (loaded_at, value)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, "asyncio.Task[Any]"] = {}
+        self._background: Set["asyncio.Task[Any]"] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl > 0 and self._max > 0
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: Hashable, loader: Loader) -> "asyncio.Task[Any]":
+        task = self._inflight.get(key)
+        if task is not None:
+            return task
+
+        async def run() -> Any:
+            me = asyncio.current_task()
+            try:
+                value = await asyncio.to_thread(loader)
+                if self._inflight.get(key) is me:  # not invalidated meanwhile
+                    self._store(key, value)
+                return value
+            finally:
+                if self._inflight.get(key) is me:
+                    del self._inflight[key]
+
+        task = asyncio.create_task(run())
+        self._inflight[key] = task
+        return task
+
+    def _revalidate(self, key: Hashable, loader: Loader) -> None:
+        if key in self._inflight:
+            return
+        task = self._load(key, loader)
+        self._background.add(task)
+
+        def done(t: "asyncio.Task[Any]") -> None:
+            self._background.discard(t)
+            if not t.cancelled() and t.exception() is not None:
+                logging.warning(f"{self.name}: background refresh of {key!r} failed: {t.exception()}")
+
+        task.add_done_callback(done)
+
+    async def get(self, key: Hashable, loader: Loader) -> Any:
+        if not self.enabled:
+            return await asyncio.to_thread(loader)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self._ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            if age < self._ttl + self._stale:
+                self.stale_hits += 1
+                self._revalidate(key, loader)
+                return entry[1]
+
+        self.misses += 1
+        # shield: one cancelled request must not cancel a load other requests are waiting on
+        return await asyncio.shield(self._load(key, loader))
+
+    async def refresh(self, key: Hashable, loader: Loader) -> Any:
+        """Bypass the cached value (but still share an in-flight load) and store the result."""
+        if not self.enabled:
+            return await asyncio.to_thread(loader)
+        self._entries.pop(key, None)
+        return await asyncio.shield(self._load(key, loader))
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop the entry (or all entries) and detach any load in flight for it."""
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+        else:
+            self._entries.pop(key, None)
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
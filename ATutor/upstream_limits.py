@@ -0,0 +1,212 @@
+# ATutor/upstream_limits.py
+# Per-upstream concurrency limits, rate limits and load shedding for AI calls.
+#
+# Each upstream (mathpix, analysis, hint, chat) gets:
+#   • a concurrency cap           — at most N calls in flight,
+#   • a token bucket              — at most R calls/second on average (burst B),
+#   • a bounded wait queue        — at most Q requests waiting for a slot, each for at most W seconds.
+# When the queue is full or the wait times out we fail fast with 503 + Retry-After instead of
+# piling more work onto an upstream that is already struggling (which is what turns a spike into 429 storms).
+# A full queue / exhausted concurrency wait answers 503; an exhausted rate budget answers 429.
+#
+# Usage:
+#     async with upstream_slot("mathpix"):
+#         text = await asyncio.to_thread(call_mathpix, ...)
+#
+# Env (per upstream, NAME in MATHPIX / ANALYSIS / HINT / CHAT):
+#   <NAME>_MAX_CONCURRENCY    default 8
+#   <NAME>_RATE_PER_SEC       default 0 (= no rate limit)
+#   <NAME>_BURST              default = MAX_CONCURRENCY
+#   <NAME>_MAX_QUEUE          default 32
+#   <NAME>_MAX_WAIT_SECONDS   default 10
+
+import asyncio
+import math
+import os
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException, status
+
+from observability import record_stage
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class TokenBucket:
+    """Classic token bucket; `rate` tokens/second refill up to `burst`. rate <= 0 disables it."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """Take a token and return 0.0, or return the seconds until one will be available."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+
+class UpstreamOverloaded(HTTPException):
+    """503/429 with Retry-After, raised when a request cannot get an upstream slot in time."""
+
+    def __init__(self, upstream: str, retry_after: float, status_code: int = status.HTTP_503_SERVICE_UNAVAILABLE) -> None:
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(
+            status_code=status_code,
+            detail=f"The {upstream} service is busy. Please try again shortly.",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+class UpstreamLimiter:
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        rate_per_sec: float,
+        burst: int,
+        max_queue: int,
+        max_wait_seconds: float,
+    ) -> None:
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.max_wait_seconds = max_wait_seconds
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._bucket = TokenBucket(rate_per_sec, burst)
+        self._waiting = 0
+        self._in_flight = 0
+        # Rolling average call time, used to suggest a sensible Retry-After
+        self._avg_call_seconds = 1.0
+        self.shed_count = 0
+
+    @classmethod
+    def from_env(cls, name: str) -> "UpstreamLimiter":
+        prefix = name.upper()
+        concurrency = _env_int(f"{prefix}_MAX_CONCURRENCY", 8)
+        return cls(
+            name=name,
+            max_concurrency=concurrency,
+            rate_per_sec=_env_float(f"{prefix}_RATE_PER_SEC", 0.0),
+            burst=_env_int(f"{prefix}_BURST", concurrency),
+            max_queue=_env_int(f"{prefix}_MAX_QUEUE", 32),
+            max_wait_seconds=_env_float(f"{prefix}_MAX_WAIT_SECONDS", 10.0),
+        )
+
+    def _retry_after_hint(self) -> float:
+        backlog = self._waiting + self._in_flight
+        return backlog * self._avg_call_seconds / self.max_concurrency
+
+    def _shed(self, status_code: int = status.HTTP_503_SERVICE_UNAVAILABLE, retry_after: Optional[float] = None) -> None:
+        self.shed_count += 1
+        raise UpstreamOverloaded(self.name, retry_after if retry_after is not None else self._retry_after_hint(), status_code)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        # 1) Bounded queue: refuse immediately if too many requests are already waiting
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            self._shed()
+
+        wait_started = time.perf_counter()
+        deadline = time.monotonic() + self.max_wait_seconds
+        self._waiting += 1
+        try:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait_seconds)
+            except asyncio.TimeoutError:
+                self._shed()
+
+            # 2) Rate limit: wait for a token, but never past the caller's deadline
+            try:
+                while True:
+                    delay = self._bucket.try_acquire()
+                    if delay <= 0:
+                        break
+                    if time.monotonic() + delay > deadline:
+                        self._shed(status.HTTP_429_TOO_MANY_REQUESTS, retry_after=delay)
+                    await asyncio.sleep(delay)
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self._waiting -= 1
+            record_stage(f"queue_{self.name}", time.perf_counter() - wait_started)
+
+        self._in_flight += 1
+        call_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - call_started
+            self._avg_call_seconds = 0.9 * self._avg_call_seconds + 0.1 * elapsed
+            self._in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "shed": self.shed_count,
+            "avg_call_ms": round(self._avg_call_seconds * 1000, 1),
+        }
+
+
+UPSTREAMS = ("mathpix", "analysis", "hint", "chat")
+_limiters: Dict[str, UpstreamLimiter] = {}
+
+
+def get_limiter(name: str) -> UpstreamLimiter:
+    limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = UpstreamLimiter.from_env(name)
+        _limiters[name] = limiter
+    return limiter
+
+
+def upstream_slot(name: str):
+    """`async with upstream_slot("chat"): ...` — acquire a slot on the named upstream or fail fast."""
+    return get_limiter(name).slot()
+
+
+def limiter_stats(name: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    names = [name] if name else list(UPSTREAMS)
+    return {n: get_limiter(n).stats() for n in names}
+
+
+async def reserve_upstream_slot(name: str) -> AsyncExitStack:
+    """
+    Acquire a slot NOW and hand back an AsyncExitStack that releases it on aclose().
+    Used by streaming endpoints so overload still produces a clean 503/429 before the
+    response starts; pass `stack.aclose` as the response's background task as a safety net
+    (aclose is idempotent, so the generator may also release early).
+    """
+    stack = AsyncExitStack()
+    await stack.enter_async_context(upstream_slot(name))
+    return stack
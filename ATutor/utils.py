@@ -11,6 +11,15 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 
 
+class _EmulatorCredential(credentials.Base):
+    """Anonymous credential for the local emulators (they ignore auth)."""
+
+    def get_credential(self):
+        from google.auth.credentials import AnonymousCredentials
+
+        return AnonymousCredentials()
+
+
 class FirebaseManager:
     _instance: Optional["FirebaseManager"] = None
     _lock = threading.Lock()
@@ -45,6 +54,18 @@ class FirebaseManager:
                 pass
 
             project_id = os.getenv("project_id")
+
+            # Local emulators (load tests, dev): no service account needed. Firestore reads
+            # FIRESTORE_EMULATOR_HOST itself; FIREBASE_AUTH_EMULATOR_HOST makes auth accept
+            # emulator-issued (unsigned) ID tokens.
+            if os.getenv("FIRESTORE_EMULATOR_HOST"):
+                self._app = firebase_admin.initialize_app(
+                    _EmulatorCredential(), {"projectId": project_id or "demo-atutor"}
+                )
+                self._db_client = firestore.client()
+                logging.info(f"FirebaseManager: using the Firestore emulator at {os.getenv('FIRESTORE_EMULATOR_HOST')}.")
+                return
+
             client_email = os.getenv("client_email")
             private_key = os.getenv("private_key")
 
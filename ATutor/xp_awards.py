@@ -0,0 +1,303 @@
+# ATutor/xp_awards.py
+# Server-side XP awards with per-user write coalescing.
+#
+# The app used to write users/{uid}.totalXP once per answered question, which hammers one hot
+# document for the whole study session. Award events now go through POST /xp/awards:
+#
+#   • XP is computed here from the event's xp_base and curve version (XP_CURVES).
+#   • Events are buffered per user for a few seconds (or until enough have piled up) and
+#     flushed as ONE transaction: totalXP += sum, the group's leaderboard snapshot row and the
+#     user's award ledger all change together — one write to users/{uid} for a whole burst.
+#   • Each question is awarded at most once per user: duplicates are dropped while buffered and
+#     checked against the ledger at flush time, so the app can safely re-send a session's awards
+#     (e.g. with flush=true at the end). The ledger is one small document per award,
+#     xpAwards/{uid}/q/{questionId} = {"xp", "curveVersion", "awardedAt"}, so a flush reads only
+#     the questions it awards and no document grows with the user's history.
+#
+# Durability: buffered awards live only in this process's memory until their flush commits.
+# An award waits at most XP_FLUSH_DELAY_SECONDS (XP_FLUSH_MAX_ATTEMPTS × that when flushes
+# fail), and the server's shutdown hook flushes everything still buffered (uvicorn runs it on
+# SIGTERM, i.e. on redeploys and scale-down). A crash or SIGKILL inside that window loses the
+# pending awards; re-sending them (the app does with flush=true at session end) is safe.
+#
+# Env:
+#   XP_FLUSH_DELAY_SECONDS   how long a user's awards are buffered (default 5)
+#   XP_FLUSH_MAX_EVENTS      flush early once this many awards are pending for a user (default 25)
+#   XP_FLUSH_MAX_ATTEMPTS    failed flushes are retried this many times before the XP is dropped (default 3)
+#   XP_MAX_BASE              largest accepted xp_base per question (default 100)
+
+import asyncio
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+from firebase_admin import firestore
+
+from leaderboard_snapshots import apply_member_update
+
+LEDGER_COLLECTION = "xpAwards"
+LEDGER_SUBCOLLECTION = "q"
+# A transaction may write 500 documents: one ledger document per award + user + snapshot
+_MAX_AWARDS_PER_TRANSACTION = 400
+
+FLUSH_DELAY_SECONDS = float(os.getenv("XP_FLUSH_DELAY_SECONDS", "5"))
+FLUSH_MAX_EVENTS = int(os.getenv("XP_FLUSH_MAX_EVENTS", "25"))
+FLUSH_MAX_ATTEMPTS = int(os.getenv("XP_FLUSH_MAX_ATTEMPTS", "3"))
+MAX_XP_BASE = int(os.getenv("XP_MAX_BASE", "100"))
+
+# Curve version -> XP for a question's base value. Old versions stay so older app builds keep
+# earning what they display; add a new version rather than changing an existing one.
+XP_CURVES: Dict[str, Callable[[int], int]] = {
+    "1": lambda base: base,
+}
+DEFAULT_CURVE_VERSION = "1"
+
+
+class UnknownCurveVersion(ValueError):
+    pass
+
+
+class UnknownUser(LookupError):
+    """No users/{uid} document to award XP to."""
+
+
+def _safe_int(v: Any, default: int = 0) -> int:
+    try:
+        return int(v)
+    except Exception:
+        return default
+
+
+def xp_for(xp_base: int, curve_version: str = DEFAULT_CURVE_VERSION) -> int:
+    curve = XP_CURVES.get(str(curve_version))
+    if curve is None:
+        raise UnknownCurveVersion(f"Unknown XP curve version: {curve_version}")
+    return max(0, int(curve(min(max(0, int(xp_base)), MAX_XP_BASE))))
+
+
+# ======= Flush (one transaction per user) =======
+
+def ledger_ref(db, user_id: str, question_id: str):
+    return db.collection(LEDGER_COLLECTION).document(user_id).collection(LEDGER_SUBCOLLECTION).document(question_id)
+
+
+def apply_awards(db, user_id: str, awards: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Apply buffered awards ({question_id: {"xp", "xpBase", "curveVersion"}}) in one transaction
+    (per _MAX_AWARDS_PER_TRANSACTION): one increment on users/{uid}.totalXP, the leaderboard
+    snapshot row and a ledger document per new award. Questions already in the ledger are
+    skipped. Returns {"awarded", "duplicates", "xp", "totalXP"}.
+    """
+    question_ids = list(awards)
+    merged: Dict[str, Any] = {"awarded": [], "duplicates": [], "xp": 0, "totalXP": None}
+    for i in range(0, len(question_ids), _MAX_AWARDS_PER_TRANSACTION):
+        chunk = {qid: awards[qid] for qid in question_ids[i:i + _MAX_AWARDS_PER_TRANSACTION]}
+        result = _apply_award_chunk(db, user_id, chunk)
+        merged["awarded"] += result["awarded"]
+        merged["duplicates"] += result["duplicates"]
+        merged["xp"] += result["xp"]
+        merged["totalXP"] = result["totalXP"]
+    return merged
+
+
+def _apply_award_chunk(db, user_id: str, awards: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    user_ref = db.collection("users").document(user_id)
+    ledger_refs = {qid: ledger_ref(db, user_id, qid) for qid in awards}
+
+    @firestore.transactional
+    def run(txn) -> Dict[str, Any]:
+        ledger = db.get_all(list(ledger_refs.values()), field_paths=["xp"], transaction=txn)
+        seen = {doc.id for doc in ledger if doc.exists}
+        user = user_ref.get(field_paths=["tierID", "groupID", "totalXP"], transaction=txn)
+        if not user.exists:
+            raise UnknownUser(user_id)
+        data = user.to_dict() or {}
+
+        fresh = {qid: award for qid, award in awards.items() if qid not in seen}
+        duplicates = [qid for qid in awards if qid in seen]
+        delta = sum(award["xp"] for award in fresh.values())
+        total = _safe_int(data.get("totalXP"), 0) + delta
+        if not fresh:
+            return {"awarded": [], "duplicates": duplicates, "xp": 0, "totalXP": total}
+
+        # Snapshot read happens inside apply_member_update, so it must come before our writes
+        apply_member_update(
+            db,
+            _safe_int(data.get("tierID"), 0),
+            _safe_int(data.get("groupID"), 0),
+            user_id,
+            total_xp=total,
+            transaction=txn,
+        )
+        if delta:
+            txn.update(user_ref, {"totalXP": firestore.Increment(delta), "lastXPAwardAt": firestore.SERVER_TIMESTAMP})
+        for qid, award in fresh.items():
+            txn.set(
+                ledger_refs[qid],
+                {"xp": award["xp"], "curveVersion": award["curveVersion"], "awardedAt": firestore.SERVER_TIMESTAMP},
+            )
+        return {"awarded": list(fresh), "duplicates": duplicates, "xp": delta, "totalXP": total}
+
+    return run(db.transaction())
+
+
+# ======= Per-user buffer =======
+
+class _Pending:
+    __slots__ = ("awards", "waiters", "attempts")
+
+    def __init__(self) -> None:
+        self.awards: Dict[str, Dict[str, Any]] = {}
+        self.waiters: List["asyncio.Future[Dict[str, Any]]"] = []
+        self.attempts = 0
+
+
+class XpAwardBuffer:
+    def __init__(
+        self,
+        get_db: Callable[[], Any],
+        delay_seconds: float = FLUSH_DELAY_SECONDS,
+        max_events: int = FLUSH_MAX_EVENTS,
+        max_attempts: int = FLUSH_MAX_ATTEMPTS,
+    ) -> None:
+        self._get_db = get_db
+        self._delay = delay_seconds
+        self._max_events = max_events
+        self._max_attempts = max_attempts
+        self._pending: Dict[str, _Pending] = {}
+        self._wake: Dict[str, asyncio.Event] = {}
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+        self._closing = False
+        self._listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        self.events = 0
+        self.flushes = 0
+        self.awarded = 0
+        self.duplicates = 0
+        self.failed_flushes = 0
+        self.dropped_xp = 0
+
+    def add_listener(self, callback: Callable[[str, Dict[str, Any]], None]) -> None:
+        """Call `callback(user_id, flush_result)` on the event loop after every committed flush."""
+        self._listeners.append(callback)
+
+    def add(self, user_id: str, awards: Dict[str, Dict[str, Any]], flush: bool = False) -> Dict[str, Any]:
+        """
+        Buffer awards for a user. Returns {"accepted", "duplicates", "pendingXP", "result"} where
+        `result` is a future for the flush that will include these awards (set when flush=True).
+        """
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = _Pending()
+        accepted, duplicates = [], []
+        for qid, award in awards.items():
+            if qid in pending.awards:
+                duplicates.append(qid)
+            else:
+                pending.awards[qid] = award
+                accepted.append(qid)
+        self.events += len(accepted)
+        self.duplicates += len(duplicates)
+
+        result: Optional["asyncio.Future[Dict[str, Any]]"] = None
+        if flush:
+            result = asyncio.get_running_loop().create_future()
+            pending.waiters.append(result)
+
+        self._ensure_flusher(user_id)
+        if flush or len(pending.awards) >= self._max_events:
+            self._wake[user_id].set()
+        return {
+            "accepted": accepted,
+            "duplicates": duplicates,
+            "pendingXP": sum(a["xp"] for a in pending.awards.values()),
+            "result": result,
+        }
+
+    def _ensure_flusher(self, user_id: str) -> None:
+        if user_id in self._tasks:
+            return
+        self._wake[user_id] = asyncio.Event()
+        self._tasks[user_id] = asyncio.create_task(self._flusher(user_id))
+
+    async def _flusher(self, user_id: str) -> None:
+        wake = self._wake[user_id]
+        try:
+            while True:
+                if not self._closing:
+                    try:
+                        await asyncio.wait_for(wake.wait(), self._delay)
+                    except asyncio.TimeoutError:
+                        pass
+                wake.clear()
+                pending = self._pending.pop(user_id, None)
+                if pending is None or not pending.awards:
+                    for waiter in pending.waiters if pending else []:
+                        if not waiter.done():
+                            waiter.set_result({"awarded": [], "duplicates": [], "xp": 0, "totalXP": None})
+                    return
+                await self._flush(user_id, pending)
+        finally:
+            self._tasks.pop(user_id, None)
+            self._wake.pop(user_id, None)
+
+    async def _flush(self, user_id: str, pending: _Pending) -> None:
+        try:
+            result = await asyncio.to_thread(apply_awards, self._get_db(), user_id, pending.awards)
+        except Exception as e:
+            self.failed_flushes += 1
+            for waiter in pending.waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            pending.waiters = []
+            pending.attempts += 1
+            xp = sum(a["xp"] for a in pending.awards.values())
+            if isinstance(e, UnknownUser) or pending.attempts >= self._max_attempts:
+                self.dropped_xp += xp
+                logging.error(f"XP flush for {user_id} failed ({e}); dropping {xp} XP from {len(pending.awards)} awards")
+                return
+            logging.warning(f"XP flush for {user_id} failed ({e}); retrying (attempt {pending.attempts})")
+            self._requeue(user_id, pending)
+            return
+
+        self.flushes += 1
+        self.awarded += len(result["awarded"])
+        self.duplicates += len(result["duplicates"])
+        for waiter in pending.waiters:
+            if not waiter.done():
+                waiter.set_result(result)
+        if result["awarded"]:
+            for callback in self._listeners:
+                try:
+                    callback(user_id, result)
+                except Exception as e:
+                    logging.warning(f"XP flush listener failed: {e}")
+
+    def _requeue(self, user_id: str, failed: _Pending) -> None:
+        # Awards that arrived during the failed flush win; the retried ones keep their attempt count
+        newer = self._pending.get(user_id)
+        if newer is not None:
+            for qid, award in failed.awards.items():
+                newer.awards.setdefault(qid, award)
+            newer.attempts = max(newer.attempts, failed.attempts)
+        else:
+            self._pending[user_id] = failed
+
+    async def close(self) -> None:
+        """Flush everything still buffered (app shutdown)."""
+        self._closing = True
+        for wake in list(self._wake.values()):
+            wake.set()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending_users": len(self._pending),
+            "pending_events": sum(len(p.awards) for p in self._pending.values()),
+            "events": self.events,
+            "flushes": self.flushes,
+            "awarded": self.awarded,
+            "duplicates": self.duplicates,
+            "failed_flushes": self.failed_flushes,
+            "dropped_xp": self.dropped_xp,
+        }
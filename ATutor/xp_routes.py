@@ -0,0 +1,124 @@
+# ATutor/xp_routes.py
+# XP award API for the app:
+# - POST /xp/awards   → award XP for answered questions (buffered + coalesced, see xp_awards.py)
+#
+# Body:
+#   {"events": [{"question_id": "calc2_w1_l1_q3", "xp_base": 10, "curve_version": "1"}, ...],
+#    "flush": false}
+#
+# With flush=false (normal answering) the response comes straight back with the awards
+# buffered. Send flush=true at the end of a session (or when the screen needs the committed
+# total): the request then waits for the write and returns the new totalXP.
+
+from typing import Any, Dict, List, Union
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel, Field
+
+from auth_utils import require_user_id
+from leaderboard_routes import publish_member_change
+from observability import stage
+from profile_routes import invalidate_profile
+from utils import FirebaseManager
+from xp_awards import (
+    DEFAULT_CURVE_VERSION,
+    MAX_XP_BASE,
+    UnknownCurveVersion,
+    UnknownUser,
+    XpAwardBuffer,
+    xp_for,
+)
+
+router = APIRouter(prefix="/xp", tags=["xp"])
+
+_firebase = FirebaseManager()
+_buffer = XpAwardBuffer(get_db=_firebase.get_db_client)
+# The cached /users/me payload carries totalXP
+_buffer.add_listener(lambda user_id, _result: invalidate_profile(user_id))
+# Live leaderboards watching this user get a rank delta
+_buffer.add_listener(lambda user_id, result: publish_member_change(user_id, total_xp=result["totalXP"]))
+
+# Firestore map keys: no leading "__" (reserved) and nothing that needs escaping
+_QUESTION_ID_PATTERN = r"^[A-Za-z0-9][A-Za-z0-9_\-:.]{0,127}$"
+MAX_EVENTS_PER_REQUEST = 50
+
+
+def xp_buffer_stats() -> Dict[str, int]:
+    return _buffer.stats()
+
+
+async def flush_xp_buffer() -> None:
+    await _buffer.close()
+
+
+# ======= Request Models =======
+
+class XpAwardEvent(BaseModel):
+    question_id: str = Field(pattern=_QUESTION_ID_PATTERN)
+    xp_base: int = Field(ge=0, le=MAX_XP_BASE)
+    curve_version: Union[str, int] = DEFAULT_CURVE_VERSION
+
+
+class XpAwardRequest(BaseModel):
+    events: List[XpAwardEvent] = Field(min_length=1, max_length=MAX_EVENTS_PER_REQUEST)
+    flush: bool = False
+
+
+# ======= Routes =======
+
+@router.post("/awards")
+async def award_xp(body: XpAwardRequest, user_id: str = Depends(require_user_id)) -> Dict[str, Any]:
+    """
+    Buffer XP awards for the caller. Shape:
+    {
+      "accepted": ["q1", ...],       # new awards (a question already awarded is listed in duplicates)
+      "duplicates": ["q0", ...],
+      "pendingXP": 20,               # XP buffered and not yet written
+      "flushed": false,
+      "totalXP": null                # committed total, only when flushed
+    }
+    """
+    awards: Dict[str, Dict[str, Any]] = {}
+    repeated: List[str] = []
+    for event in body.events:
+        curve_version = str(event.curve_version)
+        try:
+            xp = xp_for(event.xp_base, curve_version)
+        except UnknownCurveVersion as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        if event.question_id in awards:
+            repeated.append(event.question_id)
+            continue
+        awards[event.question_id] = {"xp": xp, "xpBase": event.xp_base, "curveVersion": curve_version}
+
+    buffered = _buffer.add(user_id, awards, flush=body.flush)
+    response: Dict[str, Any] = {
+        "accepted": buffered["accepted"],
+        "duplicates": buffered["duplicates"] + repeated,
+        "pendingXP": buffered["pendingXP"],
+        "flushed": False,
+        "totalXP": None,
+    }
+    if buffered["result"] is None:
+        return response
+
+    try:
+        with stage("xp_flush"):
+            result = await buffered["result"]
+    except UnknownUser:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User profile not found")
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="XP could not be saved yet; it will be retried",
+        )
+
+    already = set(result["duplicates"])
+    response.update(
+        accepted=[qid for qid in response["accepted"] if qid not in already],
+        duplicates=response["duplicates"] + [qid for qid in response["accepted"] if qid in already],
+        pendingXP=0,
+        flushed=True,
+        totalXP=result["totalXP"],
+    )
+    return response
@@ -0,0 +1,84 @@
+# test_answer_check.py
+"""
+Minimal offline unit tests for the /analyse-work answer fast-path.
+- No network calls
+- No Firebase
+- Just exercises ATutor/answer_check.quick_verdict()
+
+How to run:
+    python test_answer_check.py
+"""
+
+import asyncio
+import os
+import sys
+
+# --- Ensure ATutor is on sys.path so `answer_check` can be imported ---
+HERE = os.path.dirname(os.path.abspath(__file__))
+ATUTOR_DIR = os.path.join(HERE, "ATutor")
+if os.path.isdir(ATUTOR_DIR) and ATUTOR_DIR not in sys.path:
+    sys.path.insert(0, ATUTOR_DIR)
+
+try:
+    import answer_check
+except Exception as e:
+    print("ERROR: Could not import 'answer_check'.")
+    print("Tip: place this file at your project root (one level above 'ATutor').")
+    print(f"Underlying import error: {e}")
+    sys.exit(1)
+
+
+def run_case(name, transcription, final_answer, expected):
+    """Run a single fast-path case; expected is "CORRECT", "INCORRECT" or None (left to the model)."""
+    verdict = asyncio.run(answer_check.quick_verdict(transcription, "", final_answer=final_answer))
+    got = verdict["analysis"] if verdict else None
+    passed = (got == expected)
+    status = "PASS" if passed else "FAIL"
+    print(f"[{status}] {name:40} -> {got} expected={expected}")
+    if not passed:
+        print("    student  :", transcription)
+        print("    expected :", final_answer)
+    return passed
+
+
+def main():
+    if answer_check.sp is None:
+        print("SymPy is not installed; nothing to test.")
+        return
+
+    total = 0
+    passed = 0
+
+    cases = [
+        # --- confident verdicts ---
+        ("plain value (correct)", "x^2 = 4\nx = 2", "x = 2", "CORRECT"),
+        ("latex fraction (correct)", "x = \\frac{3}{4}", "x = 3/4", "CORRECT"),
+        ("equivalent form (correct)", "y = 2(x+1)", "y = 2x + 2", "CORRECT"),
+        ("coordinate pair (correct)", "(1, 2)", "(1, 2)", "CORRECT"),
+
+        # --- left to the model ---
+        ("wrong value", "x = 3", "x = 2", None),
+        ("wrong unknown", "y = 2", "x = 2", None),
+        ("unsimplified", "8/4", "2", None),
+        ("equation, not an answer", "2x + 1 = 7", "x = 3", None),
+        ("two assignments, first wrong", "x = 5, x = 2", "x = 1, x = 2", None),
+        ("two unknowns, first wrong", "x = 3, y = 2", "x = 1, y = 2", None),
+        ("chained equals", "x = 9 = 2", "x=2", None),
+        ("assignments joined by 'and'", "x = 3 and y = 2", "x = 1 and y = 2", None),
+        ("chain in the stored answer", "x = 2", "x = 9 = 2", None),
+        ("power tower", "9^9^7", "9^9^7", None),
+    ]
+
+    for name, transcription, final_answer, expected in cases:
+        total += 1
+        if run_case(name, transcription, final_answer, expected):
+            passed += 1
+
+    print("\n--- Summary ---")
+    print(f"Passed {passed}/{total} cases")
+    if passed != total:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# test_response_cache.py
+"""
+Minimal offline unit tests for the model-response cache keys.
+- No network calls
+- No Firebase
+- Just exercises ATutor/response_cache.make_cache_key()
+
+How to run:
+    python test_response_cache.py
+"""
+
+import os
+import sys
+
+# --- Ensure ATutor is on sys.path so `response_cache` can be imported ---
+HERE = os.path.dirname(os.path.abspath(__file__))
+ATUTOR_DIR = os.path.join(HERE, "ATutor")
+if os.path.isdir(ATUTOR_DIR) and ATUTOR_DIR not in sys.path:
+    sys.path.insert(0, ATUTOR_DIR)
+
+try:
+    import response_cache
+except Exception as e:
+    print("ERROR: Could not import 'response_cache'.")
+    print("Tip: place this file at your project root (one level above 'ATutor').")
+    print(f"Underlying import error: {e}")
+    sys.exit(1)
+
+
+def key(transcription):
+    return response_cache.make_cache_key("analyse", "q1", "a", "v1", transcription)
+
+
+def run_case(name, a, b, expected_same):
+    """Run a single case: do transcriptions a and b share a cache key?"""
+    same = (key(a) == key(b))
+    passed = (same == expected_same)
+    status = "PASS" if passed else "FAIL"
+    print(f"[{status}] {name:40} -> same={same} expected={expected_same}")
+    if not passed:
+        print("    a :", repr(response_cache.normalize_transcription(a)))
+        print("    b :", repr(response_cache.normalize_transcription(b)))
+    return passed
+
+
+def main():
+    total = 0
+    passed = 0
+
+    cases = [
+        # --- same answer, different presentation ---
+        ("delimiters and dfrac (same)", "$x^{2} = \\dfrac{1}{2}$", "\\( x^2=\\frac{1}{2} \\)", True),
+        ("left/right brackets (same)", "\\left( x + 1 \\right)", "(x+1)", True),
+        ("thin spaces (same)", "2\\,x", "2 x", True),
+
+        # --- different answers ---
+        ("rightarrow vs leftarrow", "x \\rightarrow 2", "x \\leftarrow 2", False),
+        ("rightharpoonup vs plain harpoonup", "x \\rightharpoonup 2", "x harpoonup 2", False),
+        ("quad vs quadrilateral text", "\\quadrilateral", "rilateral", False),
+        ("different values", "x = 2", "x = 3", False),
+    ]
+
+    for name, a, b, expected in cases:
+        total += 1
+        if run_case(name, a, b, expected):
+            passed += 1
+
+    print("\n--- Summary ---")
+    print(f"Passed {passed}/{total} cases")
+    if passed != total:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()